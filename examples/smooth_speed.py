@@ -0,0 +1,50 @@
+# Speed of signal.smooth() with direct and FFT convolution, used to determine
+# the cost model constants in signal._conv_method().
+#
+# example session (1 core)
+# ------------------------
+#
+# 1d N=100000
+#   M=5     direct: 1.01e-03  fft: 8.33e-03  auto: direct
+#   M=21    direct: 2.76e-03  fft: 8.79e-03  auto: direct
+#   M=81    direct: 4.02e-03  fft: 8.59e-03  auto: direct
+#   M=321   direct: 9.67e-03  fft: 8.32e-03  auto: fft
+#   M=1281  direct: 2.71e-02  fft: 8.34e-03  auto: fft
+#   M=5121  direct: 1.67e-01  fft: 8.60e-03  auto: fft
+# nd (20000, 10, 3), kern (M,1,1)
+#   M=5     direct: 9.83e-02  fft: 3.42e-02  auto: fft
+#   M=21    direct: 4.03e-01  fft: 3.45e-02  auto: fft
+#   M=81    direct: 1.35e+00  fft: 3.64e-02  auto: fft
+
+import timeit
+import numpy as np
+from scipy.signal import hann
+from pwtools import signal
+
+def bench(data, kern, axis=0):
+    out = {}
+    for method in ['direct', 'fft']:
+        out[method] = min(timeit.repeat(lambda: signal.smooth(data, kern,
+                                                              axis=axis,
+                                                              method=method),
+                                        number=1, repeat=3))
+    return out
+
+if __name__ == '__main__':
+    N = 100000
+    data = np.random.rand(N)
+    print("1d N=%i" %N)
+    for M in [5, 21, 81, 321, 1281, 5121]:
+        kern = hann(M)
+        tt = bench(data, kern)
+        sig_shape = (N + 2*M,)
+        print("  M=%-5i direct: %.2e  fft: %.2e  auto: %s" %(M, tt['direct'],
+            tt['fft'], signal._conv_method(sig_shape, kern.shape)))
+    data = np.random.rand(20000,10,3)
+    print("nd %s, kern (M,1,1)" %str(data.shape))
+    for M in [5, 21, 81]:
+        kern = hann(M)[:,None,None]
+        tt = bench(data, kern)
+        sig_shape = (data.shape[0] + 2*M,) + data.shape[1:]
+        print("  M=%-5i direct: %.2e  fft: %.2e  auto: %s" %(M, tt['direct'],
+            tt['fft'], signal._conv_method(sig_shape, kern.shape)))
@@ -7,6 +7,7 @@ __all__ = [\
     'comb',
     'common',
     'constants',
+    'correlation',
     'crys',
     'dcd',
     'decorators',
@@ -24,6 +25,7 @@ __all__ = [\
     'regex',
     'signal',
     'sql',
+    'structfac',
     'symmetry',
     'thermo',
     'timer',
@@ -0,0 +1,390 @@
+"""
+FFT-based time correlation functions of arrays ``(nstep, ...)`` along the
+time axis 0, block averaging and Green-Kubo integrals.
+
+All correlations are averaged over all time origins::
+
+    C_xy(t) = 1/(nstep-t) * sum_{j=0}^{nstep-t-1} x(j) y(j+t)
+
+and calculated via the cross-correlation theorem [1]_ with zero padding
+(:func:`~pwtools.signal.pad_zeros`) to at least ``2*nstep-1`` to get the
+linear (not circular) correlation. The cost is ``O(nstep*log(nstep))`` per
+component instead of ``O(nstep**2)`` with loops.
+
+The mean square displacement (:func:`msd`) is calculated with the same
+FFT trick [4]_ and the diffusion coefficient obtained from the Einstein
+relation (:func:`diffusion`).
+
+The Green-Kubo relations [2]_ give transport coefficients as time integrals
+of equilibrium correlation functions, e.g. the shear viscosity from the
+stress autocorrelation function (:func:`viscosity`).
+
+.. [1] http://mathworld.wolfram.com/Cross-CorrelationTheorem.html
+.. [2] M. P. Allen, D. J. Tildesley, Computer Simulation of Liquids,
+       Clarendon Press, 1989
+.. [3] P. J. Daivis, D. J. Evans, J. Chem. Phys. 100(1), 541, 1994
+.. [4] V. Calandrini, E. Pellegrini, P. Calligari, K. Hinsen, G. R. Kneller,
+       nMoldyn - Interfacing spectroscopic experiments, molecular dynamics
+       simulations and models for time correlation functions, Collection
+       SFN 12, 201, 2011
+"""
+
+import numpy as np
+from pwtools import constants, num
+from pwtools.signal import pad_zeros
+
+
+def ccorr(x, y=None, norm=False, unbiased=True, tonext=True):
+    """Cross-correlation ``C_xy(t) = <x(t0) y(t0+t)>_t0`` of all components
+    of `x` and `y` along axis 0.
+
+    Parameters
+    ----------
+    x : nd array (nstep, ...)
+    y : nd array (nstep, ...), optional
+        Same shape as `x`. If None then calculate the autocorrelation of
+        `x`.
+    norm : bool
+        Normalize each component by its value at ``t=0``.
+    unbiased : bool
+        Divide by the number of time origins ``nstep-t`` for each lag `t`.
+        If False, return the plain sums over time origins.
+    tonext : bool
+        Zero-pad to the next power of two ``>= 2*nstep-1`` for speed.
+
+    Returns
+    -------
+    c : nd array (nstep, ...)
+        Lags ``t=0...nstep-1``. For negative lags use ``C_xy(-t) =
+        C_yx(t)``, i.e. ``ccorr(y, x)``.
+
+    Examples
+    --------
+    >>> # VACF of each atom and direction, (nstep, natoms, 3)
+    >>> c = ccorr(traj.velocity)
+    >>> # VACF summed over atoms and directions
+    >>> c = ccorr(traj.velocity).sum(axis=2).sum(axis=1)
+    >>> # cross-correlation of two per-atom quantities
+    >>> c = ccorr(charges, coords[...,2])
+    """
+    x = np.asarray(x, dtype=float)
+    nstep = x.shape[0]
+    if tonext:
+        pad = lambda a: pad_zeros(a, axis=0, tonext=True,
+                                  tonext_min=2*nstep-1)
+    else:
+        pad = lambda a: pad_zeros(a, axis=0, nadd=nstep-1)
+    xp = pad(x)
+    nfft = xp.shape[0]
+    fx = np.fft.rfft(xp, axis=0)
+    del xp
+    if y is None:
+        spec = fx.real**2.0 + fx.imag**2.0
+    else:
+        y = np.asarray(y, dtype=float)
+        assert y.shape == x.shape, "x and y must have the same shape"
+        spec = fx.conj() * np.fft.rfft(pad(y), axis=0)
+    del fx
+    c = np.fft.irfft(spec, n=nfft, axis=0)[:nstep,...]
+    if unbiased:
+        c /= (nstep - np.arange(nstep)).reshape((nstep,) + (1,)*(c.ndim-1))
+    if norm:
+        c /= c[0,...]
+    return c
+
+
+def acorr(x, **kwds):
+    """Autocorrelation, same as ``ccorr(x, **kwds)``."""
+    return ccorr(x, y=None, **kwds)
+
+
+def block_ccorr(x, y=None, nblocks=10, **kwds):
+    """Block-averaged cross-correlation.
+
+    The time axis is split into `nblocks` non-overlapping blocks of length
+    ``nstep//nblocks`` (remaining steps at the end are skipped). The
+    correlation is calculated for each block and averaged, and the spread
+    over blocks gives the statistical error.
+
+    Parameters
+    ----------
+    x, y : nd arrays (nstep, ...)
+    nblocks : int
+    **kwds : passed to :func:`ccorr`
+
+    Returns
+    -------
+    c, err
+    c : nd array (nstep//nblocks, ...)
+        mean over blocks
+    err : nd array (nstep//nblocks, ...)
+        standard error of the mean ``std(c_blocks, ddof=1)/sqrt(nblocks)``
+    """
+    nstep = x.shape[0]
+    blen = nstep // nblocks
+    assert blen > 1, "nstep//nblocks must be > 1"
+    cb = np.array([ccorr(x[ii*blen:(ii+1)*blen,...],
+                         None if y is None else y[ii*blen:(ii+1)*blen,...],
+                         **kwds)
+                   for ii in range(nblocks)])
+    c = cb.mean(axis=0)
+    if nblocks > 1:
+        err = cb.std(axis=0, ddof=1) / np.sqrt(nblocks)
+    else:
+        err = np.zeros_like(c)
+    return c, err
+
+
+def green_kubo(c, dt=1.0, prefactor=1.0):
+    """Running Green-Kubo integral ``prefactor * int_0^t c(t') dt'`` along
+    axis 0 (trapezoidal rule).
+
+    Parameters
+    ----------
+    c : nd array (nstep, ...)
+        Correlation function, e.g. from :func:`ccorr`.
+    dt : float
+        time step
+    prefactor : float
+
+    Returns
+    -------
+    integral : nd array (nstep, ...)
+        ``integral[0] = 0``. Look for a plateau in ``integral`` as a
+        function of the upper limit ``t = arange(nstep)*dt``.
+    """
+    c = np.asarray(c, dtype=float)
+    integral = np.zeros_like(c)
+    integral[1:,...] = np.cumsum(0.5*(c[1:,...] + c[:-1,...]), axis=0) * dt
+    return integral * prefactor
+
+
+def stress_acf(stress, nblocks=None, **kwds):
+    """Isotropic autocorrelation of the traceless symmetric part of the
+    stress tensor [3]_::
+
+        P_ab = (s_ab + s_ba)/2 - delta_ab * tr(s)/3
+        C(t) = 1/10 * sum_ab <P_ab(0) P_ab(t)>
+
+    which is the average over the 5 independent components, e.g. ``C(t) =
+    <s_xy(0) s_xy(t)>`` for isotropic systems, but with better statistics.
+
+    Parameters
+    ----------
+    stress : 3d array (nstep,3,3)
+        e.g. ``Trajectory.stress``
+    nblocks : int, optional
+        Use :func:`block_ccorr` with `nblocks` blocks.
+    **kwds : passed to :func:`ccorr`
+
+    Returns
+    -------
+    c : if nblocks=None
+    c, err : else
+    c : 1d array (nstep,) or (nstep//nblocks,)
+    err : 1d array (nstep//nblocks,)
+    """
+    stress = np.asarray(stress, dtype=float)
+    assert stress.shape[1:] == (3,3), "stress must be (nstep,3,3)"
+    sym = 0.5*(stress + stress.transpose(0,2,1))
+    trace = np.trace(stress, axis1=1, axis2=2) / 3.0
+    sym -= trace[:,None,None] * np.identity(3)[None,...]
+    sym = sym.reshape(stress.shape[0], 9)
+    if nblocks is None:
+        return ccorr(sym, **kwds).sum(axis=1) / 10.0
+    else:
+        c, err = block_ccorr(sym, nblocks=nblocks, **kwds)
+        # components are not independent, so add errors linearly instead of
+        # in quadrature (upper bound)
+        return c.sum(axis=1) / 10.0, err.sum(axis=1) / 10.0
+
+
+def viscosity(stress, volume, temperature, dt, nblocks=None):
+    """Running Green-Kubo integral of the shear viscosity::
+
+        eta(t) = V/(kB*T) * int_0^t C(t') dt'
+
+    with the stress ACF ``C(t)`` from :func:`stress_acf`.
+
+    Parameters
+    ----------
+    stress : 3d array (nstep,3,3)
+        Stress tensor in GPa, e.g. ``Trajectory.stress``.
+    volume : float
+        Volume in Angstrom**3, e.g. ``Trajectory.volume.mean()``.
+    temperature : float
+        Temperature in K.
+    dt : float
+        Time step in fs, e.g. ``Trajectory.timestep``.
+    nblocks : int, optional
+        Block averaging, see :func:`stress_acf`.
+
+    Returns
+    -------
+    eta : if nblocks=None
+    eta, err : else
+    eta : 1d array
+        Viscosity in Pa*s as a function of the upper integral limit ``t =
+        arange(len(eta))*dt``. Take the value at the plateau.
+    err : 1d array
+        Standard error of `eta` from the block errors of the ACF (upper
+        bound).
+
+    Examples
+    --------
+    >>> eta = viscosity(traj.stress, traj.volume.mean(), 300, traj.timestep)
+    >>> plot(np.arange(len(eta))*traj.timestep, eta*1e3) # mPa*s
+    """
+    prefactor = volume * constants.Angstrom**3.0 / constants.kb / \
+                temperature * constants.GPa**2.0 * constants.fs
+    if nblocks is None:
+        c = stress_acf(stress)
+        return green_kubo(c, dt=dt, prefactor=prefactor)
+    else:
+        c, err = stress_acf(stress, nblocks=nblocks)
+        return (green_kubo(c, dt=dt, prefactor=prefactor),
+                green_kubo(err, dt=dt, prefactor=prefactor))
+
+
+def msd(coords, maxmem=1.0):
+    """Mean square displacement of each atom, averaged over all time
+    origins::
+
+        MSD(t) = <|r(t0+t) - r(t0)|**2>_t0
+
+    FFT algorithm [4]_, O(nstep*log(nstep)) instead of O(nstep**2)::
+
+        MSD(t) = S1(t) - 2*S2(t)
+        S1(t) = 1/(nstep-t) * sum_{j=0}^{nstep-t-1} (r(j)**2 + r(j+t)**2)
+        S2(t) = <r(t0) . r(t0+t)>_t0
+
+    where S1 is calculated by a recursion and S2 with :func:`ccorr`.
+
+    Parameters
+    ----------
+    coords : 3d array-like (nstep, natoms, 3)
+        *Unwrapped* Cartesian coordinates, e.g. ``Trajectory.coords``
+        without jumps across the cell boundaries (see
+        :func:`~pwtools.crys.unwrap`). Any array-like which supports slicing
+        (``numpy.memmap``, ``h5py.Dataset``) works.
+    maxmem : float
+        Max. memory in GB for temp arrays. Atoms are processed in blocks
+        which fit into that, such that only one block of `coords` is in
+        memory at a time.
+
+    Returns
+    -------
+    msd : 2d array (nstep, natoms)
+
+    See Also
+    --------
+    msd_species, diffusion
+    """
+    nstep, natoms = coords.shape[:2]
+    assert coords.shape[2] == 3, "coords must be (nstep,natoms,3)"
+    # coords, padded coords, complex FFT, result
+    bytes_per_atom = nstep * 3 * 8.0 * 8
+    nblock = num.block_size(natoms, bytes_per_atom, maxmem)
+    out = np.empty((nstep, natoms), dtype=float)
+    for start in range(0, natoms, nblock):
+        sl = slice(start, min(start + nblock, natoms))
+        rr = np.asarray(coords[:,sl,:], dtype=float)
+        # remove mean position for numerical accuracy, MSD is invariant
+        rr = rr - rr.mean(axis=0)[None,...]
+        dsq = (rr**2.0).sum(axis=2)
+        qq = np.empty_like(dsq)
+        qq[0,:] = 2.0 * dsq.sum(axis=0)
+        qq[1:,:] = qq[0,:] - np.cumsum(dsq[:-1,:] + dsq[:0:-1,:], axis=0)
+        s1 = qq / (nstep - np.arange(nstep))[:,None]
+        s2 = ccorr(rr).sum(axis=2)
+        out[:,sl] = s1 - 2.0*s2
+        del rr, dsq, qq, s1, s2
+    # MSD(0) = 0 exactly, FFT noise
+    out[0,:] = 0.0
+    return out
+
+
+def msd_species(traj, maxmem=1.0):
+    """MSD averaged over atoms of each species.
+
+    Parameters
+    ----------
+    traj : Trajectory
+        With unwrapped ``traj.coords``.
+    maxmem : float
+        See :func:`msd`.
+
+    Returns
+    -------
+    msd : 2d array (nspecies, nstep)
+        Order as in ``traj.symbols_unique``.
+
+    Examples
+    --------
+    >>> tr = crys.unwrap(traj)
+    >>> mm = msd_species(tr)
+    >>> t = np.arange(tr.nstep) * tr.timestep
+    >>> for sym, ms in zip(tr.symbols_unique, mm):
+    ...     plot(t, ms, label=sym)
+    """
+    mm = msd(traj.coords, maxmem=maxmem)
+    symbols = np.array(traj.symbols)
+    return np.array([mm[:,symbols==sym].mean(axis=1) for sym in
+                     traj.symbols_unique])
+
+
+def diffusion(msd, dt=1.0, tmin=None, tmax=None, ndim=3):
+    """Diffusion coefficient from the Einstein relation ``MSD(t) = 2*ndim*D*t
+    + b``, linear fit in the diffusive regime ``tmin <= t <= tmax``.
+
+    Parameters
+    ----------
+    msd : 1d array (nstep,) or 2d array (nstep, natoms)
+        From :func:`msd` or :func:`msd_species`, time axis 0. If 2d, each
+        column is fitted separately and the error is the standard error of
+        the mean over columns.
+    dt : float
+        time step
+    tmin, tmax : float, optional
+        Fit range, same unit as `dt`. Default: skip the first 10% (ballistic
+        regime) and the last 50% (few time origins, noisy).
+    ndim : int
+        dimensionality
+
+    Returns
+    -------
+    D, err
+        Diffusion coefficient in units of ``unit(msd)/unit(dt)``, e.g.
+        Angstrom**2/fs, and its standard error. For 1d `msd` the error is
+        the standard error of the slope, which underestimates the true error
+        since the MSD values at different times are correlated.
+
+    Examples
+    --------
+    >>> mm = msd(traj.coords)
+    >>> D, err = diffusion(mm, dt=traj.timestep)
+    >>> # in cm**2/s
+    >>> D * 1e-16 / 1e-15
+    """
+    msd = np.asarray(msd, dtype=float)
+    nstep = msd.shape[0]
+    t = np.arange(nstep) * dt
+    tmin = 0.1*t[-1] if tmin is None else tmin
+    tmax = 0.5*t[-1] if tmax is None else tmax
+    msk = (t >= tmin) & (t <= tmax)
+    assert msk.sum() > 2, "need > 2 points in fit range"
+    tt = t[msk]
+    yy = msd[msk,...].reshape(msk.sum(), -1)
+    aa = np.array([tt, np.ones_like(tt)]).T
+    coeffs = np.linalg.lstsq(aa, yy, rcond=None)[0]
+    slopes = coeffs[0,:] / (2.0*ndim)
+    if msd.ndim == 1:
+        # standard error of the slope from residuals
+        resid = yy[:,0] - np.dot(aa, coeffs[:,0])
+        sigma2 = (resid**2.0).sum() / (len(tt) - 2)
+        err = np.sqrt(sigma2 / ((tt - tt.mean())**2.0).sum()) / (2.0*ndim)
+        return slopes[0], err
+    else:
+        nn = len(slopes)
+        err = slopes.std(ddof=1) / np.sqrt(nn) if nn > 1 else 0.0
+        return slopes.mean(), err
@@ -1,8 +1,9 @@
 from math import acos, pi, sin, cos, sqrt
-import textwrap, time, os, tempfile, types, copy, itertools
+import textwrap, time, os, tempfile, types, copy, itertools, pickle
 
 import numpy as np
 from scipy.linalg import inv
+from scipy.spatial import cKDTree
 
 from pwtools import common, signal, num, atomic_data, constants, _flib
 from pwtools.common import assert_cond
@@ -821,6 +822,86 @@ def pbc_wrap(obj, copy=True, **kwds):
     return out
 
 
+def unwrap_coords(coords_frac, out=None, maxmem=1.0):
+    """Reconstruct continuous fractional coords of a trajectory whose atoms
+    were wrapped into the cell (inverse of :func:`pbc_wrap_coords`).
+
+    Frame-to-frame displacements are reduced to the minimum image (in
+    fractional coords, i.e. for any, also variable, cell) and cumulatively
+    summed, starting at the first frame. Valid as long as no atom moves by
+    more than half a cell vector between two frames.
+
+    Parameters
+    ----------
+    coords_frac : 3d array-like (nstep, natoms, 3)
+        Any array-like which supports slicing along the time axis, e.g. a
+        ``numpy.memmap`` or ``h5py.Dataset``.
+    out : 3d array-like (nstep, natoms, 3), optional
+        Write result to this array (e.g. on-disk, see above) instead of
+        allocating a new one. Can be `coords_frac` itself for an in-place
+        operation.
+    maxmem : float
+        Max. memory in GB for temp arrays. Time steps are processed in chunks
+        which fit into that.
+
+    Returns
+    -------
+    out : 3d array (nstep, natoms, 3)
+
+    See Also
+    --------
+    unwrap
+    """
+    nstep, natoms = coords_frac.shape[:2]
+    assert coords_frac.shape[2] == 3, "coords_frac must be (nstep,natoms,3)"
+    if out is None:
+        out = np.empty((nstep, natoms, 3), dtype=float)
+    # chunk + diffs + cumsum
+    nchunk = int(min(nstep, max(1, maxmem * 1e9 / (natoms * 3 * 8.0 * 4))))
+    prev_wrapped = None
+    prev_unwrapped = None
+    for start in range(0, nstep, nchunk):
+        tsl = slice(start, min(start + nchunk, nstep))
+        wrapped = np.array(coords_frac[tsl,...], dtype=float)
+        if prev_wrapped is None:
+            prev_wrapped = wrapped[0,...]
+            prev_unwrapped = wrapped[0,...]
+        dd = np.diff(np.concatenate((prev_wrapped[None,...], wrapped),
+                                    axis=0), axis=0)
+        dd -= np.round(dd)
+        unwrapped = prev_unwrapped[None,...] + np.cumsum(dd, axis=0)
+        prev_wrapped = wrapped[-1,...]
+        prev_unwrapped = unwrapped[-1,...]
+        out[tsl,...] = unwrapped
+    return out
+
+
+def unwrap(obj, copy=True, **kwds):
+    """Unwrap atoms wrapped into the cell.
+
+    Same as :func:`unwrap_coords` but accepts a Trajectory instead of the
+    array ``coords_frac``. Returns an object with continuous (unwrapped)
+    coords_frac and coords, e.g. for :func:`velocity_traj`, :func:`rmsd` or
+    :func:`~pwtools.correlation.msd`.
+
+    Parameters
+    ----------
+    obj : Trajectory
+    copy : bool
+        Return copy or in-place modified object.
+    **kwds : keywords
+        passed to :func:`unwrap_coords`
+    """
+    assert obj.is_traj, "need a Trajectory"
+    out = obj.copy() if copy else obj
+    # set to None so that it will be re-calculated by set_all()
+    out.coords = None
+    out.coords_frac = unwrap_coords(out.coords_frac, out=out.coords_frac,
+                                    **kwds)
+    out.set_all()
+    return out
+
+
 def coord_trans(coords, old=None, new=None, copy=True, axis=-1):
     """General-purpose n-dimensional coordinate transformation. `coords` can
     have arbitrary dimension, i.e. it can contain many vectors to be
@@ -1054,12 +1135,78 @@ def rmax_smith(cell):
     rmax = 0.5*min(wa,wb,wc)
     return rmax
 
+
+def rmax_smith3d(cell, axis=0):
+    """Same as :func:`rmax_smith` for 3d arrays.
+
+    Parameters
+    ----------
+    cell : 3d array
+    axis : time axis (e.g. cell.shape = (100,3,3) -> axis=0)
+
+    Returns
+    -------
+    rmax : 1d array
+    """
+    assert cell.ndim == 3
+    sl = [slice(None)]*cell.ndim
+    ret = []
+    for ii in range(cell.shape[axis]):
+        sl[axis] = ii
+        ret.append(rmax_smith(cell[tuple(sl)]))
+    return np.array(ret)
+
+
+def _dists_blocks(coords_frac0, coords_frac1, cell, idx0, idx1, pbc=True,
+                  maxmem=2.0):
+    """Generator over blocks of time steps, yielding cartesian distances
+    between pairs of atoms ``coords_frac0[:,idx0[k],:]`` and
+    ``coords_frac1[:,idx1[k],:]``.
+
+    Parameters
+    ----------
+    coords_frac0, coords_frac1 : (nstep, natoms0, 3), (nstep, natoms1, 3)
+        Fractional coords, can be the same array.
+    cell : (nstep,3,3)
+    idx0, idx1 : 1d int arrays (npairs,)
+        Atom indices into `coords_frac0` and `coords_frac1`.
+    pbc : bool
+        Apply minimum image convention.
+    maxmem : float
+        Maximal memory for temporary arrays in GB, determines the number of
+        time steps per block (at least one).
+
+    Returns
+    -------
+    generator, yields ``tsl, dists``
+    tsl : slice
+        Time steps of the current block.
+    dists : (tsl.stop - tsl.start, npairs)
+    """
+    nstep = coords_frac0.shape[0]
+    npairs = len(idx0)
+    assert len(idx1) == npairs
+    # sij (float, 3) + temp arrays
+    nstep_block = max(1, int(maxmem * 1e9 / (npairs * 24.0 * 2)))
+    for start in range(0, nstep, nstep_block):
+        tsl = slice(start, min(start + nstep_block, nstep))
+        # sij: (nb, npairs, 3)
+        sij = coords_frac0[tsl,idx0,:] - coords_frac1[tsl,idx1,:]
+        if pbc:
+            sij = min_image_convention(sij)
+        # rij: (nb, npairs, 3), per-step cell
+        rij = np.matmul(sij, cell[tsl,...])
+        del sij
+        yield tsl, np.sqrt((rij**2.0).sum(axis=2))
+
+
 def rpdf(trajs, dr=0.05, rmax='auto', amask=None, tmask=None, 
          dmask=None, pbc=True, norm_vmd=False, maxmem=2.0):
     """Radial pair distribution (pair correlation) function for Structures and
     Trajectories. In case of trajectories, the time-averaged RPDF is returned.
-    Can also handle non-orthorhombic unit cells (simulation boxes). 
-    Only fixed-cell MD at the moment.
+    Can also handle non-orthorhombic unit cells (simulation boxes) and
+    variable-cell MD (e.g. NPT), where each time step is normalized with its
+    own cell volume.
 
     Parameters
     ----------
@@ -1078,7 +1225,8 @@ def rpdf(trajs, dr=0.05, rmax='auto', amask=None, tmask=None,
         For cubic boxes of side length L, this is L/2 [AT,MD].
 
         | 'auto' : the method of [Smith] is used to calculate the max. sphere
-        |     raduis for any cell shape
+        |     raduis for any cell shape, for variable cell the minimum over
+        |     all time steps
         | float : set value yourself
     amask : None, list of one or two bool 1d arrays, list of one or two strings 
         Optional atom mask. This is the complementary functionality to
@@ -1112,7 +1260,9 @@ def rpdf(trajs, dr=0.05, rmax='auto', amask=None, tmask=None,
         all-all correlations only. `num_int` is not affected. Use this only for
         testing.
     maxmem : float, optional
-        Maximal allowed memory to use, in GB.
+        Maximal memory to use for temporary distance arrays, in GB. Time steps
+        are processed in blocks which fit into `maxmem`, so memory usage
+        doesn't grow with the number of time steps.
 
     Returns
     -------
@@ -1147,13 +1297,13 @@ def rpdf(trajs, dr=0.05, rmax='auto', amask=None, tmask=None,
     ``array(symbols)=='O'`` ("name O" in VMD) is much more difficult than VMD's
     powerful selection syntax.
 
-    Curently, the atom distances are calculated by using numpy fancy indexing.
-    That creates (big) arrays in memory. For data from long MDs, you may run
-    into trouble here. For a 20000 step MD, start by using every 200th step or
-    so (use ``tmask=slice(None,None,200)``) and look at the histogram, as you
-    take more and more points into account (every 100th, 50th step, ...).
+    Curently, the atom distances are calculated by using numpy fancy indexing
+    for blocks of time steps (see `maxmem`). For data from long MDs, this is
+    still the bottleneck. For a 20000 step MD, start by using every 200th step
+    or so (use ``tmask=slice(None,None,200)``) and look at the histogram, as
+    you take more and more points into account (every 100th, 50th step, ...).
     Especially for Car Parrinello, where time steps are small and the structure
-    doesn't change much, there is no need to use every step. See also `maxmem`.
+    doesn't change much, there is no need to use every step.
 
     Examples
     --------
@@ -1372,22 +1522,19 @@ def rpdf(trajs, dr=0.05, rmax='auto', amask=None, tmask=None,
     # distances, which seems to be correct (compare w/ VMD).
     #
     # We can easily create a MemoryError b/c of the temp arrays that numpy
-    # creates. But even w/ numexpr, which avoids big temp arrays, we store the
-    # result sij, which is a 4d array. For natoms=100, nstep=1e5, we already
-    # have a 24 GB array in RAM! The only solution is to code this section
-    # using Fortran/Cython/whatever in loops:
-    #   * distances
-    #   * apply min_image_convention() (optional)
-    #   * sij -> rij transform
-    #   * redcution to distances
+    # creates. sij for all steps is a 4d array. For natoms=100, nstep=1e5, we
+    # would have a 24 GB array in RAM! Therefore, we loop over blocks of time
+    # steps, where the block size is determined by `maxmem`, see
+    # _dists_blocks(). Only the histogram sums are accumulated, so memory
+    # doesn't grow with nstep.
     # 
     # Variable cell
     # -------------
-    # Currently, we allow only fixed cell data b/c then we can use numpy
-    # broadcasting to convert fractional to cartesian coords. But if we
-    # implement the distance calculation in Fortran, we can easily allow
-    # variable cell b/c then, we explicitely loop over time steps and can
-    # perform the conversion at every step.
+    # Each block has its own cells (nstep_block,3,3), which we use with
+    # np.matmul's broadcasting to convert fractional to cartesian coords at
+    # every step. The normalization factor norm_fac_pre = volume / volume_shells
+    # is calculated per time step as well. rmax='auto' is the minimum of
+    # rmax_smith() over all steps, such that g(r) is correct for all cells.
     #
     # Differences to VMD's measure gofr
     # =================================
@@ -1453,15 +1600,39 @@ def rpdf(trajs, dr=0.05, rmax='auto', amask=None, tmask=None,
     # normalized g(r) for rmax_auto < r < rmax_vmd, which is however of little
     # use, if the num_int doesn't match.
     
+    clst, cell, volume = _rpdf_prepare(trajs, amask=amask, tmask=tmask)
+    if rmax == 'auto':
+        rmax = rmax_smith3d(cell).min()
+    acc = RPDFAccumulator(dr=dr, rmax=rmax, dmask=dmask, pbc=pbc,
+                          norm_vmd=norm_vmd, maxmem=maxmem)
+    acc._update(clst, cell, volume)
+    return acc.result()
+
+
+def _rpdf_prepare(trajs, amask=None, tmask=None):
+    """Input processing for :func:`rpdf` and :class:`RPDFAccumulator`.
+
+    Parameters
+    ----------
+    trajs, amask, tmask : see :func:`rpdf`
+
+    Returns
+    -------
+    clst, cell, volume
+    clst : list of two 3d arrays (nstep, natoms0, 3), (nstep, natoms1, 3)
+        Fractional coords of both selections.
+    cell : (nstep,3,3)
+    volume : (nstep,)
+    """
     dup_trajs = False
-    if amask is None:
-        amask = [slice(None)]
+    # copy, don't modify input list
+    amask = [slice(None)] if amask is None else list(amask)
     if tmask is None:
         tmask = slice(None)
     if type(trajs) != type([]):
         trajs = [trajs]
     if len(trajs) == 1:
-        trajs *= 2
+        trajs = trajs * 2
         dup_trajs = True
     if len(amask) == 1:
         amask *= 2
@@ -1489,73 +1660,284 @@ def rpdf(trajs, dr=0.05, rmax='auto', amask=None, tmask=None,
             clst[ii] = clst[ii][None,...]
             assert len(clst[ii].shape) == 3
             assert clst[ii].shape[2] == 3
-    natoms0 = clst[0].shape[1]
-    natoms1 = clst[1].shape[1]
-    # assume fixed cell, 2d 
-    cell = trajs[0].cell[0,...]
-    volume = trajs[0].volume[0] 
     nstep = clst[0].shape[0]
-    rmax_auto = rmax_smith(cell)
+    # cell: (nstep,3,3), volume: (nstep,), fixed or variable cell
+    cell = trajs[0].cell[tmask,...]
+    volume = trajs[0].volume[tmask]
+    if cell.ndim == 2:
+        cell = cell[None,...]
+        volume = np.atleast_1d(volume)
+    assert cell.shape == (nstep,3,3)
+    assert volume.shape == (nstep,)
+    return clst, cell, volume
+
+
+class RPDFAccumulator(object):
+    """Streaming version of :func:`rpdf` for trajectories which are processed
+    in chunks, e.g. read piece by piece from big DCD, dump or HDF5 files.
+
+    Only the histogram sums and the number of time steps are stored, so
+    memory doesn't depend on the number of processed steps. Partial results
+    (e.g. from parallel workers or from separate job segments) can be
+    combined with :meth:`merge`. Use :meth:`dump` to save the state and
+    :func:`~pwtools.io.read_pickle` to load it, e.g. to resume a long
+    analysis or to merge the results of many restart jobs without reading
+    any coordinates again.
+
+    Examples
+    --------
+    >>> acc = crys.RPDFAccumulator(dr=0.1, rmax=5.0, amask=['O', 'H'])
+    >>> for chunk in chunks:
+    ...     acc.update(chunk)
+    ...     acc.dump('rpdf_state.pk')
+    >>> d = acc.result()
+    >>> # merge results of many job segments
+    >>> acc = io.read_pickle('seg0/rpdf_state.pk')
+    >>> for fn in ['seg1/rpdf_state.pk', 'seg2/rpdf_state.pk']:
+    ...     acc.merge(io.read_pickle(fn))
+    >>> d = acc.result()
+    """
+    def __init__(self, dr=0.05, rmax=None, amask=None, dmask=None, pbc=True,
+                 norm_vmd=False, maxmem=2.0):
+        """
+        Parameters
+        ----------
+        rmax : float
+            Max. radius. Must be given explicitly since the cells of later
+            chunks are unknown, use ``rmax_smith3d(traj.cell).min()`` or
+            smth like that.
+        dr, amask, dmask, pbc, norm_vmd, maxmem : see :func:`rpdf`
+        """
+        assert rmax is not None, ("rmax must be given")
+        self.dr = dr
+        self.rmax = rmax
+        self.amask = amask
+        self.dmask = dmask
+        self.pbc = pbc
+        self.norm_vmd = norm_vmd
+        self.maxmem = maxmem
+        self.bins = np.arange(0, rmax+dr, dr)
+        self.rad = self.bins[:-1]+0.5*dr
+        self.volume_shells = 4.0/3.0*pi*(self.bins[1:]**3.0 -
+                                         self.bins[:-1]**3.0)
+        self.hist_sum = np.zeros(len(self.bins)-1, dtype=float)
+        self.number_integral_sum = np.zeros(len(self.bins)-1, dtype=float)
+        self.nstep = 0
+
+    def update(self, trajs):
+        """Add time steps.
+
+        Parameters
+        ----------
+        trajs : Structure or Trajectory or list of one or two such objects,
+            see :func:`rpdf`
+        """
+        clst, cell, volume = _rpdf_prepare(trajs, amask=self.amask)
+        self._update(clst, cell, volume)
+        return self
+
+    def _update(self, clst, cell, volume):
+        # Theory and implementation notes: see rpdf().
+        natoms0 = clst[0].shape[1]
+        natoms1 = clst[1].shape[1]
+        bins = self.bins
+        rmax = self.rmax
+        dmask = self.dmask
+        # all (natoms0, natoms1) combinations as pairs of atom indices
+        idx0 = np.repeat(np.arange(natoms0), natoms1)
+        idx1 = np.tile(np.arange(natoms1), natoms0)
+        for tsl, dists_all in _dists_blocks(clst[0], clst[1], cell, idx0, idx1,
+                                            pbc=self.pbc, maxmem=self.maxmem):
+            nb = tsl.stop - tsl.start
+            if self.norm_vmd:
+                msk = dists_all < 1e-15
+                dups = [len(np.nonzero(entry)[0]) for entry in msk]
+            else:
+                dups = np.zeros((nb,))
+
+            # Not needed b/c bins[-1] == rmax, but doesn't hurt. Plus,
+            # test_rpdf.py would fail b/c old reference data calculated w/
+            # that setting (difference 1%, only the last point differs).
+            dists_all[dists_all >= rmax] = 0.0
+            
+            if dmask is not None:
+                placeholder = '{d}'
+                if placeholder in dmask:
+                    _dmask = dmask.replace(placeholder, 'dists_all')
+                else:
+                    _dmask = 'dists_all ' + dmask
+                dists_all[np.invert(eval(_dmask))] = 0.0
+
+            # Calculate hists for each time step and sum them. This Python
+            # loop is the bottleneck if we have many timesteps.
+            for idx in range(nb):
+                # rad_hist == bins
+                hist, rad_hist = np.histogram(dists_all[idx,...], bins=bins)
+                if bins[0] == 0.0:
+                    hist[0] = 0.0
+                norm_fac = volume[tsl.start + idx] / self.volume_shells \
+                    / (natoms0 * natoms1 - dups[idx])
+                self.hist_sum += hist * norm_fac
+                self.number_integral_sum += 1.0 * np.cumsum(hist) / natoms0
+        self.nstep += cell.shape[0]
+
+    @staticmethod
+    def _setting_equal(a, b):
+        # amask: None, list of symbols, index or bool arrays; dmask: None or
+        # str; pbc, norm_vmd: bool
+        if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+            return len(a) == len(b) and \
+                all(RPDFAccumulator._setting_equal(x, y) for x,y in zip(a, b))
+        if a is None or b is None:
+            return a is b
+        return np.array_equal(np.asarray(a), np.asarray(b))
+
+    def merge(self, other):
+        """Add the histogram sums of another RPDFAccumulator, which must have
+        the same `dr`, `rmax`, `amask`, `dmask`, `pbc` and `norm_vmd`.
+        
+        Parameters
+        ----------
+        other : RPDFAccumulator
+        """
+        assert len(self.bins) == len(other.bins) and \
+            np.allclose(self.bins, other.bins), ("bins differ")
+        for name in ['amask', 'dmask', 'pbc', 'norm_vmd']:
+            assert self._setting_equal(getattr(self, name),
+                                       getattr(other, name)), \
+                ("%s differs: %s, %s" %(name, getattr(self, name),
+                                        getattr(other, name)))
+        self.hist_sum += other.hist_sum
+        self.number_integral_sum += other.number_integral_sum
+        self.nstep += other.nstep
+        return self
+
+    def result(self):
+        """Time-averaged RPDF of all steps so far.
+
+        Returns
+        -------
+        array (len(rad), 3), see :func:`rpdf`
+        """
+        assert self.nstep > 0, ("no time steps processed")
+        out = np.empty((len(self.rad), 3))
+        out[:,0] = self.rad
+        out[:,1] = self.hist_sum / float(self.nstep)
+        out[:,2] = self.number_integral_sum / float(self.nstep)
+        return out
+
+    def dump(self, dump_filename, mkdir=True):
+        """Write object to binary file using pickle. Read back
+        with :func:`~pwtools.io.read_pickle`."""
+        if mkdir:
+            dr = os.path.dirname(dump_filename)
+            if dr != '':
+                common.makedirs(dr)
+        with open(dump_filename, 'wb') as fd:
+            pickle.dump(self, fd, protocol=2)
+
+
+def rpdf_partial(traj, dr=0.05, rmax='auto', tmask=None, pbc=True,
+                 maxmem=2.0):
+    """Partial radial pair distribution functions for all pairs of atom
+    species in one pass.
+
+    Same as calling :func:`rpdf` with ``amask=[sym0, sym1]`` for all pairs
+    ``(sym0, sym1)`` of ``traj.symbols_unique`` with ``sym0 <= sym1``, but
+    distances are calculated only once per time step.
+
+    Parameters
+    ----------
+    traj : Structure or Trajectory
+    dr, rmax, tmask, pbc, maxmem : see :func:`rpdf`
+
+    Returns
+    -------
+    out, pairs
+    out : array (npairs, len(rad), 3)
+        ``out[k,...]`` is the :func:`rpdf` result for ``pairs[k]``, i.e.
+        ``out[k,:,0]`` = rad, ``out[k,:,1]`` = g(r), ``out[k,:,2]`` = the
+        number integral (coordination number of ``pairs[k][1]`` atoms around
+        ``pairs[k][0]`` atoms).
+    pairs : list of tuples (npairs,)
+        Symbol pairs, e.g. ``[('Al','Al'), ('Al','N'), ('N','N')]``.
+
+    Examples
+    --------
+    >>> out, pairs = crys.rpdf_partial(traj, dr=0.1, tmask=np.s_[3000::50])
+    >>> for (sym0, sym1), dd in zip(pairs, out):
+    ...     plot(dd[:,0], dd[:,1], label='%s-%s' %(sym0, sym1))
+    """
+    traj = struct2traj(traj)
+    if tmask is None:
+        tmask = slice(None)
+    coords_frac = traj.coords_frac[tmask,...]
+    cell = traj.cell[tmask,...]
+    volume = traj.volume[tmask]
+    if coords_frac.ndim == 2:
+        coords_frac = coords_frac[None,...]
+        cell = cell[None,...]
+        volume = np.atleast_1d(volume)
+    nstep = coords_frac.shape[0]
+    assert cell.shape == (nstep,3,3)
+    assert volume.shape == (nstep,)
+    rmax_auto = rmax_smith3d(cell).min()
     if rmax == 'auto':
         rmax = rmax_auto
     bins = np.arange(0, rmax+dr, dr)
     rad = bins[:-1]+0.5*dr
+    nbins = len(rad)
     volume_shells = 4.0/3.0*pi*(bins[1:]**3.0 - bins[:-1]**3.0)
-    norm_fac_pre = volume / volume_shells
-    
-    if nstep * natoms0 * natoms1 * 24.0 / 1e9 > maxmem:
-        raise Exception("would use more than maxmem=%f GB of memory, "
-                            "try `tmask` to reduce time steps" %maxmem)
-
-    # distances
-    # sij: (nstep, natoms0, natoms1, 3)
-    sij = clst[0][:,:,None,:] - clst[1][:,None,:,:]
-    assert sij.shape == (nstep, natoms0, natoms1, 3)
-    if pbc:
-        sij = min_image_convention(sij)
-    # sij: (nstep, atoms0 * natoms1, 3)
-    sij = sij.reshape(nstep, natoms0*natoms1, 3)
-    # rij: (nstep, natoms0 * natoms1, 3)
-    rij = np.dot(sij, cell)
-    # dists_all: (nstep, natoms0 * natoms1)
-    dists_all = np.sqrt((rij**2.0).sum(axis=2))
-    
-    if norm_vmd:
-        msk = dists_all < 1e-15
-        dups = [len(np.nonzero(entry)[0]) for entry in msk]
-    else:
-        dups = np.zeros((nstep,))
-
-    # Not needed b/c bins[-1] == rmax, but doesn't hurt. Plus, test_rpdf.py
-    # would fail b/c old reference data calculated w/ that setting (difference
-    # 1%, only the last point differs).
-    dists_all[dists_all >= rmax] = 0.0
     
-    if dmask is not None:
-        placeholder = '{d}'
-        if placeholder in dmask:
-            _dmask = dmask.replace(placeholder, 'dists_all')
-        else:
-            _dmask = 'dists_all ' + dmask
-        dists_all[np.invert(eval(_dmask))] = 0.0
-
-    hist_sum = np.zeros(len(bins)-1, dtype=float)
-    number_integral_sum = np.zeros(len(bins)-1, dtype=float)
-    # Calculate hists for each time step and average them. This Python loop is
-    # the bottleneck if we have many timesteps.
-    for idx in range(int(nstep)):
-        # rad_hist == bins
-        hist, rad_hist = np.histogram(dists_all[idx,...], bins=bins)
-        if bins[0] == 0.0:
-            hist[0] = 0.0
-        norm_fac = norm_fac_pre / (natoms0 * natoms1 - dups[idx])
-        hist_sum += hist * norm_fac
-        number_integral_sum += 1.0 * np.cumsum(hist) / natoms0
-    out = np.empty((len(rad), 3))
-    out[:,0] = rad
-    out[:,1] = hist_sum / float(nstep)
-    out[:,2] = number_integral_sum / float(nstep)
-    return out
+    # All (i,j) atom index pairs of each species pair, concatenated. `pidx`
+    # maps each atom pair to its species pair.
+    sy = np.array(traj.symbols)
+    pairs = []
+    idx0 = []
+    idx1 = []
+    pidx = []
+    natoms0 = []
+    natoms1 = []
+    for sym0, sym1 in itertools.combinations_with_replacement(traj.symbols_unique, 2):
+        ii0 = np.nonzero(sy == sym0)[0]
+        ii1 = np.nonzero(sy == sym1)[0]
+        idx0.append(np.repeat(ii0, len(ii1)))
+        idx1.append(np.tile(ii1, len(ii0)))
+        pidx.append(np.ones((len(ii0)*len(ii1),), dtype=int)*len(pairs))
+        natoms0.append(len(ii0))
+        natoms1.append(len(ii1))
+        pairs.append((sym0, sym1))
+    idx0 = np.concatenate(idx0)
+    idx1 = np.concatenate(idx1)
+    pidx = np.concatenate(pidx)
+    natoms0 = np.array(natoms0, dtype=float)
+    natoms1 = np.array(natoms1, dtype=float)
+    npairs = len(pairs)
+
+    hist_sum = np.zeros((npairs, nbins), dtype=float)
+    number_integral_sum = np.zeros((npairs, nbins), dtype=float)
+    for tsl, dists in _dists_blocks(coords_frac, coords_frac, cell, idx0, idx1,
+                                    pbc=pbc, maxmem=maxmem):
+        nb = tsl.stop - tsl.start
+        # Histogram of all species pairs and time steps of this block with one
+        # bincount() call. Bin index of each distance, flat index into
+        # hist[istep, ipair, ibin].
+        ibin = (dists / dr).astype(int)
+        msk = (dists < rmax) & (ibin < nbins)
+        flat = (np.arange(nb)[:,None]*npairs + pidx[None,:])*nbins + ibin
+        hist = np.bincount(flat[msk], 
+                           minlength=nb*npairs*nbins).reshape(nb, npairs, nbins)
+        # zero distances (i==j) and d >= rmax, as in rpdf()
+        hist[...,0] = 0
+        hist_sum += (hist * volume[tsl,None,None]).sum(axis=0) \
+            / volume_shells[None,:] / (natoms0 * natoms1)[:,None]
+        number_integral_sum += np.cumsum(hist, axis=-1).sum(axis=0) \
+            / natoms0[:,None]
+    out = np.empty((npairs, nbins, 3))
+    out[...,0] = rad[None,:]
+    out[...,1] = hist_sum / float(nstep)
+    out[...,2] = number_integral_sum / float(nstep)
+    return out, pairs
 
 
 def call_vmd_measure_gofr(trajfn, dr=None, rmax=None, sel=['all','all'],
@@ -1920,6 +2302,251 @@ def angles(struct, pbc=False, mask_val=999.0, deg=True):
     return anglesijk
 
 
+def bond_angle_distribution(obj, cutoff, nbins=180, tmask=None, pbc=True,
+                            norm=False):
+    """Bond angle distribution (BAD) of all neighbor triplets within a cutoff
+    around each atom, for each triplet of atom species, averaged over time
+    steps.
+
+    In contrast to :func:`angles`, only angles ``jj-ii-kk`` where `jj` and `kk`
+    are neighbors of the central atom `ii` within `cutoff` are calculated and
+    directly accumulated into a histogram (Fortran extension
+    ``_flib.angles_hist``), so memory doesn't scale with ``natoms**3``.
+
+    Parameters
+    ----------
+    obj : Structure or Trajectory
+    cutoff : float
+        Neighbor cutoff radius, same unit as `cell`, e.g. Angstrom.
+    nbins : int
+        Number of histogram bins in [0,180] degrees.
+    tmask : None or slice object, optional
+        Time mask, see :func:`rpdf`.
+    pbc : bool
+        Apply minimum image convention to distances.
+    norm : bool
+        Normalize each distribution to unit area (in degrees), else return
+        the average number of angles per time step in each bin.
+
+    Returns
+    -------
+    ang, bad, triplets
+    ang : 1d array (nbins,)
+        Angles in degrees, middle of each histogram bin.
+    bad : 2d array (ntriplets, nbins)
+    triplets : list of tuples (ntriplets,)
+        Symbols ``(center, neighbor0, neighbor1)`` with ``neighbor0 <=
+        neighbor1``, e.g. ``('Si', 'O', 'O')`` for O-Si-O angles.
+
+    Examples
+    --------
+    >>> ang, bad, triplets = crys.bond_angle_distribution(traj, cutoff=2.0)
+    >>> idx = triplets.index(('Si', 'O', 'O'))
+    >>> plot(ang, bad[idx,:])
+    """
+    traj = struct2traj(obj)
+    if tmask is None:
+        tmask = slice(None)
+    coords_frac = traj.coords_frac[tmask,...]
+    cell = traj.cell[tmask,...]
+    if coords_frac.ndim == 2:
+        coords_frac = coords_frac[None,...]
+        cell = cell[None,...]
+    nstep = coords_frac.shape[0]
+    nn = traj.natoms
+    ntypat = traj.ntypat
+    typat = np.array(traj.typat)
+    # allocate once and re-use for all steps
+    distsq = fempty((nn,nn))
+    distvecs = fempty((nn,nn,3))
+    distvecs_frac = fempty((nn,nn,3))
+    hist = np.zeros((nbins, ntypat, ntypat, ntypat), order='F')
+    for istep in range(nstep):
+        _flib.distsq_frac(coords_frac=coords_frac[istep,...],
+                          cell=cell[istep,...],
+                          pbc=int(pbc),
+                          distsq=distsq,
+                          distvecs=distvecs,
+                          distvecs_frac=distvecs_frac)
+        _flib.angles_hist(distvecs=distvecs,
+                          dists=np.sqrt(distsq),
+                          typat=typat,
+                          cutoff=cutoff,
+                          hist=hist)
+    dang = 180.0 / nbins
+    ang = np.arange(nbins) * dang + 0.5*dang
+    triplets = []
+    bad = []
+    symbols_unique = traj.symbols_unique
+    for ii in range(ntypat):
+        for jj, kk in itertools.combinations_with_replacement(range(ntypat), 2):
+            triplets.append((symbols_unique[ii], symbols_unique[jj],
+                             symbols_unique[kk]))
+            bad.append(hist[:,ii,jj,kk] / float(nstep))
+    bad = np.array(bad)
+    if norm:
+        area = bad.sum(axis=1) * dang
+        msk = area > 0
+        bad[msk,:] /= area[msk,None]
+    return ang, bad, triplets
+
+
+class PeriodicKDTree(object):
+    """Spatial index for repeated nearest neighbor queries on one Structure.
+
+    Wraps ``scipy.spatial.cKDTree``, built once from the atoms in the cell
+    plus all periodic images needed for distances up to `rmax`. Queries
+    return minimum image distances, where each atom appears only once (with
+    its closest image). Use this instead of :func:`nearest_neighbors` when
+    many atoms of the same structure are queried, e.g. ``nearest_neighbors(...,
+    tree=tree)`` or :meth:`query_radius` and :meth:`query` with many atoms at
+    once.
+
+    Examples
+    --------
+    >>> tree = crys.PeriodicKDTree(struct)
+    >>> # all neighbors within 3.0 of atoms 0 and 5
+    >>> nn_idx, nn_dist = tree.query_radius([0, 5], cutoff=3.0)
+    >>> # 4 nearest neighbors of all atoms, arrays (natoms, 4)
+    >>> nn_idx, nn_dist = tree.query(range(struct.natoms), k=4)
+    >>> ni = crys.nearest_neighbors(struct, idx=23, num=6, skip='H', tree=tree)
+    """
+    def __init__(self, struct, rmax=None, pbc=True, leafsize=16):
+        """
+        Parameters
+        ----------
+        struct : Structure
+        rmax : float, optional
+            Max. distance up to which queries are correct. Determines the
+            number of periodic images in the tree. Default is
+            ``rmax_smith(struct.cell)``, i.e. one image in each direction
+            (3x3x3 cells).
+        pbc : bool
+            Use periodic images. If False, the tree contains only the atoms in
+            the cell and `rmax` is ignored.
+        leafsize : int
+            See ``scipy.spatial.cKDTree``.
+        """
+        self.natoms = struct.natoms
+        self.pbc = pbc
+        cell = struct.cell
+        if pbc:
+            coords_frac = np.mod(struct.coords_frac, 1.0)
+            self.rmax = rmax_smith(cell) if rmax is None else rmax
+            # cell widths (distances between opposite faces)
+            vol = abs(volume_cell(cell))
+            width = np.array([vol / norm(np.cross(cell[(ii+1)%3,:],
+                                                  cell[(ii+2)%3,:]))
+                              for ii in range(3)])
+            nimg = np.ceil(self.rmax / width).astype(int)
+            shifts = np.array(list(itertools.product(
+                *(range(-n, n+1) for n in nimg))), dtype=float)
+            # (nshifts*natoms, 3), images of all atoms, atom index runs
+            # fastest
+            images = (coords_frac[None,:,:] + shifts[:,None,:]).reshape(-1,3)
+            self.coords = np.dot(coords_frac, cell)
+            self._atom_idx = np.tile(np.arange(self.natoms), shifts.shape[0])
+            self.tree = cKDTree(np.dot(images, cell), leafsize=leafsize)
+        else:
+            self.rmax = np.inf
+            self.coords = struct.coords.copy()
+            self._atom_idx = np.arange(self.natoms)
+            self.tree = cKDTree(self.coords, leafsize=leafsize)
+
+    def _check_dist(self, dist):
+        if dist > self.rmax:
+            raise ValueError("distance %g > rmax=%g, use a larger rmax" %(dist,
+                              self.rmax))
+
+    def _unique(self, ii, nb_img, nb_dist):
+        # Map image indices to atom indices, keep the closest image of each
+        # atom (`nb_dist` is sorted), drop the central atom `ii`.
+        nb_idx = self._atom_idx[nb_img]
+        nb_idx, first = np.unique(nb_idx, return_index=True)
+        nb_dist = nb_dist[first]
+        msk = nb_idx != ii
+        nb_idx = nb_idx[msk]
+        nb_dist = nb_dist[msk]
+        order = np.argsort(nb_dist, kind='mergesort')
+        return nb_idx[order], nb_dist[order]
+
+    def query_radius(self, idx, cutoff):
+        """All neighbors of atom(s) `idx` with distance ``0 < d < cutoff``.
+
+        Parameters
+        ----------
+        idx : int or sequence of ints
+            Atom index or indices.
+        cutoff : float
+
+        Returns
+        -------
+        nn_idx, nn_dist
+            1d arrays if `idx` is an int, else lists of 1d arrays (one per
+            atom in `idx`), sorted by distance.
+        """
+        self._check_dist(cutoff)
+        scalar = np.isscalar(idx)
+        idx = np.atleast_1d(idx)
+        lst = self.tree.query_ball_point(self.coords[idx,:], r=cutoff)
+        nn_idx = []
+        nn_dist = []
+        for ii, img in zip(idx, lst):
+            img = np.array(img, dtype=int)
+            dist = np.sqrt(((self.tree.data[img,:] -
+                             self.coords[ii,:])**2.0).sum(axis=1))
+            order = np.argsort(dist, kind='mergesort')
+            _idx, _dist = self._unique(ii, img[order], dist[order])
+            msk = (_dist > 0) & (_dist < cutoff)
+            nn_idx.append(_idx[msk])
+            nn_dist.append(_dist[msk])
+        if scalar:
+            return nn_idx[0], nn_dist[0]
+        else:
+            return nn_idx, nn_dist
+
+    def query(self, idx, k):
+        """`k` nearest neighbors of atom(s) `idx`, the central atom excluded.
+
+        Parameters
+        ----------
+        idx : int or sequence of ints
+            Atom index or indices.
+        k : int
+            Number of neighbors, at most ``natoms-1``.
+
+        Returns
+        -------
+        nn_idx, nn_dist
+            Arrays (k,) if `idx` is an int, else (len(idx), k), sorted by
+            distance.
+        """
+        scalar = np.isscalar(idx)
+        idx = np.atleast_1d(idx)
+        k = min(k, self.natoms - 1)
+        ntree = self.tree.n
+        # Query more points than needed since images of the same atom and
+        # the central atom are removed.
+        kq = min(k + 1, ntree)
+        while True:
+            dist, img = self.tree.query(self.coords[idx,:], k=kq)
+            dist = dist.reshape(len(idx), kq)
+            img = img.reshape(len(idx), kq)
+            res = [self._unique(ii, img[jj,:], dist[jj,:])
+                   for jj,ii in enumerate(idx)]
+            if min(len(x[0]) for x in res) >= k or kq == ntree:
+                break
+            kq = min(2*kq, ntree)
+        nn_idx = np.array([x[0][:k] for x in res], dtype=int)
+        nn_dist = np.array([x[1][:k] for x in res])
+        if k > 0:
+            self._check_dist(nn_dist[:,-1].max())
+        if scalar:
+            return nn_idx[0], nn_dist[0]
+        else:
+            return nn_idx, nn_dist
+
+
 def nearest_neighbors_from_dists(dists, symbols, idx=None, skip=None,
                                  cutoff=None, num=None, pbc=True, 
                                  sort=True, fullout=False):
@@ -1959,8 +2586,9 @@ def nearest_neighbors_from_dists(dists, symbols, idx=None, skip=None,
     else:            
         only_msk = np.ones((len(symbols_sort),), dtype=bool)
     if cutoff is None:
-        # ``1:`` : central atom excluded
-        cut_msk = np.s_[1:num+1]
+        # central atom excluded, also if its symbol is in `skip`
+        only_msk = only_msk & (idx_lst_sort != idx)
+        cut_msk = np.s_[:num]
         ret_idx = idx_lst_sort[only_msk][cut_msk]
     else:
         cut_msk = (dist1d_sort > 0) & (dist1d_sort < cutoff)
@@ -1975,7 +2603,7 @@ def nearest_neighbors_from_dists(dists, symbols, idx=None, skip=None,
 
 
 def nearest_neighbors(struct, idx=None, skip=None, cutoff=None, num=None, pbc=True,
-                      sort=True, fullout=False):
+                      sort=True, fullout=False, tree=None):
     """Indices of the nearest neighbor atoms to atom `idx`, skipping atoms
     whose symbols are `skip`.
 
@@ -1997,6 +2625,10 @@ def nearest_neighbors(struct, idx=None, skip=None, cutoff=None, num=None, pbc=Tr
         Sort `nn_idx` and `nn_dist` by distance.     
     fullout : bool
         See below.
+    tree : PeriodicKDTree, optional
+        Pre-built spatial index of `struct`. Use it instead of calculating
+        the full distance matrix, much faster when called many times for the
+        same `struct`. `pbc` is then set by the tree.
 
     Returns
     -------
@@ -2051,6 +2683,34 @@ def nearest_neighbors(struct, idx=None, skip=None, cutoff=None, num=None, pbc=Tr
     >>> skip=filter(lambda x: x!='O', set(symbols))
     >>> ['H', 'Ca', 'Cl']
     """
+    if tree is not None:
+        assert idx != None, "idx is None"
+        assert None in [num,cutoff], "use either num or cutoff"
+        symbols = np.array(struct.symbols)
+        skip = common.asseq(skip)
+        if skip != [None]:
+            skip_msk = np.in1d(symbols, skip)
+        else:
+            skip_msk = np.zeros((len(symbols),), dtype=bool)
+        if cutoff is None:
+            # query enough neighbors to have `num` left after skipping
+            ret_idx, ret_dist = tree.query(idx, k=num + skip_msk.sum())
+            msk = np.invert(skip_msk[ret_idx])
+            ret_idx = ret_idx[msk][:num]
+            ret_dist = ret_dist[msk][:num]
+        else:
+            ret_idx, ret_dist = tree.query_radius(idx, cutoff=cutoff)
+            msk = np.invert(skip_msk[ret_idx])
+            ret_idx = ret_idx[msk]
+            ret_dist = ret_dist[msk]
+        if not sort:
+            order = np.argsort(ret_idx)
+            ret_idx = ret_idx[order]
+            ret_dist = ret_dist[order]
+        if fullout:
+            return ret_idx, ret_dist
+        else:
+            return ret_idx
     # Distance matrix (natoms, natoms). Each row or col is sorted like
     # struct.symbols. If used in loops over trajs, the distances() call is the
     # most costly part, even though coded in Fortran.
@@ -2083,6 +2743,82 @@ def nearest_neighbors_struct(struct, **kwds):
     return new_struct                           
 
 
+def coordination_numbers(obj, cutoff, pbc=True, neighbors=False, maxnb=32,
+                         tmask=None):
+    """Coordination numbers (and optionally neighbor lists) of all atoms for
+    each time step.
+
+    Wrapper for _flib.neighbors_traj(), which calculates minimum image
+    distances and counts neighbors of all atoms in one pass per time step,
+    parallelized over time steps with OpenMP if the extension was compiled
+    with OpenMP support. This is much faster than looping over
+    :func:`nearest_neighbors` for all atoms and steps.
+
+    Parameters
+    ----------
+    obj : Structure or Trajectory
+    cutoff : float
+        Neighbors of atom ``ii`` are all atoms ``jj`` with ``0 < dist(ii,jj) <
+        cutoff``, same as ``nearest_neighbors(..., cutoff=cutoff)``.
+    pbc : bool
+        Use minimum image distances.
+    neighbors : bool
+        Also return neighbor lists.
+    maxnb : int
+        Initial guess for the max. number of neighbors stored per atom if
+        ``neighbors=True``. If exceeded, we re-run with ``maxnb =
+        cn.max()``.
+    tmask : None or slice object, optional
+        Time mask, see :func:`rpdf`.
+
+    Returns
+    -------
+    cn : if neighbors=False
+    cn, nblst : if neighbors=True
+    cn : int array (nstep, natoms)
+    nblst : int array (nstep, natoms, cn.max())
+        Neighbor indices of each atom, ``nblst[istep,ii,:cn[istep,ii]]`` are
+        the neighbors of atom ``ii`` at step ``istep``. The rest is filled
+        with -1. Neighbors are ordered by atom index, not by distance.
+
+    Examples
+    --------
+    >>> cn = crys.coordination_numbers(traj, cutoff=2.2)
+    >>> # time series of the mean coordination of all Si atoms
+    >>> plot(cn[:, np.array(traj.symbols)=='Si'].mean(axis=1))
+    >>> cn, nblst = crys.coordination_numbers(traj, cutoff=2.2, neighbors=True)
+    >>> # neighbor symbols of atom 3 at step 100
+    >>> np.array(traj.symbols)[nblst[100,3,:cn[100,3]]]
+    """
+    traj = struct2traj(obj)
+    if tmask is None:
+        tmask = slice(None)
+    coords_frac = traj.coords_frac[tmask,...]
+    cell = traj.cell[tmask,...]
+    if coords_frac.ndim == 2:
+        coords_frac = coords_frac[None,...]
+        cell = cell[None,...]
+    coords_frac = np.asarray(coords_frac, order='F')
+    cell = np.asarray(cell, order='F')
+    _maxnb = maxnb if neighbors else 0
+    cn, nblst = _flib.neighbors_traj(coords_frac=coords_frac,
+                                     cell=cell,
+                                     pbc=int(pbc),
+                                     cutoff=cutoff,
+                                     maxnb=_maxnb)
+    if neighbors:
+        cnmax = cn.max()
+        if cnmax > maxnb:
+            cn, nblst = _flib.neighbors_traj(coords_frac=coords_frac,
+                                             cell=cell,
+                                             pbc=int(pbc),
+                                             cutoff=cutoff,
+                                             maxnb=cnmax)
+        return cn, nblst[...,:cnmax]
+    else:
+        return cn
+
+
 def center_on_atom(obj_in, idx=None, copy=True):
     """Shift all coords in `obj` such that the atom with index `idx` is at the
     center of the cell: [0.5,0.5,0.5] fractional coords.
@@ -1,5 +1,8 @@
 """
-EOS fitting. Use :class:`EosFit` (only Vinet EOS for now).
+EOS fitting. Use :class:`EosFit` or :class:`EosFitBatch` for many E(V)
+curves at once. EOS models with analytic 1st and 2nd derivatives (pressure,
+bulk modulus): :class:`Vinet` (default), :class:`BirchMurnaghan`,
+:class:`Murnaghan`, :class:`PoirierTarantola`, :class:`Polynomial3`.
 
 Also: Old interface class :class:`ElkEOSFit` and the base class
 :class:`ExternEOS` for calling extern EOS fitting applications. Compile the app
@@ -46,6 +49,24 @@ def _vinet_deriv2(V, params):
             (2*eta**5 * V0) * ex
 
 
+def _vinet_jac(V, params):
+    """Vinet derivatives dE/d(e0,b0,b1,v0), shape ``V.shape + (4,)``."""
+    # With a = B1-1, z = a*(eta-1): E = E0 + 2*B0*V0/a**2 * g(z),
+    # g(z) = 2 - (2+3z)*exp(-3z/2), g'(z) = 9/2*z*exp(-3z/2)
+    E0, B0, B1, V0 = params['e0'], params['b0'], params['b1'], params['v0']
+    eta = (V/V0)**(1./3.)
+    aa = B1 - 1.0
+    zz = aa * (eta - 1.0)
+    ex = np.exp(-1.5*zz)
+    gg = 2.0 - (2.0 + 3.0*zz) * ex
+    dg = 4.5 * zz * ex
+    de0 = 1.0
+    db0 = 2.0 * V0 * gg / aa**2.0
+    db1 = 2.0 * B0 * V0 * (dg * (eta - 1.0) / aa**2.0 - 2.0 * gg / aa**3.0)
+    dv0 = 2.0 * B0 * gg / aa**2.0 - 2.0 * B0 * dg * eta / (3.0 * aa)
+    return np.stack(np.broadcast_arrays(de0, db0, db1, dv0), axis=-1)
+
+
 class MaxDerivException(Exception):
     def __init__(self, msg=None):
         self.msg = msg
@@ -85,6 +106,35 @@ class EVFunction(object):
         """    
         pass
     
+    def jac(self, volume, params):
+        """Derivatives of E(V) w.r.t. the parameters in ``self.param_order``
+        (the Jacobian for least squares fits). This default implementation
+        uses central finite differences. Derived classes may override it
+        with analytic derivatives.
+
+        Parameters
+        ----------
+        volume : array
+            volume per atom [Ang^3]
+        params : dict
+            {'e0', 'b0', 'b1', 'v0'}, values can be arrays which broadcast
+            against `volume`
+
+        Returns
+        -------
+        array ``volume.shape + (nparams,)``
+        """
+        ret = []
+        for key in self.param_order:
+            hh = 1e-6 * np.maximum(np.abs(params[key]), 1e-3)
+            pp = dict(params)
+            pp[key] = params[key] + hh
+            ep = self.evaluate(volume, pp)
+            pp[key] = params[key] - hh
+            em = self.evaluate(volume, pp)
+            ret.append((ep - em) / (2.0 * hh))
+        return np.stack(np.broadcast_arrays(*ret), axis=-1)
+
     def get_min(self):
         pass
 
@@ -113,8 +163,123 @@ class Vinet(EVFunction):
             return _vinet_deriv2(volume, params)
         else:
             raise MaxDerivException("der %i not supported" %der)
+
+    def jac(self, volume, params):
+        return _vinet_jac(volume, params)
     
 
+class Murnaghan(EVFunction):
+    """Murnaghan EOS model [1]::
+
+        E(V) = E0 + B0*V/B1 * [(V0/V)**B1/(B1-1) + 1] - B0*V0/(B1-1)
+        P(V) = B0/B1 * [(V0/V)**B1 - 1]
+
+    [1] F. D. Murnaghan, Am. J. Math. 49, 235 (1937)
+    """
+    def evaluate(self, volume, params):
+        E0, B0, B1, V0 = params['e0'], params['b0'], params['b1'], params['v0']
+        return E0 + B0 * volume / B1 * ((V0/volume)**B1 / (B1 - 1.0) + 1.0) \
+            - B0 * V0 / (B1 - 1.0)
+
+    def deriv(self, volume, params, der=None):
+        B0, B1, V0 = params['b0'], params['b1'], params['v0']
+        if der == 1:
+            return -B0 / B1 * ((V0/volume)**B1 - 1.0)
+        elif der == 2:
+            return B0 * (V0/volume)**B1 / volume
+        else:
+            raise MaxDerivException("der %i not supported" %der)
+
+
+class BirchMurnaghan(EVFunction):
+    """Birch-Murnaghan 3rd order EOS model [1], with ``x = (V0/V)**(1/3)``::
+
+        E(V) = E0 + 9/16*V0*B0 * [(x**2-1)**3*B1 + (x**2-1)**2*(6-4*x**2)]
+        P(V) = 3/2*B0 * (x**7 - x**5) * [1 + 3/4*(B1-4)*(x**2-1)]
+
+    [1] F. Birch, Phys. Rev. 71, 809 (1947)
+    """
+    def evaluate(self, volume, params):
+        E0, B0, B1, V0 = params['e0'], params['b0'], params['b1'], params['v0']
+        x2 = (V0/volume)**(2./3.)
+        return E0 + 9.0/16.0 * V0 * B0 * ((x2 - 1.0)**3.0 * B1 +
+                                          (x2 - 1.0)**2.0 * (6.0 - 4.0*x2))
+
+    def deriv(self, volume, params, der=None):
+        B0, B1, V0 = params['b0'], params['b1'], params['v0']
+        xx = (V0/volume)**(1./3.)
+        cc = 0.75 * (B1 - 4.0)
+        if der == 1:
+            return -1.5 * B0 * (xx**7.0 - xx**5.0) * \
+                (1.0 + cc * (xx**2.0 - 1.0))
+        elif der == 2:
+            # -dP/dV = dP/dx * x/(3V)
+            dpdx = 1.5 * B0 * ((7.0*xx**6.0 - 5.0*xx**4.0) *
+                               (1.0 + cc * (xx**2.0 - 1.0)) +
+                               (xx**7.0 - xx**5.0) * 2.0 * cc * xx)
+            return dpdx * xx / (3.0 * volume)
+        else:
+            raise MaxDerivException("der %i not supported" %der)
+
+
+class PoirierTarantola(EVFunction):
+    """Natural strain (Poirier-Tarantola) 3rd order EOS model [1], with ``L
+    = ln(V0/V)``::
+
+        E(V) = E0 + B0*V0 * [L**2/2 + (B1-2)*L**3/6]
+        P(V) = B0*V0/V * [L + (B1-2)*L**2/2]
+
+    [1] J.-P. Poirier, A. Tarantola, Phys. Earth Planet. Int. 109, 1 (1998)
+    """
+    def evaluate(self, volume, params):
+        E0, B0, B1, V0 = params['e0'], params['b0'], params['b1'], params['v0']
+        ll = np.log(V0/volume)
+        return E0 + B0 * V0 * (ll**2.0 / 2.0 + (B1 - 2.0) * ll**3.0 / 6.0)
+
+    def deriv(self, volume, params, der=None):
+        B0, B1, V0 = params['b0'], params['b1'], params['v0']
+        ll = np.log(V0/volume)
+        if der == 1:
+            return -B0 * V0 / volume * (ll + (B1 - 2.0) * ll**2.0 / 2.0)
+        elif der == 2:
+            return B0 * V0 / volume**2.0 * (1.0 + (B1 - 1.0) * ll +
+                                            (B1 - 2.0) * ll**2.0 / 2.0)
+        else:
+            raise MaxDerivException("der %i not supported" %der)
+
+
+class Polynomial3(EVFunction):
+    """Cubic polynomial in (V-V0), parametrized by E0, B0, B1, V0 such that
+    ``E'(V0) = 0``, ``V0*E''(V0) = B0`` and ``dB/dP(V0) = B1``::
+
+        E(V) = E0 + B0/(2*V0)*(V-V0)**2 - (1+B1)*B0/(6*V0**2)*(V-V0)**3
+    """
+    def evaluate(self, volume, params):
+        E0, B0, B1, V0 = params['e0'], params['b0'], params['b1'], params['v0']
+        dv = volume - V0
+        return E0 + B0 / (2.0*V0) * dv**2.0 - \
+            (1.0 + B1) * B0 / (6.0*V0**2.0) * dv**3.0
+
+    def deriv(self, volume, params, der=None):
+        B0, B1, V0 = params['b0'], params['b1'], params['v0']
+        dv = volume - V0
+        if der == 1:
+            return B0 / V0 * dv - (1.0 + B1) * B0 / (2.0*V0**2.0) * dv**2.0
+        elif der == 2:
+            return B0 / V0 - (1.0 + B1) * B0 / V0**2.0 * dv
+        else:
+            raise MaxDerivException("der %i not supported" %der)
+
+
+# EVFunction classes for ElkEOSFit's `etype`, use ``EosFit(volume, energy,
+# func=ELK_ETYPE_FUNC[etype]())`` to fit in-process instead of calling eos.x
+ELK_ETYPE_FUNC = {1: Vinet,
+                  2: Murnaghan,
+                  3: BirchMurnaghan,
+                  5: PoirierTarantola,
+                  7: Polynomial3}
+
+
 # Before using this a fitfunc in thermo.Gibbs, test it! You may need to
 # implement data scaling, as we do in num.PolyFit.
 class EosFit(Fit1D):
@@ -233,6 +398,176 @@ class EosFit(Fit1D):
             return volume * self(volume, der=2) * eV_by_Ang3_to_GPa
 
 
+class EosFitBatch(object):
+    """Fit many E(V) curves at once.
+
+    All curves are fitted together by vectorized Levenberg-Marquardt
+    (damped Gauss-Newton) iterations: in each iteration, the Jacobians of all
+    curves (``func.jac()``) are calculated in one go and the small normal
+    equations (nparams x nparams) of all curves are solved in one batched
+    call. The initial guess for each curve is a parabola fit, as in
+    :class:`EosFit`. Results agree with :class:`EosFit` (which uses
+    ``scipy.optimize.leastsq`` for each curve) within the fit tolerance.
+
+    Attributes
+    ----------
+    params : dict
+        {'e0', 'b0', 'b1', 'v0'} with 1d arrays (ncurves,), units as in
+        :class:`EosFit`
+    converged : 1d bool array (ncurves,)
+        Convergence flag for each curve. Parameters of non-converged curves
+        are those of the last iteration.
+    niter : 1d int array (ncurves,)
+        Number of iterations for each curve.
+
+    Examples
+    --------
+    >>> from pwtools.eos import EosFitBatch
+    >>> # volume: (npoints,) or (ncurves, npoints), energy: (ncurves, npoints)
+    >>> f = EosFitBatch(volume, energy)
+    >>> f.params['v0'][f.converged]
+    >>> f.params['b0'] * eV_by_Ang3_to_GPa
+    >>> # E(V) of all curves at their own volumes
+    >>> f(volume)
+    """
+    def __init__(self, volume, energy, func=Vinet(), maxiter=100, xtol=1e-10,
+                 ftol=1e-14):
+        """
+        Parameters
+        ----------
+        volume : 1d array (npoints,) or 2d array (ncurves, npoints)
+            volume per atom [Ang^3], same for all curves if 1d
+        energy : 2d array (ncurves, npoints)
+            total energy per atom [eV]
+        func : EVFunction instance
+        maxiter : int
+            max. number of iterations
+        xtol : float
+            Converged if the relative change of all parameters is < `xtol` ...
+        ftol : float
+            ... or if the relative change of the sum of squared residuals is
+            < `ftol` after a successful step.
+        """
+        self.energy = np.atleast_2d(np.asarray(energy, dtype=float))
+        self.volume = np.broadcast_to(np.asarray(volume, dtype=float),
+                                      self.energy.shape)
+        assert self.energy.shape[1] >= len(func.param_order), \
+            "need at least as many points as parameters"
+        self.func = func
+        self.maxiter = maxiter
+        self.xtol = xtol
+        self.ftol = ftol
+        self.fit()
+
+    def _guess(self):
+        # parabola fit E = a*V**2 + b*V + c for all curves, see EosFit.fit()
+        vand = self.volume[...,None]**np.array([2.0, 1.0, 0.0])
+        coeffs = np.linalg.solve(np.matmul(vand.transpose(0,2,1), vand),
+                                 np.matmul(vand.transpose(0,2,1),
+                                           self.energy[...,None]))[...,0]
+        a, b, c = coeffs.T
+        v0 = -b/(2*a)
+        e0 = a*v0**2 + b*v0 + c
+        b0 = 2*a*v0
+        b1 = 4.0 * np.ones_like(v0)
+        return dict(e0=e0, b0=b0, b1=b1, v0=v0)
+
+    def _params_dct(self, pp):
+        # (ncurves, nparams) -> dict with (ncurves,1) arrays
+        return dict((key, pp[:,ii,None]) for ii,key in
+                    enumerate(self.func.param_order))
+
+    def _resid(self, pp, idx=slice(None)):
+        # residuals of curves `idx` for their params `pp`
+        with np.errstate(all='ignore'):
+            return self.energy[idx] - self.func(self.volume[idx],
+                                                self._params_dct(pp))
+
+    def fit(self):
+        """Fit all curves, fill ``self.params``, ``self.converged``,
+        ``self.niter``."""
+        ncurves = self.energy.shape[0]
+        pp = np.array(self.func.dct2lst(self._guess())).T
+        npar = pp.shape[1]
+        res = self._resid(pp)
+        ssr = (res**2.0).sum(axis=1)
+        lam = 1e-3 * np.ones((ncurves,))
+        converged = np.zeros((ncurves,), dtype=bool)
+        # no progress possible (singular normal equations, NaNs, huge
+        # damping)
+        failed = ~np.isfinite(ssr)
+        niter = np.zeros((ncurves,), dtype=int)
+        eye = np.identity(npar)
+        for it in range(self.maxiter):
+            act = ~(converged | failed)
+            if not act.any():
+                break
+            idx = np.nonzero(act)[0]
+            niter[idx] += 1
+            with np.errstate(all='ignore'):
+                jj = self.func.jac(self.volume[idx],
+                                   self._params_dct(pp[idx]))
+            jtj = np.matmul(jj.transpose(0,2,1), jj)
+            jtr = np.matmul(jj.transpose(0,2,1), res[idx,:,None])
+            # Marquardt scaling with diag(J^T J)
+            diag = jtj[:,range(npar),range(npar)]
+            amat = jtj + lam[idx,None,None] * diag[:,:,None] * eye[None,...]
+            bad = ~(np.isfinite(amat).all(axis=(1,2)) &
+                    np.isfinite(jtr).all(axis=(1,2)))
+            bad[~bad] = np.linalg.cond(amat[~bad]) > 1.0 / num.EPS
+            step = np.zeros((len(idx), npar))
+            if (~bad).any():
+                step[~bad] = np.linalg.solve(amat[~bad], jtr[~bad])[...,0]
+            pnew = pp[idx] + step
+            rnew = self._resid(pnew, idx)
+            snew = (rnew**2.0).sum(axis=1)
+            ok = ~bad & np.isfinite(snew) & (snew <= ssr[idx])
+            xconv = (np.abs(step) <= self.xtol *
+                     (np.abs(pp[idx]) + self.xtol)).all(axis=1)
+            fconv = np.abs(ssr[idx] - snew) <= self.ftol * ssr[idx]
+            # accept steps, less damping
+            pp[idx[ok]] = pnew[ok]
+            res[idx[ok]] = rnew[ok]
+            ssr[idx[ok]] = snew[ok]
+            lam[idx[ok]] /= 10.0
+            converged[idx[ok & (xconv | fconv)]] = True
+            # reject steps, more damping
+            lam[idx[~ok]] *= 10.0
+            failed[idx[bad]] = True
+            failed[lam > 1e16] = True
+        self.params = self.func.lst2dct(pp.T)
+        self.converged = converged
+        self.niter = niter
+
+    def __call__(self, volume, der=0):
+        """E(V) or derivatives for all curves.
+
+        Parameters
+        ----------
+        volume : 1d array (nv,) or 2d array (ncurves, nv)
+            volume per atom [Ang^3]
+        der : int
+            derivative order
+
+        Returns
+        -------
+        2d array (ncurves, nv)
+        """
+        volume = np.asarray(volume, dtype=float)
+        params = dict((key, val[:,None]) for key,val in self.params.items())
+        return self.func(volume if volume.ndim == 2 else volume[None,:],
+                         params, der=der)
+
+    def pressure(self, volume):
+        """P(V) [GPa], 2d array (ncurves, nv)"""
+        return -self(volume, der=1) * eV_by_Ang3_to_GPa
+
+    def bulkmod(self, volume):
+        """B(V) = V*d^2E/dV^2 [GPa], 2d array (ncurves, nv)"""
+        volume = np.asarray(volume, dtype=float)
+        return volume * self(volume, der=2) * eV_by_Ang3_to_GPa
+
+
 class ExternEOS(FlexibleGetters):
     """Base class for calling extern EOS-fitting executables. The class
     writes an input file, calls the app, loads E(V) fitted data and loads or
@@ -503,6 +838,10 @@ class ElkEOSFit(ExternEOS):
             Planet Int. 109, p1 (1998))
          6. Natural strain 4th-order EOS
          7. Cubic polynomial in (V-V0)
+
+        All but the 4th order ones are also implemented natively. To fit in
+        memory without calling eos.x, use ``EosFit(volume, energy,
+        func=ELK_ETYPE_FUNC[etype]())``.
         """
         ExternEOS.__init__(self, app=app, **kwargs)
         self.name = name
@@ -278,7 +278,55 @@ def write_h5(fn, dct, **kwds):
     fh.close()
 
 
-def read_h5(fn):
+class H5LazyDataset(object):
+    """Read-only access to a dataset in an h5 file which reads only the
+    requested slice. The file is opened for each read and closed right
+    after, so no file handle stays open (the file can be written in between,
+    e.g. by another ``thermo.Gibbs.calc_G(..., h5file=...)``).
+
+    Examples
+    --------
+    >>> d = H5LazyDataset('gibbs.h5', '/T/P/ax0-ax1/G')
+    >>> d.shape
+    (5000, 100, 36)
+    >>> d[100,3,:]
+    >>> np.asarray(d)   # read all
+    """
+    def __init__(self, filename, key):
+        """
+        Parameters
+        ----------
+        filename : str
+        key : str
+            dataset name, e.g. '/a/b/d1'
+        """
+        self.filename = filename
+        self.key = key
+        with h5py.File(self.filename, mode='r') as fh:
+            dset = fh[self.key]
+            self.shape = dset.shape
+            self.dtype = dset.dtype
+            self.chunks = dset.chunks
+        self.ndim = len(self.shape)
+
+    def __getitem__(self, idx):
+        with h5py.File(self.filename, mode='r') as fh:
+            return fh[self.key][idx]
+
+    def __array__(self, dtype=None):
+        arr = self[()]
+        return arr if dtype is None else arr.astype(dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return "<%s %s:%s shape=%s dtype=%s>" %(self.__class__.__name__,
+                                                self.filename, self.key,
+                                                self.shape, self.dtype)
+
+
+def read_h5(fn, lazy=False):
     """Read h5 file into dict.
     
     Dict keys are the group + dataset names, e.g. '/a/b/c/dset'. All keys start
@@ -288,20 +336,33 @@ def read_h5(fn):
     ----------
     fn : str
         filename
+    lazy : bool
+        Don't read the data. Dict values are :class:`H5LazyDataset`
+        objects, which read only the requested slice, e.g.
+        ``dct['/a/b/d1'][3,:]``. No file handle stays open. Use for big
+        arrays such as those from ``thermo.Gibbs.calc_G(...,
+        h5file=...)``.
     
     Examples
     --------
     >>> read_h5('foo.h5').keys()
     ['/a/b/d1', '/a/b/d2', '/a/c/d3', '/x/y/z']
+    >>> d = read_h5('gibbs.h5', lazy=True)
+    >>> d['/T/P/ax0-ax1/G'].shape
+    (5000, 100, 36)
+    >>> d['/T/P/ax0-ax1/G'][100,3,:]
     """
     fh = h5py.File(fn, mode='r') 
     dct = {}
     def get(name, obj, dct=dct):
         if isinstance(obj, h5py.Dataset):
             _name = name if name.startswith('/') else '/'+name
-            dct[_name] = obj.value
+            dct[_name] = _name if lazy else obj[()]
     fh.visititems(get)            
     fh.close()
+    if lazy:
+        for key in dct.keys():
+            dct[key] = H5LazyDataset(fn, key)
     return dct
 
 
@@ -7,6 +7,7 @@ import scipy.optimize as optimize
 from scipy.interpolate import bisplrep, \
     bisplev, splev, splrep
 from scipy.integrate import simps, trapz
+from scipy.linalg import solve_triangular, cho_factor, cho_solve
 from pwtools import _flib
 import warnings
 ##warnings.simplefilter('always')
@@ -24,9 +25,56 @@ except ImportError:
     NearestNDInterpolator = None
     LinearNDInterpolator = None
 
+try:
+    # scipy >= 1.4, multi-threaded FFTs with the `workers` keyword
+    import scipy.fft as _fft_mod
+    _fft_has_workers = True
+except ImportError:
+    import numpy.fft as _fft_mod
+    _fft_has_workers = False
+
 # constants
 EPS = np.finfo(float).eps
 
+
+def block_size(nitems, bytes_per_item, maxmem):
+    """Number of items (e.g. atoms or time steps) per block for processing
+    big arrays in blocks, such that a block of ``bytes_per_item`` per item
+    fits into `maxmem` GB.
+
+    Parameters
+    ----------
+    nitems : int
+    bytes_per_item : float
+        Memory of all temp arrays per item in bytes.
+    maxmem : float
+        GB
+
+    Returns
+    -------
+    int, at least 1 and at most `nitems`
+    """
+    return int(min(nitems, max(1, maxmem * 1e9 / bytes_per_item)))
+
+
+def rfft(x, n=None, axis=-1, nthreads=None):
+    """FFT of real input, ``scipy.fft.rfft`` on `nthreads` threads (None =
+    all cores) with scipy >= 1.4, ``numpy.fft.rfft`` otherwise."""
+    if _fft_has_workers:
+        return _fft_mod.rfft(x, n=n, axis=axis,
+                             workers=-1 if nthreads is None else nthreads)
+    else:
+        return _fft_mod.rfft(x, n=n, axis=axis)
+
+
+def irfft(x, n=None, axis=-1, nthreads=None):
+    """Inverse of :func:`rfft`."""
+    if _fft_has_workers:
+        return _fft_mod.irfft(x, n=n, axis=axis,
+                              workers=-1 if nthreads is None else nthreads)
+    else:
+        return _fft_mod.irfft(x, n=n, axis=axis)
+
 def normalize(a):
     """Normalize array by it's max value. Works also for complex arrays.
 
@@ -1254,7 +1302,9 @@ def polyfit(points, values, deg, scale=True):
     points : nd array (npoints,ndim)
         `npoints` points in `ndim`-space, to be fitted by a `ndim` polynomial
         f(x0,x1,...,x{ndim-1}).
-    values : 1d array        
+    values : 1d array (npoints,) or 2d array (npoints, nfit)
+        With 2d `values`, fit `nfit` data sets with the same `points` at
+        once, using one least squares solve with multiple right-hand sides.
     deg : int
         Degree of the poly (e.g. 3 for cubic).
     scale: bool, optional
@@ -1267,7 +1317,9 @@ def polyfit(points, values, deg, scale=True):
     fit : dict
         {coeffs, deg, pscale, vscale, pmin, vmin} where coeffs = 1d array
         ((deg+1)**ndim,) with poly coefficients and `*min` and `*scale` are for
-        data scaling. Input for polyval().
+        data scaling. Input for polyval(). For 2d `values`, coeffs is
+        ((deg+1)**ndim, nfit) and `vscale`, `vmin` are (nfit,), use
+        :func:`polyfit_split` to get one fit dict per data set.
     
     Notes
     -----
@@ -1287,23 +1339,146 @@ def polyfit(points, values, deg, scale=True):
     :class:`PolyFit`, :class:`PolyFit1D`, :func:`polyval`
     """
     assert points.ndim == 2, "points must be 2d array"
-    assert values.ndim == 1, "values must be 1d array"
+    assert values.ndim in [1,2], "values must be 1d or 2d array"
     if scale:
         pmin = points.min(axis=0)[None,:]
-        vmin = values.min()
+        vmin = values.min(axis=0)
         pscale = np.abs(points).max(axis=0)[None,:] - pmin
-        vscale = np.abs(values).max() - vmin
+        vscale = np.abs(values).max(axis=0) - vmin
     else:
         pscale = np.ones((points.shape[1],), dtype=float)[None,:]
-        vscale = 1.0
+        vscale = 1.0 if values.ndim == 1 else np.ones((values.shape[1],))
         pmin = np.zeros((points.shape[1],), dtype=float)[None,:] 
-        vmin = 0.0
+        vmin = 0.0 if values.ndim == 1 else np.zeros((values.shape[1],))
     vand = vander((points - pmin) / pscale, deg)
     return {'coeffs': np.linalg.lstsq(vand, (values - vmin) / vscale)[0], 
             'deg': deg, 'pscale': pscale, 'vscale': vscale,
             'pmin': pmin, 'vmin': vmin}
 
 
+def polyfit_split(fit):
+    """Split the result of :func:`polyfit` with 2d `values` (npoints, nfit)
+    into a list of `nfit` fit dicts, each the same as for the 1d `values`
+    case.
+
+    Parameters
+    ----------
+    fit : dict
+        Result of ``polyfit(points, values, ...)`` with 2d `values`.
+
+    Returns
+    -------
+    list of dicts (nfit,)
+    """
+    nfit = fit['coeffs'].shape[1]
+    return [dict(fit, coeffs=fit['coeffs'][:,ii], vscale=fit['vscale'][ii],
+                 vmin=fit['vmin'][ii]) for ii in range(nfit)]
+
+
+class PolyFitBasis(object):
+    """Polynomial least squares fits of many data sets on the same `points`,
+    with the design (Vandermonde) matrix factorized once.
+
+    :func:`polyfit` builds the Vandermonde matrix and solves the least
+    squares problem for each call. If only the `values` change (e.g. G(ax0,
+    ax1) for each (T,P) in :class:`~pwtools.thermo.Gibbs`), use this class
+    instead: the factorization is done in the constructor and
+    :meth:`fit` solves for any number of right-hand sides at once.
+
+    Parameters
+    ----------
+    points : nd array (npoints, ndim) or 1d array (npoints,) for ndim=1
+    deg : int
+        Degree of the poly.
+    scale : bool
+        Scale `points` and `values` to unity, as in :func:`polyfit`.
+    method : str
+        | 'qr' : QR factorization ``V = Q R``, ``coeffs = R^-1 Q^T b``
+        | 'chol' : Cholesky factorization of the normal equations ``V^T V =
+        |     L L^T``. Faster, but squares the condition number.
+        | 'svd' : pseudo-inverse by SVD, same as np.linalg.lstsq() in
+        |     :func:`polyfit`, use for rank deficient problems
+        If there are fewer points than coefficients (``npoints <
+        (deg+1)**ndim``) or the design matrix is rank deficient, 'qr' and
+        'chol' fall back to 'svd' (minimum norm solution), see
+        ``self.method``.
+
+    Examples
+    --------
+    >>> basis = num.PolyFitBasis(points, deg=5)
+    >>> # values: (npoints, nfit)
+    >>> fits = num.polyfit_split(basis.fit(values))
+    >>> f0 = num.PolyFit(points, values[:,0], fit=fits[0])
+    >>> f0(new_points)
+    """
+    def __init__(self, points, deg, scale=True, method='qr'):
+        points = np.asarray(points, dtype=float)
+        self.points = points[:,None] if points.ndim == 1 else points
+        assert self.points.ndim == 2, "points must be 2d array"
+        self.deg = deg
+        self.scale = scale
+        self.method = method
+        ndim = self.points.shape[1]
+        if scale:
+            self.pmin = self.points.min(axis=0)[None,:]
+            self.pscale = np.abs(self.points).max(axis=0)[None,:] - self.pmin
+        else:
+            self.pscale = np.ones((ndim,), dtype=float)[None,:]
+            self.pmin = np.zeros((ndim,), dtype=float)[None,:]
+        vand = vander((self.points - self.pmin) / self.pscale, deg)
+        if method not in ['qr', 'chol', 'svd']:
+            raise ValueError("unknown method: %s" %method)
+        # fewer points than coeffs: no unique solution, use the min. norm
+        # solution by SVD (as np.linalg.lstsq() in polyfit())
+        if vand.shape[0] < vand.shape[1]:
+            self.method = 'svd'
+        if self.method == 'qr':
+            self._q, self._r = np.linalg.qr(vand)
+            rdiag = np.abs(np.diag(self._r))
+            if rdiag.min() <= EPS * max(vand.shape) * rdiag.max():
+                self.method = 'svd'
+        elif self.method == 'chol':
+            try:
+                self._vandt = vand.T
+                self._cho = cho_factor(np.dot(vand.T, vand))
+            except np.linalg.LinAlgError:
+                self.method = 'svd'
+        if self.method == 'svd':
+            self._pinv = np.linalg.pinv(vand, rcond=EPS)
+
+    def fit(self, values):
+        """Fit one or many data sets.
+
+        Parameters
+        ----------
+        values : 1d array (npoints,) or 2d array (npoints, nfit)
+
+        Returns
+        -------
+        fit : dict
+            Same as :func:`polyfit`.
+        """
+        values = np.asarray(values, dtype=float)
+        assert values.ndim in [1,2], "values must be 1d or 2d array"
+        assert values.shape[0] == self.points.shape[0], \
+            "values and points have different length"
+        if self.scale:
+            vmin = values.min(axis=0)
+            vscale = np.abs(values).max(axis=0) - vmin
+        else:
+            vscale = 1.0 if values.ndim == 1 else np.ones((values.shape[1],))
+            vmin = 0.0 if values.ndim == 1 else np.zeros((values.shape[1],))
+        rhs = (values - vmin) / vscale
+        if self.method == 'qr':
+            coeffs = solve_triangular(self._r, np.dot(self._q.T, rhs))
+        elif self.method == 'chol':
+            coeffs = cho_solve(self._cho, np.dot(self._vandt, rhs))
+        else:
+            coeffs = np.dot(self._pinv, rhs)
+        return {'coeffs': coeffs, 'deg': self.deg, 'pscale': self.pscale,
+                'vscale': vscale, 'pmin': self.pmin, 'vmin': vmin}
+
+
 def polyval(fit, points, der=0, avg=False):
     """Evaluate polynomial generated by :func:`polyfit` on `points`.
 
@@ -1519,18 +1694,26 @@ class PolyFit(object):
         ----------
         points : nd array (npoints, ndim)
         values : 1d array (npoints,)
+        fit : dict, optional
+            Result of :func:`polyfit` for `points` and `values`, calculated
+            elsewhere (e.g. one element of :func:`polyfit_split`). Skip
+            fitting and use that.
         **kwds : keywords to [avg]polyfit()
         """
         self.points = self._fix_shape_init(points)
         assert self.points.ndim == 2, "points is not 2d array"
         self.values = values
+        fit = kwds.pop('fit', None)
         if self._has_keys(kwds, ['degrange', 'degmin', 'degmax', 'levels']):
             self.fitfunc = avgpolyfit
             self.evalfunc = avgpolyval
         else:
             self.fitfunc = polyfit
             self.evalfunc = polyval
-        self.fit = self.fitfunc(self.points, self.values, *args, **kwds)
+        if fit is None:
+            self.fit = self.fitfunc(self.points, self.values, *args, **kwds)
+        else:
+            self.fit = fit
     
     @staticmethod
     def _has_keys(dct, keys):
@@ -14,12 +14,13 @@ Other codes which do that are [2]_ and [3]_.
 
 import os, warnings
 import numpy as np
-from scipy.fftpack import fft
+from scipy.fftpack import fft, next_fast_len
 from scipy.signal import convolve, gaussian
 from pwtools import constants, _flib, num
 from pwtools.verbose import verbose
 from pwtools.signal import pad_zeros, welch, mirror
 
+
 def pyvacf(vel, m=None, method=3):
     """Reference implementation for calculating the VACF of velocities in 3d
     array `vel`. This is slow. Use for debugging only. For production, use
@@ -73,7 +74,38 @@ def pyvacf(vel, m=None, method=3):
     return c
 
 
-def fvacf(vel, m=None, method=2, nthreads=None):
+def _fft_vacf(vel, m=None, nthreads=None, maxmem=1.0, win=None):
+    """Normalized VACF by FFT (Wiener-Khinchin theorem), see fvacf(...,
+    method=3).
+
+    The velocities of each atom and direction are zero-padded to at least
+    ``2*nstep-1`` (next fast FFT length) to get the linear (not circular)
+    correlation. Atoms are processed in blocks which fit into `maxmem` (in GB)
+    and the power spectra of all atoms are summed before the (single) inverse
+    FFT. With scipy >= 1.4, each block's FFTs run on `nthreads` threads.
+    Optional window `win` (nstep,) is applied to each block.
+    """
+    nstep, natoms = vel.shape[:2]
+    nfft = next_fast_len(2*nstep - 1)
+    # real input + complex output + power spectrum per atom
+    bytes_per_atom = nfft * 3 * 8.0 * 4
+    nblock = num.block_size(natoms, bytes_per_atom, maxmem)
+    power = np.zeros((nfft//2 + 1,), dtype=float)
+    for start in range(0, natoms, nblock):
+        sl = slice(start, min(start + nblock, natoms))
+        vv = np.asarray(vel[:,sl,:], dtype=float)
+        if m is not None:
+            vv = vv * np.sqrt(m[sl])[None,:,None]
+        if win is not None:
+            vv = vv * win[:,None,None]
+        ff = num.rfft(vv, n=nfft, axis=0, nthreads=nthreads)
+        power += (ff.real**2.0 + ff.imag**2.0).sum(axis=2).sum(axis=1)
+        del vv, ff
+    c = num.irfft(power, n=nfft, nthreads=nthreads)[:nstep]
+    return c / c[0]
+
+
+def fvacf(vel, m=None, method=2, nthreads=None, maxmem=1.0):
     """Interface to Fortran function _flib.vacf(). Otherwise same
     functionallity as pyvacf(). Use this for production calculations.
     
@@ -86,11 +118,20 @@ def fvacf(vel, m=None, method=2, nthreads=None):
     method : int
         | 1 : loops
         | 2 : vectorized loops
+        | 3 : FFT (Wiener-Khinchin theorem) with zero padding, O(nstep
+        |     log(nstep)) instead of O(nstep**2), use this for long
+        |     trajectories. Doesn't call the Fortran extension.
 
     nthreads : int ot None
         If int, then use this many OpenMP threads in the Fortran extension.
         Only useful if the extension was compiled with OpenMP support, of
-        course.
+        course. With method=3, the number of threads for the FFTs (scipy >=
+        1.4, default: all cores).
+    maxmem : float
+        Max. memory in GB for temp arrays. Atoms are processed in blocks
+        which fit into that, such that no full copy of `vel` is made (e.g.
+        conversion to Fortran order or float64). Hence `vel` can also be
+        float32 or an on-disk array (``numpy.memmap``, ``h5py.Dataset``).
 
     Returns
     -------
@@ -130,9 +171,11 @@ def fvacf(vel, m=None, method=2, nthreads=None):
     # ------------------------------------------------
     # With vel = np.asarray(vel, order='F'), we convert vel to F-order and a
     # copy is made by numpy. If we don't do it, the f2py wrapper code does.
-    # This copy is unavoidable, unless we allocate the array vel in F-order in
-    # the first place.
-    #   c = _flib.vacf(np.asarray(vel, order='F'), m, c, method, use_m)
+    # To never hold a second full copy of `vel`, we pass blocks of atoms
+    # vel[:,sl,:] (F-order, float64 copy of only the block, also for float32
+    # or on-disk input) to the extension and sum up the un-normalized
+    # correlations of all blocks. _flib.vacf() returns c/c[0], but c[0] =
+    # sum(m*v**2) of the block is cheap to calculate here.
     # 
     # speed
     # -----
@@ -143,32 +186,51 @@ def fvacf(vel, m=None, method=2, nthreads=None):
     natoms = vel.shape[1]
     nstep = vel.shape[0]
     assert vel.shape[-1] == 3, ("last dim of vel must be 3: (nstep,natoms,3)")
-    # `c` as "intent(in, out)" could be "intent(out), allocatable" or so,
-    # makes extension more pythonic, don't pass `c` in, let be allocated on
-    # Fortran side
-    c = np.zeros((nstep,), dtype=float)
+    if nthreads is None and 'OMP_NUM_THREADS' in os.environ:
+        nthreads = int(os.environ['OMP_NUM_THREADS'])
+    if method == 3:
+        if m is not None:
+            assert len(m) == natoms, "len(m) != vel.shape[1]"
+        verbose("calling _fft_vacf ...")
+        c = _fft_vacf(vel, m=m, nthreads=nthreads, maxmem=maxmem)
+        verbose("... ready")
+        return c
     if m is None:
         # dummy
-        m = np.empty((natoms,), dtype=float)
+        m = np.ones((natoms,), dtype=float)
         use_m = 0
     else:
+        assert len(m) == natoms, "len(m) != vel.shape[1]"
+        m = np.asarray(m, dtype=float)
         use_m = 1
+    # F-order block copy + mass weighted copy in method 2
+    bytes_per_atom = nstep * 3 * 8.0 * (1 + use_m)
+    nblock = num.block_size(natoms, bytes_per_atom, maxmem)
+    c = np.zeros((nstep,), dtype=float)
     verbose("calling _flib.vacf ...")
-    if nthreads is None:
-        # Possible f2py bug workaround: The f2py extension does not always set
-        # the number of threads correctly according to OMP_NUM_THREADS. Catch
-        # OMP_NUM_THREADS here and set number of threads using the "nthreads"
-        # arg.
-        key = 'OMP_NUM_THREADS'
-        if key in os.environ:
-            nthreads = int(os.environ[key])
-            c = _flib.vacf(vel, m, c, method, use_m, nthreads)
-        else:            
-            c = _flib.vacf(vel, m, c, method, use_m)
-    else:        
-        c = _flib.vacf(vel, m, c, method, use_m, nthreads)
+    for start in range(0, natoms, nblock):
+        sl = slice(start, min(start + nblock, natoms))
+        vv = np.asarray(vel[:,sl,:], dtype=float, order='F')
+        mm = m[sl]
+        c0 = np.dot((vv*vv).sum(axis=2).sum(axis=0), mm)
+        if c0 == 0.0:
+            continue
+        # `c` as "intent(in, out)" could be "intent(out), allocatable" or so,
+        # makes extension more pythonic, don't pass `c` in, let be allocated
+        # on Fortran side
+        cc = np.zeros((nstep,), dtype=float)
+        # Possible f2py bug workaround: The f2py extension does not always
+        # set the number of threads correctly according to OMP_NUM_THREADS.
+        # We caught OMP_NUM_THREADS above and set number of threads using the
+        # "nthreads" arg.
+        if nthreads is None:
+            cc = _flib.vacf(vv, mm, cc, method, use_m)
+        else:        
+            cc = _flib.vacf(vv, mm, cc, method, use_m, nthreads)
+        c += cc * c0
+        del vv
     verbose("... ready")
-    return c
+    return c / c[0]
 
 
 def pdos(vel, dt=1.0, m=None, full_out=False, area=1.0, window=True,
@@ -261,15 +323,17 @@ def pdos(vel, dt=1.0, m=None, full_out=False, area=1.0, window=True,
         assert len(mass) == vel.shape[1], "len(mass) != vel.shape[1]"
         # define here b/c may be used twice below
         mass_bc = mass[None,:,None]
-    if window:
+    # handle options which are mutually exclusive
+    if method == 'vacf':
+        assert npad in [0,None], "use npad={0,None} for method='vacf'"
+        # window applied to blocks of atoms in fvacf(), no copy of `vel`
+        vel2 = vel
+    elif window:
         sl = [None]*vel.ndim 
         sl[axis] = slice(None) # ':'
-        vel2 = vel*(welch(vel.shape[axis])[sl])
+        vel2 = vel*(welch(vel.shape[axis])[tuple(sl)])
     else:
         vel2 = vel
-    # handle options which are mutually exclusive
-    if method == 'vacf':
-        assert npad in [0,None], "use npad={0,None} for method='vacf'"
     # padding
     if npad is not None:
         nadd = (vel2.shape[axis]-1)*npad
@@ -305,7 +369,8 @@ def pdos(vel, dt=1.0, m=None, full_out=False, area=1.0, window=True,
         else:
             return default_out
     elif method == 'vacf':
-        vacf = fvacf(vel2, m=mass)
+        win = welch(vel.shape[axis]) if window else None
+        vacf = _fft_vacf(vel, m=mass, win=win)
         if mirr:
             fft_vacf = fft(mirror(vacf))
         else:
@@ -341,3 +406,196 @@ def direct_pdos(vel, *args, **kwds):
         kwds['tonext'] = kwds['pad_tonext']
         kwds.pop('pad_tonext')
     return pdos(vel, *args, method='direct', **kwds)
+
+
+def welch_pdos(vel, dt=1.0, m=None, seglen=None, overlap=0.5, window=True,
+               npad=None, area=1.0, full_out=False, nthreads=None):
+    """Phonon DOS by Welch's method: average of the power spectra of
+    overlapping, windowed segments of the velocities.
+
+    Only one segment ``vel[start:start+seglen,...]`` is read and FFT'ed at a
+    time, so `vel` can be any array-like which supports slicing along the
+    first axis, e.g. a ``numpy.memmap`` or a ``h5py.Dataset``, and memory
+    is bounded by one segment. Compared to :func:`pdos` with
+    ``method='direct'`` on the full trajectory, the frequency resolution is
+    lower (set by `seglen`), but the spectrum is much less noisy and we get
+    the variance over segments for error bars.
+
+    Parameters
+    ----------
+    vel : 3d array-like (nstep, natoms, 3)
+        atomic velocities
+    dt : time step
+    m : 1d array (natoms,),
+        atomic mass array, if None then mass=1.0 for all atoms is used
+    seglen : int, optional
+        Segment length in time steps. Default is ``nstep//4``.
+    overlap : float
+        Overlap of segments in [0,1). 0.5 means 50% overlap.
+    window : bool
+        use Welch windowing on each segment before FFT
+    npad : {None, int}
+        Pad each segment with ``(seglen-1)*npad`` zeros, see :func:`pdos`.
+    area : float
+        normalize area under frequency-PDOS curve to this value
+    full_out : bool
+    nthreads : int or None
+        Number of threads for the FFTs (scipy >= 1.4, default: all cores).
+
+    Returns
+    -------
+    if full_out = False
+        | ``(faxis, pdos)``
+    if full_out = True
+        | ``(faxis, pdos, pdos_var, nseg)``
+        | pdos_var : 1d array, variance of the single-segment spectra (same
+        |     normalization as `pdos`), ``sqrt(pdos_var/nseg)`` is the
+        |     standard error of `pdos` if segments are uncorrelated
+        | nseg : number of segments
+
+    Examples
+    --------
+    >>> import h5py
+    >>> fh = h5py.File('traj.h5', 'r')
+    >>> freq, dos, var, nseg = welch_pdos(fh['/velocity'], dt=dt, m=mass,
+    ...                                   seglen=4096, full_out=True)
+    >>> errorbar(freq, dos, yerr=np.sqrt(var/nseg))
+
+    See Also
+    --------
+    :func:`pdos`
+    """
+    nstep, natoms = vel.shape[:2]
+    assert vel.shape[-1] == 3
+    if seglen is None:
+        seglen = nstep // 4
+    assert 1 < seglen <= nstep, "need 1 < seglen <= nstep"
+    assert 0.0 <= overlap < 1.0, "need 0 <= overlap < 1"
+    if m is not None:
+        assert len(m) == natoms, "len(m) != vel.shape[1]"
+        mass_bc = np.asarray(m, dtype=float)[None,:,None]
+    nfft = seglen if npad is None else seglen + (seglen-1)*npad
+    split_idx = nfft // 2
+    faxis = np.fft.fftfreq(nfft, dt)[:split_idx]
+    if window:
+        win = welch(seglen)[:,None,None]
+    step = max(1, seglen - int(round(overlap*seglen)))
+    starts = range(0, nstep - seglen + 1, step)
+    nseg = len(starts)
+    # running mean and sum of squared deviations (Welford)
+    mean = np.zeros((split_idx,), dtype=float)
+    msq = np.zeros((split_idx,), dtype=float)
+    for iseg, start in enumerate(starts):
+        seg = np.asarray(vel[start:start+seglen,...], dtype=float)
+        if window:
+            seg = seg * win
+        ff = num.rfft(seg, n=nfft, axis=0, nthreads=nthreads)[:split_idx,...]
+        power = ff.real**2.0 + ff.imag**2.0
+        if m is not None:
+            power *= mass_bc
+        power = power.sum(axis=2).sum(axis=1)
+        delta = power - mean
+        mean += delta / (iseg + 1)
+        msq += delta * (power - mean)
+    var = msq / (nseg - 1) if nseg > 1 else np.zeros_like(msq)
+    pdos = num.norm_int(mean, faxis, area=area)
+    imax = np.argmax(mean)
+    scale = pdos[imax] / mean[imax]
+    if full_out:
+        return faxis, pdos, var * scale**2.0, nseg
+    else:
+        return faxis, pdos
+
+
+def projected_pdos(vel, groups, dt=1.0, m=None, area=1.0, window=True,
+                   npad=None, tonext=False, full_out=False, nthreads=None,
+                   maxmem=1.0):
+    """Phonon DOS projected onto groups of atoms (e.g. species), with one FFT
+    of the velocities.
+
+    Same as ``pdos(vel[:,idx,:], ..., method='direct')`` for the atoms
+    ``idx`` of each group, but the per-atom power spectra are calculated only
+    once and reduced into all groups. All groups are normalized with the same
+    factor, such that the total DOS (all atoms) has integral area `area`.
+    Hence, if `groups` is a partition of all atoms, the group DOS sum up to
+    the total DOS.
+
+    Parameters
+    ----------
+    vel : 3d array (nstep, natoms, 3)
+        atomic velocities
+    groups : sequence (ngroups,)
+        Each entry is a bool mask (natoms,) or a sequence of atom indices.
+    dt, m, area, window, npad, tonext :
+        See :func:`pdos`.
+    full_out : bool
+    nthreads : int or None
+        Number of threads for the FFTs (scipy >= 1.4, default: all cores).
+    maxmem : float
+        Max. memory in GB for temp arrays, atoms are FFT'ed in blocks which
+        fit into that.
+
+    Returns
+    -------
+    if full_out = False
+        | ``(faxis, pdos)``
+    if full_out = True
+        | ``(faxis, pdos, pdos_total)``
+    faxis : 1d array (nfreq,)
+    pdos : 2d array (ngroups, nfreq)
+    pdos_total : 1d array (nfreq,), DOS of all atoms, same as
+        ``pdos(..., method='direct')``
+
+    Examples
+    --------
+    >>> symbols = np.array(traj.symbols)
+    >>> groups = [symbols == sym for sym in traj.symbols_unique]
+    >>> freq, dos = projected_pdos(traj.velocity, groups, m=traj.mass,
+    ...                            dt=traj.timestep, npad=1)
+    >>> for sym, dd in zip(traj.symbols_unique, dos):
+    ...     plot(freq, dd, label=sym)
+    """
+    nstep, natoms = vel.shape[:2]
+    assert vel.shape[-1] == 3
+    # (natoms, ngroups) indicator matrix
+    ind = np.zeros((natoms, len(groups)), dtype=float)
+    for ii, grp in enumerate(groups):
+        grp = np.asarray(grp)
+        if grp.dtype == bool:
+            assert len(grp) == natoms, "bool mask must have len natoms"
+        ind[grp,ii] = 1.0
+    if m is not None:
+        assert len(m) == natoms, "len(m) != vel.shape[1]"
+        mass = np.asarray(m, dtype=float)
+    nfft = nstep if npad is None else nstep + (nstep-1)*npad
+    if tonext:
+        nfft = 2**int(np.ceil(np.log2(nfft)))
+    split_idx = nfft // 2
+    faxis = np.fft.fftfreq(nfft, dt)[:split_idx]
+    if window:
+        win = welch(nstep)[:,None,None]
+    # real input + complex output + power spectrum per atom
+    bytes_per_atom = nfft * 3 * 8.0 * 4
+    nblock = num.block_size(natoms, bytes_per_atom, maxmem)
+    group_pdos = np.zeros((len(groups), split_idx), dtype=float)
+    total = np.zeros((split_idx,), dtype=float)
+    for start in range(0, natoms, nblock):
+        sl = slice(start, min(start + nblock, natoms))
+        vv = np.asarray(vel[:,sl,:], dtype=float)
+        if window:
+            vv = vv * win
+        ff = num.rfft(vv, n=nfft, axis=0, nthreads=nthreads)[:split_idx,...]
+        # per-atom power spectra (nfreq, nblock)
+        power = (ff.real**2.0 + ff.imag**2.0).sum(axis=2)
+        del vv, ff
+        if m is not None:
+            power *= mass[None,sl]
+        total += power.sum(axis=1)
+        group_pdos += np.dot(power, ind[sl,:]).T
+    pdos_total = num.norm_int(total, faxis, area=area)
+    imax = np.argmax(total)
+    group_pdos *= pdos_total[imax] / total[imax]
+    if full_out:
+        return faxis, group_pdos, pdos_total
+    else:
+        return faxis, group_pdos
@@ -5,8 +5,9 @@ reference implementations plus some utilities.
 
 from itertools import product
 import numpy as np
-from scipy.fftpack import fft, ifft
-from scipy.signal import fftconvolve, gaussian, kaiserord, firwin, lfilter, freqz
+from scipy.fftpack import fft, ifft, next_fast_len
+from scipy.signal import fftconvolve, convolve, gaussian, kaiserord, firwin, \
+    lfilter, freqz
 from scipy.integrate import trapz
 from pwtools import _flib, num
 
@@ -393,8 +394,9 @@ def mirror(arr, axis=0):
 # gets returned. Check f2py docs for wrapping such that c generated on the
 # Fortran side.
 #
-def acorr(v, method=7, norm=True):
-    """(Normalized) autocorrelation function (ACF) for 1d arrays.
+def acorr(v, method=7, norm=True, axis=0, out=None):
+    """(Normalized) autocorrelation function (ACF) for 1d arrays, or for all
+    1d arrays along `axis` of an nd array (method 7).
 
     Without normalization
         c(t) = <v(0) v(t)>
@@ -410,7 +412,7 @@ def acorr(v, method=7, norm=True):
 
     Parameters
     ----------
-    v : 1d array
+    v : 1d array, or nd array for method 7
     method : int
         | 1: Python loops
         | 2: Python loops, zero-padded
@@ -421,10 +423,17 @@ def acorr(v, method=7, norm=True):
         | 7: fft, Wiener-Khinchin Theorem
     norm : bool
         normalize or not
+    axis : int
+        method 7 only: time axis of nd array `v`. The ACFs of all 1d arrays
+        along `axis` are calculated with one batched FFT.
+    out : array, optional
+        method 7 only: array of ``v.shape`` to write the result into. This
+        saves only the result array, the FFT temporaries of length
+        ``>=2*len(v)-1`` along `axis` are allocated anyway.
 
     Returns
     -------
-    c : numpy 1d array
+    c : numpy 1d array, or nd array of ``v.shape`` for nd input
         | c[0]  <=> lag = 0
         | c[-1] <=> lag = len(v)
     
@@ -440,6 +449,8 @@ def acorr(v, method=7, norm=True):
        in the time domain, i.e. norm(acorr(v,1) - acorr(v,6)) = 0.0. 
        The FFT method introduces small numerical noise, norm(acorr(v,1) -
        acorr(v,4)) = O(1e-16) or so.
+       The FFT method pads with zeros to the next fast FFT length >= 2*len(v)-1
+       (scipy.fftpack.next_fast_len) to get the linear correlation.
 
     signature of the Fortran extension _flib.acorr::
 
@@ -462,6 +473,27 @@ def acorr(v, method=7, norm=True):
     .. [4] http://mathworld.wolfram.com/Wiener-KhinchinTheorem.html
     .. [5] http://mathworld.wolfram.com/Autocorrelation.html
     """
+    v = np.asarray(v)
+    if method == 7:
+        # Correlation via fft. After ifft, the imaginary part is (in theory) =
+        # 0, in practise < 1e-16, so we use rfft/irfft of real arrays. rfft
+        # pads with zeros to length nfft, no copy of `v`.
+        nstep = v.shape[axis]
+        nfft = next_fast_len(2*nstep - 1)
+        fv = np.fft.rfft(v, n=nfft, axis=axis)
+        c = np.fft.irfft(fv.real**2.0 + fv.imag**2.0, n=nfft, axis=axis)
+        del fv
+        c = num.slicetake(c, slice(0, nstep), axis=axis, copy=False)
+        if out is None:
+            out = np.empty(c.shape, dtype=float)
+        # normalize directly into `out`, no temp copy
+        if norm:
+            np.divide(c, num.slicetake(c, slice(0, 1), axis=axis, copy=False),
+                      out=out)
+        else:
+            out[...] = c
+        return out
+    assert v.ndim == 1, "method %i: only 1d arrays" %method
     nstep = v.shape[0]
     c = np.zeros((nstep,), dtype=float)
     _norm = 1 if norm else 0
@@ -483,11 +515,6 @@ def acorr(v, method=7, norm=True):
         return _flib.acorr(v, c, 1, _norm)
     elif method == 6: 
         return _flib.acorr(v, c, 2, _norm)
-    elif method == 7: 
-        # Correlation via fft. After ifft, the imaginary part is (in theory) =
-        # 0, in practise < 1e-16, so we are safe to return the real part only.
-        vv = np.concatenate((v, np.zeros((nstep,),dtype=float)))
-        c = ifft(np.abs(fft(vv))**2.0)[:nstep].real
     else:
         raise ValueError('unknown method: %s' %method)
     if norm:        
@@ -581,10 +608,92 @@ def find_peaks(y, x=None, k=3, spread=2, ymin=None):
     return idx0, pos0
 
 
-def smooth(data, kern, axis=0, edge='m', norm=True):
+# Cost model constants for _conv_method(), from examples/smooth_speed.py.
+# Direct convolution costs ~ nout*M multiply-adds, FFT convolution ~ L*log2(L)
+# with L = len(sig). Relative cost of one FFT "operation" compared to one
+# direct multiply-add for 1d arrays (np.convolve, fast) and nd arrays
+# (scipy.signal.convolve, much slower per multiply-add).
+_CONV_FFT_COST_1D = 16.0
+_CONV_FFT_COST_ND = 0.1
+
+
+def _conv_method(sig_shape, kern_shape):
+    """Return 'direct' or 'fft', whichever is estimated to be faster for
+    ``convolve(sig, kern, 'valid')``."""
+    nsig = float(np.prod(sig_shape))
+    nkern = float(np.prod(kern_shape))
+    nout = float(np.prod([ns - nk + 1 for ns,nk in zip(sig_shape,
+                                                       kern_shape)]))
+    fft_cost = _CONV_FFT_COST_1D if len(sig_shape) == 1 else \
+               _CONV_FFT_COST_ND
+    if nout * nkern < fft_cost * nsig * np.log2(max(nsig, 2.0)):
+        return 'direct'
+    else:
+        return 'fft'
+
+
+def _convolve_valid(sig, kern, method):
+    if method == 'auto':
+        method = _conv_method(sig.shape, kern.shape)
+    if method == 'fft':
+        return fftconvolve(sig, kern, 'valid')
+    elif method == 'direct':
+        return convolve(sig, kern, 'valid', method='direct')
+    else:
+        raise ValueError("unknown method: %s" %method)
+
+
+def _smooth_chunked(data, kern, axis, edge, norm, out, chunksize, method):
+    # smooth() in chunks along `axis`, see comments there. Each output chunk
+    # data[a:b] is the 'valid' convolution of the padded signal `sig` for
+    # data indices [a-M, b+M), where indices < 0 and >= N are mapped to the
+    # same mirror/constant/zero values which smooth() uses for padding.
+    N = data.shape[axis]
+    M = kern.shape[axis]
+    if out is None:
+        out = np.empty(data.shape, dtype=float)
+    kk = kern/float(kern.sum()) if norm else kern
+    s0 = M//2 if M % 2 == 0 else M//2+1
+    K = min(M, N-1)
+    bshape = [1]*len(data.shape)
+    for a in range(0, N, chunksize):
+        b = min(a + chunksize, N)
+        wlo = max(a-M, 0)
+        whi = min(b+M, N)
+        sl = [slice(None)]*len(data.shape)
+        sl[axis] = slice(wlo, whi)
+        win = np.asarray(data[tuple(sl)], dtype=float)
+        # data indices of sig
+        didx = np.arange(a-M, b+M)
+        zero = np.zeros(didx.shape, dtype=bool)
+        if edge == 'm':
+            left = didx < 0
+            right = didx >= N
+            zero[left] = -didx[left] > K
+            zero[right] = didx[right] - N >= K
+            didx[left] = -didx[left]
+            didx[right] = 2*N - 2 - didx[right]
+        elif edge == 'c':
+            didx = np.clip(didx, 0, N-1)
+        else:
+            raise Exception("unknown value for edge")
+        didx[zero] = wlo
+        sig = np.take(win, didx - wlo, axis=axis)
+        if zero.any():
+            bshape[axis] = len(zero)
+            sig *= np.invert(zero).reshape(bshape)
+        ret = _convolve_valid(sig, kk, method)
+        osl = [slice(None)]*len(data.shape)
+        osl[axis] = slice(a, b)
+        out[tuple(osl)] = num.slicetake(ret, sl=slice(s0, s0+b-a), axis=axis)
+    return out
+
+
+def smooth(data, kern, axis=0, edge='m', norm=True, out=None,
+           chunksize=None, method='auto'):
     """Smooth N-dim `data` by convolution with a kernel `kern`. 
     
-    Uses scipy.signal.fftconvolve(). 
+    Uses scipy.signal.fftconvolve() or direct convolution, see `method`.
     
     Note that due to edge effect handling (padding) and kernal normalization,
     the convolution identity convolve(data,kern) == convolve(kern,data) doesn't
@@ -612,11 +721,24 @@ def smooth(data, kern, axis=0, edge='m', norm=True):
         signal lies within the data. Note that this is not True for kernels
         with very big spread (i.e. ``hann(N*10)`` or ``gaussian(N/2,
         std=N*10)``. Then the kernel is effectively a constant.
+    out : nd array-like, optional
+        Write result to this array of ``data.shape``, e.g. a
+        ``numpy.memmap`` or ``h5py.Dataset``.
+    chunksize : int, optional
+        Process `data` in chunks of this many points along `axis`
+        (overlap-save), reading only ``chunksize + 2*len(kern)`` points at a
+        time. Then `data` can be any array-like which supports slicing, e.g.
+        ``numpy.memmap`` or ``h5py.Dataset``. The result is the same as
+        without chunks (up to FFT round-off).
+    method : str
+        | 'fft' : scipy.signal.fftconvolve(), O(N*log(N))
+        | 'direct' : direct convolution, O(N*M), faster for short kernels
+        | 'auto' : choose by a simple cost model, see Notes
     
     Returns
     -------
     ret : data.shape
-        Convolved signal.
+        Convolved signal. `out` if given.
 
     Examples
     --------
@@ -696,6 +818,17 @@ def smooth(data, kern, axis=0, edge='m', norm=True):
     :func:`lorentz`, much wider kernels are needed such as `M=100*std` b/c
     of the long tails of the Lorentz function. Testing is mandatory!
     
+    Convolution method:
+
+    With ``method='auto'``, direct convolution is used if ``N*M <
+    c*L*log2(L)`` (L = padded signal length, all dimensions multiplied for nd
+    arrays). The constant `c` was determined with
+    ``examples/smooth_speed.py``. For 1d data, the crossover is at ``M ~
+    250`` for ``N=1e5``, i.e. direct convolution is faster for typical
+    smoothing kernels, FFT for wide kernels (e.g. Lorentz kernels with
+    ``M=100*std``). For nd data and kernels like ``(M,1,1)``, FFT is almost
+    always faster b/c scipy's nd direct convolution is slow.
+
     Edge effects:
 
     We use padding of the signal with ``M=len(kern)`` values at both ends such
@@ -736,6 +869,9 @@ def smooth(data, kern, axis=0, edge='m', norm=True):
     The size of the chunk over which you explicitely loop depends on the data
     of course. We do exactly this in :func:`pwtools.crys.smooth`.
     """
+    if chunksize is not None:
+        return _smooth_chunked(data, kern, axis=axis, edge=edge, norm=norm,
+                               out=out, chunksize=chunksize, method=method)
     # edge = 'm'
     # ----------
     # 
@@ -789,7 +925,7 @@ def smooth(data, kern, axis=0, edge='m', norm=True):
         raise Exception("unknown value for edge")
     sig = np.concatenate((dleft, data, dright), axis=axis)
     kk = kern/float(kern.sum()) if norm else kern
-    ret = fftconvolve(sig, kk, 'valid')
+    ret = _convolve_valid(sig, kk, method)
     assert ret.shape[axis] == N+M+1, "unexpected convolve result shape"
     del sig
     if M % 2 == 0:
@@ -800,6 +936,9 @@ def smooth(data, kern, axis=0, edge='m', norm=True):
     ret = num.slicetake(ret, sl=sl, axis=axis)        
     assert ret.shape == data.shape, ("ups, ret.shape (%s)!= data.shape (%s)" \
                                       %(ret.shape, data.shape))
+    if out is not None:
+        out[...] = ret
+        return out
     return ret
 
 
@@ -922,13 +1061,76 @@ class FIRFilter(object):
         w,h = freqz(self.taps)
         self.w = (w/np.pi)*nyq
         self.h = h
+        # state for process()
+        self.zi = None
+
+    def reset(self):
+        """Reset the filter state of :meth:`process`."""
+        self.zi = None
 
-    def __call__(self, x, axis=-1):
+    def process(self, x, axis=-1):
+        """Apply filter to the next chunk of a signal along `axis`.
+
+        The filter state is carried over between calls, such that filtering
+        a signal chunk by chunk gives the same result as :meth:`__call__`
+        with the whole signal. Call :meth:`reset` before starting with a new
+        signal.
+
+        Parameters
+        ----------
+        x : nd array
+        axis : int
+
+        Returns
+        -------
+        y : nd array of ``x.shape``
+
+        Examples
+        --------
+        >>> f = FIRFilter(cutoff=10, nyq=50, ntaps=101)
+        >>> for start in range(0, nstep, 10000):
+        ...     sl = slice(start, start+10000)
+        ...     out[sl,...] = f.process(data[sl,...], axis=0)
+        """
+        x = np.asarray(x)
+        if self.zi is None:
+            shape = list(x.shape)
+            shape[axis] = len(self.taps) - 1
+            self.zi = np.zeros(shape, dtype=float)
+        y, self.zi = lfilter(self.taps, 1.0, x, axis=axis, zi=self.zi)
+        return y
+
+    def __call__(self, x, axis=-1, out=None, chunksize=None):
         """Apply filter to signal.
 
         Parameters
         ----------
-        x : 1d array
+        x : nd array
         axis : int
+        out : nd array-like, optional
+            Write result to this array of ``x.shape``, e.g. a
+            ``numpy.memmap`` or ``h5py.Dataset``.
+        chunksize : int, optional
+            Filter `x` in chunks of this many points along `axis` with
+            carried filter state (see :meth:`process`). Then `x` can be any
+            array-like which supports slicing (``numpy.memmap``,
+            ``h5py.Dataset``) and only one chunk is in memory at a time. The
+            result is the same as without chunks.
         """
-        return lfilter(self.taps, 1.0, x, axis=axis)
+        if chunksize is None:
+            y = lfilter(self.taps, 1.0, x, axis=axis)
+            if out is not None:
+                out[...] = y
+                return out
+            return y
+        else:
+            if out is None:
+                out = np.empty(x.shape, dtype=float)
+            self.reset()
+            nn = x.shape[axis]
+            sl = [slice(None)]*len(x.shape)
+            for start in range(0, nn, chunksize):
+                sl[axis] = slice(start, min(start + chunksize, nn))
+                out[tuple(sl)] = self.process(x[tuple(sl)], axis=axis)
+            self.reset()
+            return out
@@ -0,0 +1,241 @@
+"""
+Static structure factor S(q) from MD trajectories or single structures.
+
+Two methods are implemented:
+
+* :func:`sq_from_rpdf` : sine transform of the radial pair distribution
+  function g(r), e.g. from :func:`~pwtools.crys.rpdf` or
+  :func:`~pwtools.crys.rpdf_partial` [1]_.
+* :func:`sq_direct` : direct summation over reciprocal lattice vectors of the
+  (super)cell [2]_, which is exact for the periodic system, but restricted to
+  the q-points compatible with the cell.
+
+Partial structure factors of both methods are of the Faber-Ziman type [3]_,
+i.e. they converge to 1 for large q for all pairs, also ``a != b``. The total
+S(q) is the concentration-weighted sum ``sum_ab c_a c_b S_ab(q)`` with ``c_a =
+N_a/N``, where pairs ``a != b`` appear twice.
+
+.. [1] M. P. Allen, D. J. Tildesley, Computer Simulation of Liquids,
+       Clarendon Press, 1989
+.. [2] J.-P. Hansen, I. R. McDonald, Theory of Simple Liquids, Academic Press,
+       2006
+.. [3] T. E. Faber, J. M. Ziman, Phil. Mag. 11(109), 153, 1965
+"""
+
+import itertools
+from math import pi
+import numpy as np
+from pwtools import crys
+
+
+def sq_from_rpdf(rad, gr, rho, q=None, window='lorch'):
+    """Structure factor from the radial pair distribution function by sine
+    transform::
+
+        S(q) = 1 + 4*pi*rho * int(0,rmax) dr r**2 * (g(r) - 1) *
+                                                    sin(q*r)/(q*r) * W(r)
+
+    Parameters
+    ----------
+    rad : 1d array (nbins,)
+        Radius, middle of the histogram bins with equal spacing `dr`, e.g.
+        ``crys.rpdf(...)[:,0]``.
+    gr : array (..., nbins)
+        g(r), e.g. ``crys.rpdf(...)[:,1]`` or ``out[...,1]`` of
+        ``out,pairs = crys.rpdf_partial(...)`` for all partials at once.
+    rho : float
+        Total number density ``natoms/volume`` (also for partials).
+    q : 1d array (nq,), optional
+        Default is ``pi/rmax * arange(1, nbins+1)`` with ``rmax = rad[-1] +
+        dr/2``, which is the resolution limit of the histogram.
+    window : {'lorch', None} or 1d array (nbins,)
+        Window function W(r) to reduce truncation ripples at ``r=rmax``.
+        'lorch' is ``sin(pi*r/rmax) / (pi*r/rmax)``.
+
+    Returns
+    -------
+    q, sq
+    q : 1d array (nq,)
+    sq : array (..., nq)
+
+    Examples
+    --------
+    >>> out, pairs = crys.rpdf_partial(traj, dr=0.05)
+    >>> rho = traj.natoms / traj.volume.mean()
+    >>> q, sq = structfac.sq_from_rpdf(out[0,:,0], out[...,1], rho)
+    >>> for (sym0, sym1), ss in zip(pairs, sq):
+    ...     plot(q, ss, label='%s-%s' %(sym0, sym1))
+    """
+    rad = np.asarray(rad)
+    gr = np.asarray(gr)
+    assert gr.shape[-1] == len(rad), ("last dim of gr must be len(rad)")
+    dr = rad[1] - rad[0]
+    rmax = rad[-1] + 0.5*dr
+    if q is None:
+        q = pi / rmax * np.arange(1, len(rad)+1)
+    q = np.asarray(q, dtype=float)
+    if window is None:
+        win = np.ones_like(rad)
+    elif isinstance(window, str):
+        if window == 'lorch':
+            # np.sinc(x) = sin(pi*x) / (pi*x)
+            win = np.sinc(rad / rmax)
+        else:
+            raise ValueError("unknown window: %s" %window)
+    else:
+        win = np.asarray(window)
+    # (nq, nbins), sin(q*r) / (q*r), =1 for q*r=0
+    kern = np.sinc(q[:,None] * rad[None,:] / pi)
+    integrand = rad**2.0 * (gr - 1.0) * win
+    sq = 1.0 + 4.0*pi*rho*dr*np.dot(integrand, kern.T)
+    return q, sq
+
+
+def _qshell_sums(traj, qmax, dq, tmask, partial, maxmem):
+    # Shell sums of S(G) for all G vectors with |G| <= qmax, see sq_direct().
+    traj = crys.struct2traj(traj)
+    if tmask is None:
+        tmask = slice(None)
+    coords_frac = traj.coords_frac[tmask,...]
+    cell = traj.cell[tmask,...]
+    if coords_frac.ndim == 2:
+        coords_frac = coords_frac[None,...]
+        cell = cell[None,...]
+    nstep, natoms = coords_frac.shape[:2]
+    # Miller indices h of G = h . recip_cell with |G| <= qmax. Since
+    # G . a_i = 2*pi*h_i, we have |h_i| <= qmax*|a_i|/(2*pi). Use max. cell
+    # vector lengths in case of variable cell.
+    amax = np.sqrt((cell**2.0).sum(axis=2)).max(axis=0)
+    hmax = np.ceil(qmax * amax / 2.0 / pi).astype(int)
+    hshape = tuple(2*hmax + 1)
+    nh = int(np.prod(hshape))
+    rcell = np.array([crys.recip_cell(cc) for cc in cell])
+    nq = int(np.ceil(qmax / dq))
+
+    symbols = np.array(traj.symbols)
+    symbols_unique = traj.symbols_unique
+    # (nspecies, natoms) indicator matrix for summing atoms of each species
+    ind = np.array([symbols == sym for sym in symbols_unique], dtype=float)
+    nat_sp = ind.sum(axis=1)
+    pairs = list(itertools.combinations_with_replacement(
+                 range(len(symbols_unique)), 2))
+
+    ssum = np.zeros((len(pairs), nq)) if partial else np.zeros((nq,))
+    qsum = np.zeros((nq,))
+    cnt = np.zeros((nq,))
+    # memory per (step, G) of the complex phase array + temps, and of the
+    # (nb, ng, 3) G vectors, qlen, iq, qmsk
+    nbytes = natoms * 16.0 * 2 + 24 + 8 + 8 + 1
+    ng = int(min(nh, max(1, maxmem * 1e9 / nbytes)))
+    nb = int(min(nstep, max(1, maxmem * 1e9 / nbytes / ng)))
+    for gstart in range(0, nh, ng):
+        # Miller indices of this block (ng, 3), generated on the fly instead
+        # of the full (nh, 3) array
+        hh = np.array(np.unravel_index(np.arange(gstart, min(gstart + ng, nh)),
+                                       hshape)).T - hmax[None,:]
+        # Half space, S(G) = S(-G). Skip G=0.
+        hmsk = (hh[:,0] > 0) | ((hh[:,0] == 0) & (hh[:,1] > 0)) | \
+               ((hh[:,0] == 0) & (hh[:,1] == 0) & (hh[:,2] > 0))
+        hh = hh[hmsk,:].astype(float)
+        if hh.shape[0] == 0:
+            continue
+        for tstart in range(0, nstep, nb):
+            tsl = slice(tstart, min(tstart + nb, nstep))
+            # |G| for all h and steps in block: (nb, ng)
+            qlen = np.sqrt((np.matmul(hh[None,...], rcell[tsl,...])**2.0).sum(axis=2))
+            iq = (qlen / dq).astype(int)
+            qmsk = (qlen <= qmax) & (iq < nq)
+            if not qmsk.any():
+                continue
+            cnt += np.bincount(iq[qmsk], minlength=nq)
+            qsum += np.bincount(iq[qmsk], weights=qlen[qmsk], minlength=nq)
+            # exp(i G . r) = exp(2*pi*i h . s), s = fractional coords
+            # (nb, natoms, ng)
+            phase = np.exp(2j*pi*np.matmul(coords_frac[tsl,...], hh.T))
+            if partial:
+                # rho_a(G) = sum_{j in a} exp(i G . r_j): (nb, nspecies, ng)
+                rho = np.matmul(ind[None,...], phase)
+                for ip, (ia, ib) in enumerate(pairs):
+                    sab = (rho[:,ia,:] * rho[:,ib,:].conj()).real \
+                        / np.sqrt(nat_sp[ia] * nat_sp[ib])
+                    ssum[ip,:] += np.bincount(iq[qmsk], weights=sab[qmsk],
+                                              minlength=nq)
+            else:
+                rho = phase.sum(axis=1)
+                ss = (rho * rho.conj()).real / natoms
+                ssum += np.bincount(iq[qmsk], weights=ss[qmsk],
+                                    minlength=nq)
+            del phase, rho, qlen, iq, qmsk
+    if partial:
+        # Ashcroft-Langreth -> Faber-Ziman:
+        # S_ab = 1 + (S_ab^AL - delta_ab) / sqrt(c_a*c_b), applied to the
+        # shell sums, i.e. weighted by the number of G vectors per shell
+        conc = nat_sp / float(natoms)
+        for ip, (ia, ib) in enumerate(pairs):
+            delta = 1.0 if ia == ib else 0.0
+            ssum[ip,:] = cnt + (ssum[ip,:] - delta*cnt) \
+                / np.sqrt(conc[ia] * conc[ib])
+    pairs = [(symbols_unique[ia], symbols_unique[ib]) for ia,ib in pairs]
+    return qsum, ssum, cnt, pairs
+
+
+def sq_direct(traj, qmax, dq=0.05, tmask=None, partial=False, maxmem=2.0):
+    """Structure factor by direct summation over reciprocal lattice vectors G
+    of the cell, averaged over shells of ``|G|`` and time steps::
+
+        S(G) = 1/N |sum_j exp(i G . r_j)|**2
+        S_ab(G) = 1 + (S_ab^AL(G) - delta_ab) / sqrt(c_a*c_b)
+        S_ab^AL(G) = 1/sqrt(N_a*N_b) Re[rho_a(G) rho_b(G)^*]
+        rho_a(G) = sum_{j in a} exp(i G . r_j)
+
+    with ``c_a = N_a/N``. The partials S_ab are of the Faber-Ziman type (same
+    as :func:`sq_from_rpdf` with partial g(r)), converted from the
+    Ashcroft-Langreth partials S_ab^AL.
+
+    Handles variable-cell trajectories: ``exp(i G . r) = exp(2*pi*i h . s)``
+    with Miller indices h and fractional coords s, only the shell assignment
+    by ``|G|`` depends on the cell of each step.
+
+    Parameters
+    ----------
+    traj : Structure or Trajectory
+    qmax : float
+        Max. ``|G|``, unit is 1/(length unit of `cell`), e.g. 1/Angstrom.
+    dq : float
+        Shell width.
+    tmask : None or slice object, optional
+        Time mask, see :func:`~pwtools.crys.rpdf`.
+    partial : bool
+        Calculate partial structure factors for all pairs of
+        ``traj.symbols_unique`` (as in :func:`~pwtools.crys.rpdf_partial`).
+    maxmem : float
+        Maximal memory for temporary arrays in GB. G vectors (also the
+        Miller indices and ``|G|``) and time steps are processed in blocks
+        which fit into `maxmem`.
+
+    Returns
+    -------
+    q, sq : if partial=False
+    q, sq, pairs : if partial=True
+    q : 1d array (nq,)
+        Mean ``|G|`` of each non-empty shell.
+    sq : array (nq,) or (npairs, nq)
+    pairs : list of tuples (npairs,)
+        Symbol pairs, e.g. ``[('Al','Al'), ('Al','N'), ('N','N')]``.
+
+    Notes
+    -----
+    The smallest accessible q is ``2*pi/L`` for a cell of length L, so large
+    cells (supercells) are needed for a dense q grid. The cost is
+    ``nstep*natoms*nG``, where nG grows like ``qmax**3 * volume``.
+    """
+    qsum, ssum, cnt, pairs = _qshell_sums(traj, qmax=qmax, dq=dq,
+                                          tmask=tmask, partial=partial,
+                                          maxmem=maxmem)
+    msk = cnt > 0
+    q = qsum[msk] / cnt[msk]
+    sq = ssum[...,msk] / cnt[msk]
+    if partial:
+        return q, sq, pairs
+    else:
+        return q, sq
@@ -10,3 +10,25 @@ def test_acorr():
             np.testing.assert_array_almost_equal(acorr(arr, method=m, 
                                                        norm=norm), 
                                                  ref)    
+            # list input
+            np.testing.assert_array_almost_equal(acorr(list(arr), method=m,
+                                                       norm=norm),
+                                                 ref)
+
+
+def test_acorr_nd():
+    arr = np.random.rand(30,4,3)
+    for norm in [True, False]:
+        for axis in [0,1,2]:
+            c = acorr(arr, norm=norm, axis=axis)
+            assert c.shape == arr.shape
+            # reference: loop over all 1d arrays along `axis`
+            arr2 = np.moveaxis(arr, axis, -1)
+            ref = np.empty_like(arr2)
+            for idx in np.ndindex(arr2.shape[:-1]):
+                ref[idx] = acorr(arr2[idx], method=1, norm=norm)
+            assert np.allclose(c, np.moveaxis(ref, -1, axis))
+            out = np.empty_like(arr)
+            ret = acorr(arr, norm=norm, axis=axis, out=out)
+            assert ret is out
+            assert np.allclose(out, c)
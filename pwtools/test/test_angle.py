@@ -60,3 +60,42 @@ def test_angle():
             assert (agf - 180.0 < eps).any(), "no 180 degree cases"
             assert (agf >= 0.0).all(), "negative angles"
 
+
+
+def test_bond_angle_distribution():
+    # compare with all angles from crys.angles(), selecting neighbor triplets
+    # by hand
+    symbols = ['Si']*4 + ['O']*8
+    natoms = len(symbols)
+    nstep = 3
+    cutoff = 3.0
+    nbins = 90
+    traj = crys.Trajectory(coords_frac=np.random.rand(nstep,natoms,3),
+                           cell=np.identity(3)*5,
+                           symbols=symbols)
+    for pbc in [True, False]:
+        ang, bad, triplets = crys.bond_angle_distribution(traj, cutoff=cutoff,
+                                                          nbins=nbins, pbc=pbc)
+        assert triplets == [('O','O','O'), ('O','O','Si'), ('O','Si','Si'),
+                            ('Si','O','O'), ('Si','O','Si'), ('Si','Si','Si')]
+        assert bad.shape == (len(triplets), nbins)
+        assert np.allclose(ang[[0,-1]], [1.0, 179.0])
+        ref = np.zeros_like(bad)
+        sy = np.array(symbols)
+        for st in traj:
+            dists = crys.distances(st, pbc=pbc)
+            anglesijk = crys.angles(st, pbc=pbc)
+            for ii,jj,kk in permutations(range(natoms),3):
+                if (jj < kk) and (dists[ii,jj] < cutoff) and \
+                   (dists[ii,kk] < cutoff):
+                    trip = (sy[ii],) + tuple(sorted([sy[jj], sy[kk]]))
+                    ibin = min(int(anglesijk[ii,jj,kk] / 180.0 * nbins),
+                               nbins-1)
+                    ref[triplets.index(trip), ibin] += 1
+        assert np.allclose(bad, ref / nstep)
+        ang, badn, triplets = crys.bond_angle_distribution(traj, cutoff=cutoff,
+                                                           nbins=nbins, pbc=pbc,
+                                                           norm=True)
+        for bb in badn:
+            if bb.sum() > 0:
+                assert np.allclose(bb.sum() * 2.0, 1.0)
@@ -0,0 +1,132 @@
+import numpy as np
+from pwtools import correlation, signal, constants
+rand = np.random.rand
+
+
+def ccorr_loop(x, y):
+    nstep = x.shape[0]
+    c = np.zeros_like(x)
+    for t in range(nstep):
+        c[t,...] = (x[:nstep-t,...] * y[t:,...]).sum(axis=0) / (nstep - t)
+    return c
+
+
+def test_ccorr():
+    for shape in [(50,), (51,3), (40,4,3)]:
+        x = rand(*shape)
+        y = rand(*shape)
+        for tonext in [True, False]:
+            c = correlation.ccorr(x, y, tonext=tonext)
+            assert c.shape == shape
+            assert np.allclose(c, ccorr_loop(x, y))
+            # C_xy(-t) = C_yx(t)
+            assert np.allclose(correlation.ccorr(y, x, tonext=tonext),
+                               ccorr_loop(y, x))
+            assert np.allclose(correlation.acorr(x, tonext=tonext),
+                               ccorr_loop(x, x))
+    x = rand(100)
+    assert np.allclose(correlation.acorr(x, unbiased=False),
+                       signal.acorr(x, norm=False))
+    assert np.allclose(correlation.acorr(x, unbiased=False, norm=True),
+                       signal.acorr(x, norm=True))
+
+
+def test_block_ccorr():
+    x = rand(103,2)
+    c, err = correlation.block_ccorr(x, nblocks=5)
+    assert c.shape == err.shape == (20,2)
+    ref = np.array([ccorr_loop(x[ii*20:(ii+1)*20], x[ii*20:(ii+1)*20])
+                    for ii in range(5)])
+    assert np.allclose(c, ref.mean(axis=0))
+    assert np.allclose(err, ref.std(axis=0, ddof=1) / np.sqrt(5))
+    c, err = correlation.block_ccorr(x, nblocks=1)
+    assert np.allclose(c, ccorr_loop(x[:103], x[:103]))
+    assert (err == 0).all()
+
+
+def test_green_kubo():
+    # int_0^t exp(-t'/tau) dt' = tau*(1-exp(-t/tau))
+    dt = 0.01
+    tau = 2.0
+    t = np.arange(2000) * dt
+    c = np.exp(-t/tau)
+    gk = correlation.green_kubo(c, dt=dt, prefactor=3.0)
+    assert gk[0] == 0.0
+    assert np.allclose(gk, 3.0*tau*(1 - np.exp(-t/tau)), rtol=1e-4)
+    gk2 = correlation.green_kubo(np.array([c, 2*c]).T, dt=dt)
+    assert np.allclose(gk2[:,1], 2*gk2[:,0])
+
+
+def test_stress_acf():
+    nstep = 60
+    stress = rand(nstep,3,3)
+    c = correlation.stress_acf(stress)
+    sym = 0.5*(stress + stress.transpose(0,2,1))
+    sym -= np.trace(stress, axis1=1, axis2=2)[:,None,None]/3.0 * np.identity(3)
+    ref = np.zeros((nstep,))
+    for ii in range(3):
+        for jj in range(3):
+            ref += ccorr_loop(sym[:,ii,jj], sym[:,ii,jj])
+    assert np.allclose(c, ref/10.0)
+    # pure shear xy: C = <s_xy(0) s_xy(t)>
+    stress = np.zeros((nstep,3,3))
+    stress[:,0,1] = stress[:,1,0] = rand(nstep)
+    assert np.allclose(correlation.stress_acf(stress),
+                       0.2*ccorr_loop(stress[:,0,1], stress[:,0,1]))
+    c, err = correlation.stress_acf(stress, nblocks=3)
+    assert c.shape == err.shape == (20,)
+    eta = correlation.viscosity(stress, volume=100.0, temperature=300.0,
+                                dt=2.0)
+    pre = 100.0*constants.Angstrom**3 / constants.kb / 300.0 * \
+          constants.GPa**2 * constants.fs
+    assert np.allclose(eta, correlation.green_kubo(
+        correlation.stress_acf(stress), dt=2.0, prefactor=pre))
+    eta, err = correlation.viscosity(stress, volume=100.0,
+                                     temperature=300.0, dt=2.0, nblocks=3)
+    assert eta.shape == err.shape == (20,)
+
+
+def msd_loop(coords):
+    nstep = coords.shape[0]
+    out = np.zeros(coords.shape[:2])
+    for t in range(nstep):
+        out[t,:] = ((coords[t:,...] - coords[:nstep-t,...])**2.0).sum(axis=2).mean(axis=0)
+    return out
+
+
+def test_msd():
+    from pwtools import crys
+    nstep, natoms = 80, 5
+    # random walk
+    coords = np.cumsum(rand(nstep, natoms, 3) - 0.5, axis=0) + 10.0
+    ref = msd_loop(coords)
+    # blocks of 1 atom
+    for maxmem in [1.0, 1e-9]:
+        assert np.allclose(correlation.msd(coords, maxmem=maxmem), ref)
+    symbols = ['Al', 'N', 'Al', 'N', 'N']
+    traj = crys.Trajectory(coords=coords, symbols=symbols,
+                           cell=np.identity(3)*20)
+    mm = correlation.msd_species(traj)
+    assert mm.shape == (2, nstep)
+    assert np.allclose(mm[0], ref[:,[0,2]].mean(axis=1))
+    assert np.allclose(mm[1], ref[:,[1,3,4]].mean(axis=1))
+
+
+def test_diffusion():
+    dt = 0.5
+    t = np.arange(200) * dt
+    # MSD = 6*D*t + b
+    D = 0.3
+    mm = 6*D*t + 1.0
+    d, err = correlation.diffusion(mm, dt=dt)
+    assert np.allclose(d, D)
+    assert err < 1e-10
+    d, err = correlation.diffusion(mm, dt=dt, ndim=2, tmin=10, tmax=20)
+    assert np.allclose(d, 1.5*D)
+    mm2 = np.array([6*D*t, 6*2*D*t]).T
+    d, err = correlation.diffusion(mm2, dt=dt)
+    assert np.allclose(d, 1.5*D)
+    assert np.allclose(err, np.std([D, 2*D], ddof=1) / np.sqrt(2))
+    mm = 6*D*t + rand(len(t))
+    d, err = correlation.diffusion(mm, dt=dt)
+    assert abs(d - D) < 5*err
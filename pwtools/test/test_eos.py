@@ -142,3 +142,71 @@ def test_eos_fit_deriv():
     assert np.allclose(eos(xx, der=2), spl(xx, der=2)) # call _vinet_deriv2
     assert np.allclose(eos(xx, der=3), spl(xx, der=3)) # call eos.spl(xx, der=3)
 
+
+
+def test_eos_fit_batch():
+    from pwtools.eos import EosFitBatch, Vinet
+    data = np.loadtxt("files/ev/evdata.txt")
+    volume = data[:,0] * Bohr3_to_Ang3
+    energy = data[:,1] * (Ry / eV)
+    rnd = np.random.RandomState(42)
+    nc = 20
+    # random Vinet curves on the same volume grid + noise
+    params = dict(e0=rnd.uniform(-20,-5,nc), b0=rnd.uniform(0.3,1.0,nc),
+                  b1=rnd.uniform(3,6,nc), v0=rnd.uniform(37,43,nc))
+    vv = np.linspace(30, 50, 15)
+    ee = Vinet()(vv[None,:], dict((k,v[:,None]) for k,v in params.items()))
+    ee += rnd.randn(*ee.shape) * 1e-3
+    for vol, ene in [(vv, ee), (volume, energy[None,:]),
+                     (np.array([volume]*3), np.array([energy]*3))]:
+        fb = EosFitBatch(vol, ene)
+        assert fb.converged.all()
+        vol2d = np.broadcast_to(vol, ene.shape)
+        for ii in range(ene.shape[0]):
+            ref = EosFit(vol2d[ii], ene[ii])
+            for key in ['e0', 'b0', 'b1', 'v0']:
+                assert np.allclose(fb.params[key][ii], ref.params[key],
+                                   rtol=1e-6, atol=0)
+        assert fb(vol).shape == ene.shape
+        v0 = fb.params['v0']
+        assert np.allclose(fb.pressure(v0[:,None]), 0.0, atol=1e-8)
+        assert np.allclose(fb.bulkmod(v0[:,None])[:,0],
+                           fb.params['b0'] * eV_by_Ang3_to_GPa)
+    # flat curve: no minimum, flagged, no exception
+    ee[0,:] = 1.0
+    fb = EosFitBatch(vv, ee)
+    assert not fb.converged[0]
+    assert fb.converged[1:].all()
+
+
+def test_eos_models():
+    from pwtools import eos
+    params = dict(e0=-10.0, b0=0.6, b1=4.3, v0=40.0)
+    vv = np.linspace(32, 50, 15)
+    h = 1e-4
+    for etype, cls in eos.ELK_ETYPE_FUNC.items():
+        func = cls()
+        # analytic derivatives
+        for der in [1,2]:
+            dnum = (func(vv+h, params, der=der-1) -
+                    func(vv-h, params, der=der-1)) / (2*h)
+            assert np.allclose(func(vv, params, der=der), dnum, atol=1e-8)
+        # E0, P(V0) = 0, B(V0) = B0, dB/dP(V0) = B1
+        v0 = params['v0']
+        assert np.allclose(func(v0, params), params['e0'])
+        assert np.allclose(func(v0, params, der=1), 0.0)
+        assert np.allclose(v0 * func(v0, params, der=2), params['b0'])
+        bfunc = lambda v: v * func(v, params, der=2)
+        pfunc = lambda v: -func(v, params, der=1)
+        assert np.allclose((bfunc(v0+h) - bfunc(v0-h)) /
+                           (pfunc(v0+h) - pfunc(v0-h)), params['b1'])
+        # fit recovers params, in-process and batch
+        ee = func(vv, params)
+        fit = EosFit(vv, ee, func=func)
+        fb = eos.EosFitBatch(vv, np.array([ee]*2), func=func)
+        assert fb.converged.all()
+        for key,val in params.items():
+            assert np.allclose(fit.params[key], val, rtol=1e-5)
+            assert np.allclose(fb.params[key], val, rtol=1e-5)
+        assert np.allclose(fit.pressure(vv),
+                           -func(vv, params, der=1) * eV_by_Ang3_to_GPa)
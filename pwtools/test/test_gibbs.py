@@ -64,8 +64,9 @@ import copy, os
 from itertools import product
 from pwtools.thermo import Gibbs
 from pwtools.signal import gauss
-from pwtools import num, crys, io, constants
+from pwtools import num, crys, io, constants, thermo
 from pwtools.test import tools
+from pwtools.test.testenv import testdir
 
 
 def compare_dicts_with_arrays(a, b):
@@ -160,3 +161,192 @@ def test_gibbs():
                        ev(g['/#opt/P/V']) + g['/P/P']*g['/#opt/P/V'] / \
                        constants.eV_by_Ang3_to_GPa)
 
+
+
+def get_gibbs_2d(T, P):
+    freq = np.linspace(0,1000,300)
+    nax = 6
+    # 2d case, see test_gibbs()
+    cell_a = np.linspace(2.5,3.5,nax)
+    cell_c = np.linspace(3,3.8,nax)
+    volfunc_ax = lambda x: x[0]**2 * x[1]
+    axes_flat = np.array([x for x in product(cell_a, cell_c)])
+    V = np.array([volfunc_ax(x) for x in axes_flat])
+    etot = np.array([(a-cell_a.mean())**2.0 + (c-cell_c.mean())**2.0 for a,c
+                     in axes_flat])
+    phdos = [np.array([freq,gauss(freq-(550-50*vv/V.max()),100)*0.01]).T for
+             vv in V]
+    gibbs = Gibbs(T=T, P=P, etot=etot, phdos=phdos, axes_flat=axes_flat,
+                  volfunc_ax=volfunc_ax, case='2d', dosarea=None)
+    gibbs.set_fitfunc('C', lambda x,y: num.Spline(x,y,s=None,k=5, eps=1e-5))
+    return gibbs
+
+
+def test_gibbs_nprocs_warm_start():
+    T = np.linspace(5, 2000, 20)
+    P = np.linspace(0,5,3)
+    gibbs = get_gibbs_2d(T, P)
+    gref = gibbs.calc_G(calc_all=True)
+    for kwds in [dict(nprocs=2), dict(warm_start=True),
+                 dict(nprocs=3, warm_start=True)]:
+        g = gibbs.calc_G(calc_all=True, **kwds)
+        assert set(g.keys()) == set(gref.keys())
+        for name in ['ax0', 'ax1', 'V', 'G']:
+            key = '/#opt/T/P/%s' %name
+            assert g[key].shape == (len(T), len(P))
+            assert np.allclose(g[key], gref[key], atol=1e-7, rtol=1e-7)
+    # non-default fit function: no batch fitting, same result
+    gibbs.set_fitfunc('2d-G', lambda x,y: num.PolyFit(x, y, deg=5,
+                                                      scale=True))
+    g = gibbs.calc_G(calc_all=True, nprocs=2)
+    assert np.allclose(g['/#opt/T/P/G'], gref['/#opt/T/P/G'])
+    # worker state only in the workers
+    assert thermo._GIBBS_WORKER_ARGS is None
+    # no fork: serial
+    import multiprocessing, warnings
+    get_all_start_methods = multiprocessing.get_all_start_methods
+    try:
+        multiprocessing.get_all_start_methods = lambda: ['spawn']
+        with warnings.catch_warnings(record=True) as wrn:
+            warnings.simplefilter('always')
+            g = gibbs.calc_G(calc_all=True, nprocs=2)
+        assert any("nprocs=1" in str(ww.message) for ww in wrn)
+    finally:
+        multiprocessing.get_all_start_methods = get_all_start_methods
+    assert np.allclose(g['/#opt/T/P/G'], gref['/#opt/T/P/G'])
+
+
+def test_gibbs_h5():
+    T = np.linspace(5, 2000, 20)
+    P = np.linspace(0,5,3)
+    gibbs = get_gibbs_2d(T, P)
+    gref = gibbs.calc_G(calc_all=True)
+    gkey = '/T/P/ax0-ax1/G'
+    # maxmem: G of 3 T points per block -> 7 blocks
+    maxmem = 3 * len(P) * gibbs.npoints * 8 / 1e9
+    for nprocs in [1,2]:
+        h5fn = os.path.join(testdir, 'test_gibbs_%i.h5' %nprocs)
+        if os.path.exists(h5fn):
+            os.remove(h5fn)
+        g = gibbs.calc_G(calc_all=True, h5file=h5fn, maxmem=maxmem,
+                         nprocs=nprocs)
+        assert set(g.keys()) == set(gref.keys())
+        assert g[gkey].shape == gref[gkey].shape
+        assert g[gkey].chunks[0] < len(T)
+        assert np.allclose(g[gkey][2,1,:], gref[gkey][2,1,:])
+        gh5 = io.read_h5(h5fn)
+        assert gh5['/#calc_G/tdone'].all()
+        for dct in [g, gh5]:
+            tools.assert_dict_with_all_types_almost_equal(
+                gref, dct, keys=[k for k,v in gref.items() if k != gkey and
+                                 v is not None],
+                atol=1e-8, rtol=1e-8)
+        assert np.allclose(gh5[gkey], gref[gkey])
+    # resume: fake unfinished blocks
+    import h5py
+    with h5py.File(h5fn, mode='a') as fh:
+        fh['/#calc_G/tdone'][4:10] = False
+        fh['/#opt/T/P/G'][4:10,:] = 0.0
+        fh[gkey][4:10,...] = 0.0
+    g = gibbs.calc_G(calc_all=True, h5file=h5fn, maxmem=maxmem)
+    gh5 = io.read_h5(h5fn, lazy=True)
+    assert isinstance(gh5[gkey], io.H5LazyDataset)
+    assert np.allclose(gh5[gkey][()], gref[gkey])
+    assert np.allclose(gh5['/#opt/T/P/G'][()], gref['/#opt/T/P/G'])
+    assert np.allclose(g['/#opt/T/P/Cp'], gref['/#opt/T/P/Cp'])
+    # calc_G twice on the same file, the G dataset of the first call doesn't
+    # keep the file open
+    h5fn = os.path.join(testdir, 'test_gibbs_twice.h5')
+    if os.path.exists(h5fn):
+        os.remove(h5fn)
+    g = gibbs.calc_G(calc_all=True, h5file=h5fn, maxmem=maxmem)
+    g2 = gibbs.calc_G(calc_all=True, h5file=h5fn, maxmem=maxmem)
+    assert np.allclose(g[gkey][()], gref[gkey])
+    assert np.allclose(np.asarray(g2[gkey]), gref[gkey])
+    # resume a calc_all=False file with calc_all=True: /#opt/T/P/* of the
+    # finished T blocks are missing
+    h5fn = os.path.join(testdir, 'test_gibbs_calc_all.h5')
+    if os.path.exists(h5fn):
+        os.remove(h5fn)
+    g = gibbs.calc_G(calc_all=False, h5file=h5fn, maxmem=maxmem)
+    try:
+        gibbs.calc_G(calc_all=True, h5file=h5fn, maxmem=maxmem)
+        raise Exception("resume with different calc_all not detected")
+    except AssertionError:
+        pass
+    # other inputs: refuse to reuse the results in the file
+    gibbs2 = get_gibbs_2d(T, P)
+    gibbs2.etot = gibbs2.etot * 1.1
+    gibbs3 = get_gibbs_2d(T, P)
+    gibbs3.set_fitfunc('2d-G', lambda x,y: num.PolyFit(x, y, deg=4,
+                                                      scale=True))
+    for gg in [gibbs2, gibbs3]:
+        try:
+            gg.calc_G(calc_all=False, h5file=h5fn, maxmem=maxmem)
+            raise Exception("resume with different inputs not detected")
+        except AssertionError:
+            pass
+    # derived results (not streamed) are overwritten
+    h5fn = os.path.join(testdir, 'test_gibbs_1.h5')
+    with h5py.File(h5fn, mode='a') as fh:
+        fh['/#opt/T/P/Cp'][...] = 0.0
+    g = gibbs.calc_G(calc_all=True, h5file=h5fn, maxmem=maxmem)
+    assert np.allclose(io.read_h5(h5fn)['/#opt/T/P/Cp'], gref['/#opt/T/P/Cp'])
+
+
+def test_gibbs_phfreq():
+    from pwtools.thermo import harmonic_thermo_qpoints
+    T = np.linspace(5, 2000, 30)
+    P = np.linspace(0,5,2)
+    nax = 6
+    V = np.linspace(10,20,nax)
+    axes_flat = V**(1/3.)
+    volfunc_ax = lambda x: x[0]**3.0
+    etot = (V-V.mean())**2
+    rnd = np.random.RandomState(1)
+    freqs0 = rnd.rand(20, 6) * 500 + 50
+    freqs0[0,:3] = 0.0
+    qw = rnd.rand(20)
+    # lower freqs for higher volume
+    phfreq = [freqs0 * (1.2 - 0.4*(vv - V.min()) / (V.max() - V.min())) for
+              vv in V]
+    gibbs = Gibbs(T=T, P=P, etot=etot, phfreq=phfreq,
+                  qweights=[qw]*nax, axes_flat=axes_flat,
+                  volfunc_ax=volfunc_ax, case='1d')
+    g = gibbs.calc_G(calc_all=True)
+    for idx in [0, nax-1]:
+        fvib, evib, svib, cv = harmonic_thermo_qpoints(phfreq[idx], T,
+                                                       weights=qw)
+        assert np.allclose(g['/ax0/T/Fvib'][idx,:], fvib)
+        assert np.allclose(g['/ax0/T/Cv'][idx,:], cv)
+        assert np.allclose(g['/ax0/T/F'][idx,:], etot[idx] + fvib)
+    assert np.isfinite(g['/#opt/T/P/V']).all()
+    # thermal expansion
+    assert (np.diff(g['/#opt/T/P/V'][:,0]) > 0).all()
+
+
+def test_gibbs_few_points():
+    # 1d case with 5 volumes < deg+1 = 6 poly coeffs of the default G fit
+    T = np.linspace(5, 2000, 20)
+    P = np.linspace(0,5,2)
+    freq = np.linspace(0,1000,300)
+    V = np.linspace(10,20,5)
+    axes_flat = V**(1/3.)
+    etot = (V-V.mean())**2
+    fcenter = 450 + 100*(axes_flat - axes_flat.min())
+    phdos = [np.array([freq,gauss(freq-fc, 100)]).T for fc in
+             fcenter[::-1]]
+    kwds = dict(T=T, P=P, etot=etot, phdos=phdos, axes_flat=axes_flat,
+                volfunc_ax=lambda x: x[0]**3.0, case='1d', dosarea=None)
+    gibbs = Gibbs(**kwds)
+    gibbs.set_fitfunc('C', lambda x,y: num.Spline(x,y,s=None,k=5, eps=1e-5))
+    g = gibbs.calc_G(calc_all=True)
+    assert gibbs.fit_basis.method == 'svd'
+    assert np.isfinite(g['/#opt/T/P/V']).all()
+    # same as fitting each G(V) with the fit function
+    gibbs = Gibbs(**kwds)
+    gibbs.set_fitfunc('C', lambda x,y: num.Spline(x,y,s=None,k=5, eps=1e-5))
+    gibbs.set_fitfunc('1d-G', lambda x,y: num.PolyFit1D(x, y, deg=5,
+                                                        scale=True))
+    gref = gibbs.calc_G(calc_all=True)
+    assert np.allclose(g['/#opt/T/P/V'], gref['/#opt/T/P/V'])
@@ -49,5 +49,15 @@ def test_h5():
         read_dct3 = io.read_h5(h5fn)
         assert np.sort(np.array(list(read_dct3.keys()))).tolist() == ['/b', '/c']
 
+        # lazy: read slices, file not kept open, can be written in between
+        h5fn = os.path.join(testdir, 'test_lazy.h5')
+        arr = rand(4,5)
+        io.write_h5(h5fn, {'/a/x': arr}, mode='w')
+        lazy = io.read_h5(h5fn, lazy=True)
+        assert lazy['/a/x'].shape == (4,5)
+        assert np.allclose(lazy['/a/x'][1,:], arr[1,:])
+        io.write_h5(h5fn, {'/b': 1.0}, mode='a')
+        assert np.allclose(np.asarray(lazy['/a/x']), arr)
+
     except ImportError:
         tools.skip("skipping test_h5, no h5py importable")
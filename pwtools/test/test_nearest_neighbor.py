@@ -53,3 +53,79 @@ def test_nn():
     d=nearest_neighbors(struct, idx=3, num=2, skip=['O','Cl'], fullout=True)[1] 
     np.allclose(d, np.array([1.98,3.0]))
     
+
+
+def test_coordination_numbers():
+    from pwtools import crys
+    symbols = ['Si']*10 + ['O']*20
+    natoms = len(symbols)
+    nstep = 5
+    cell = np.identity(3)[None,...] * np.linspace(5, 6, nstep)[:,None,None]
+    traj = crys.Trajectory(coords_frac=np.random.rand(nstep,natoms,3),
+                           cell=cell,
+                           symbols=symbols)
+    cutoff = 2.5
+    for pbc in [True, False]:
+        cn = crys.coordination_numbers(traj, cutoff=cutoff, pbc=pbc)
+        assert cn.shape == (nstep, natoms)
+        # maxnb=1 triggers the re-run w/ maxnb=cn.max()
+        cn2, nblst = crys.coordination_numbers(traj, cutoff=cutoff, pbc=pbc,
+                                               neighbors=True, maxnb=1)
+        assert (cn == cn2).all()
+        assert nblst.shape == (nstep, natoms, cn.max())
+        for istep, st in enumerate(traj):
+            for ii in range(natoms):
+                ref = nearest_neighbors(st, idx=ii, cutoff=cutoff, pbc=pbc,
+                                        sort=False)
+                assert cn[istep,ii] == len(ref)
+                assert aequal(nblst[istep,ii,:cn[istep,ii]], ref)
+                assert (nblst[istep,ii,cn[istep,ii]:] == -1).all()
+    cn = crys.coordination_numbers(traj[0], cutoff=cutoff)
+    assert cn.shape == (1, natoms)
+
+
+def test_periodic_kdtree():
+    from pwtools import crys
+    symbols = ['Si']*10 + ['O']*20 + ['H']*10
+    natoms = len(symbols)
+    # orthorhombic, where min_image_convention() used by the dense path is
+    # exact
+    struct = crys.Structure(coords_frac=np.random.rand(natoms,3),
+                            cell=np.diag([5.0, 6.0, 7.0]),
+                            symbols=symbols)
+    for pbc in [True, False]:
+        # num=5 with skip can reach beyond the default rmax
+        tree = crys.PeriodicKDTree(struct, pbc=pbc, rmax=5.0)
+        for idx in range(natoms):
+            for kwds in [dict(num=5), dict(num=5, skip='O'),
+                         dict(cutoff=2.4), dict(cutoff=2.4, skip=['H','Si']),
+                         dict(num=4, sort=False)]:
+                ref_idx, ref_dist = nearest_neighbors(struct, idx=idx,
+                                                      pbc=pbc, fullout=True,
+                                                      **kwds)
+                nn_idx, nn_dist = nearest_neighbors(struct, idx=idx,
+                                                    pbc=pbc, fullout=True,
+                                                    tree=tree, **kwds)
+                assert aequal(nn_idx, ref_idx)
+                assert np.allclose(nn_dist, ref_dist)
+        # many atoms at once
+        idx = np.arange(natoms)
+        nn_idx, nn_dist = tree.query(idx, k=3)
+        assert nn_idx.shape == nn_dist.shape == (natoms, 3)
+        nn_idx_lst, nn_dist_lst = tree.query_radius(idx, cutoff=2.0)
+        assert len(nn_idx_lst) == natoms
+        for ii in idx:
+            ref = nearest_neighbors(struct, idx=ii, num=3, pbc=pbc)
+            assert aequal(nn_idx[ii,:], ref)
+            ref = nearest_neighbors(struct, idx=ii, cutoff=2.0, pbc=pbc)
+            assert aequal(nn_idx_lst[ii], ref)
+    # distances beyond rmax are refused
+    tree = crys.PeriodicKDTree(struct)
+    try:
+        tree.query_radius(0, cutoff=3.0)
+        raise AssertionError("no ValueError for cutoff > rmax")
+    except ValueError:
+        pass
+    tree = crys.PeriodicKDTree(struct, rmax=3.0)
+    assert aequal(tree.query_radius(0, cutoff=3.0)[0],
+                  nearest_neighbors(struct, idx=0, cutoff=3.0))
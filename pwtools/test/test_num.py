@@ -41,3 +41,18 @@ def test_euler_matrix():
         rot = num.euler_matrix(0, 0, ri*2*np.pi)
         assert (np.dot(rot,vec) == vec).all()
 
+
+
+def test_block_size():
+    assert num.block_size(100, 1e9, 2.0) == 2
+    assert num.block_size(100, 1e12, 2.0) == 1
+    assert num.block_size(100, 1.0, 2.0) == 100
+
+
+def test_rfft():
+    x = np.random.rand(30, 4)
+    for nthreads in [None, 1, 2]:
+        ff = num.rfft(x, n=64, axis=0, nthreads=nthreads)
+        assert np.allclose(ff, np.fft.rfft(x, n=64, axis=0))
+        assert np.allclose(num.irfft(ff, n=64, axis=0,
+                                     nthreads=nthreads)[:30,:], x)
@@ -56,3 +56,32 @@ def test_pbc_wrap():
 
     tr_wrap = crys.pbc_wrap(tr, mask=[True,True,False], xyz_axis=-1)                      
     assert np.allclose(tr.coords_frac[...,2], tr_wrap.coords_frac[...,2])
+
+
+def test_unwrap():
+    from pwtools import crys
+    nstep, natoms = 100, 4
+    # random walk, steps < half a cell
+    steps = (np.random.rand(nstep, natoms, 3) - 0.5) * 0.3
+    steps[0,...] = 0.0
+    cf = np.random.rand(natoms, 3)[None,...] + np.cumsum(steps, axis=0)
+    wrapped = crys.pbc_wrap_coords(cf)
+    unwrapped = crys.unwrap_coords(wrapped)
+    # continuous up to the integer shift of the first frame
+    assert np.allclose(unwrapped - cf, np.round(unwrapped - cf))
+    assert np.allclose(unwrapped - unwrapped[0,...], cf - cf[0,...])
+    # chunks of 1 step, output array, in-place
+    out = np.empty_like(wrapped)
+    crys.unwrap_coords(wrapped, out=out, maxmem=1e-9)
+    assert np.allclose(out, unwrapped)
+    tmp = wrapped.copy()
+    crys.unwrap_coords(tmp, out=tmp, maxmem=1e-9)
+    assert np.allclose(tmp, unwrapped)
+    # variable cell
+    cell = np.identity(3)[None,...] * np.linspace(4, 5, nstep)[:,None,None]
+    traj = crys.Trajectory(coords_frac=wrapped, cell=cell,
+                           symbols=['H']*natoms)
+    tr = crys.unwrap(traj)
+    assert np.allclose(tr.coords_frac, unwrapped)
+    assert np.allclose(tr.coords, np.matmul(unwrapped, cell))
+    assert np.allclose(traj.coords_frac, wrapped)
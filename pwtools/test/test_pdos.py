@@ -89,3 +89,70 @@ def test_pdos_1d():
     p2=(abs(fft(mirror(acorr(v*w,norm=False)))))[:n]
     assert np.allclose(p1, p2)
 
+
+
+def test_welch_pdos():
+    nstep, natoms = 400, 4
+    vel = rand(nstep, natoms, 3)
+    mass = rand(natoms) + 1.0
+    # one segment = pdos(method='direct')
+    fd, dd = pd.direct_pdos(vel, m=mass, npad=1)
+    fw, dw, var, nseg = pd.welch_pdos(vel, m=mass, seglen=nstep, npad=1,
+                                      full_out=True)
+    assert nseg == 1
+    assert np.allclose(fd, fw)
+    assert np.allclose(dd, dw)
+    assert (var == 0.0).all()
+    # segments, 50% overlap
+    fw, dw, var, nseg = pd.welch_pdos(vel, m=mass, seglen=100, dt=2.0,
+                                      full_out=True)
+    assert nseg == 7
+    assert len(fw) == len(dw) == len(var) == 50
+    assert np.allclose(fw, np.fft.fftfreq(100, 2.0)[:50])
+    assert (var >= 0).all()
+    # reference: mean and variance of the single-segment spectra with the
+    # same normalization
+    win = welch(100)[:,None,None]
+    spec = np.array([(np.abs(fft(vel[ii:ii+100,...]*win, axis=0))**2.0 *
+                      mass[None,:,None]).sum(axis=(1,2))[:50]
+                     for ii in range(0, 301, 50)])
+    scale = dw.sum() / spec.mean(axis=0).sum()
+    assert np.allclose(dw, spec.mean(axis=0) * scale)
+    assert np.allclose(var, spec.var(axis=0, ddof=1) * scale**2)
+    # on-disk array, only segments are read
+    fn = os.path.join(testdir, 'welch_pdos_vel.dat')
+    mm = np.memmap(fn, dtype=float, mode='w+', shape=vel.shape)
+    mm[...] = vel
+    mm.flush()
+    mm = np.memmap(fn, dtype=float, mode='r', shape=vel.shape)
+    fm, dm = pd.welch_pdos(mm, m=mass, seglen=100, dt=2.0)
+    assert np.allclose(dm, dw)
+
+
+def test_projected_pdos():
+    nstep, natoms = 300, 6
+    vel = rand(nstep, natoms, 3)
+    mass = rand(natoms) + 1.0
+    symbols = np.array(['Al', 'N', 'N', 'Al', 'N', 'O'])
+    groups = [symbols == sym for sym in ['Al', 'N', 'O']]
+    for npad, tonext in [(None, False), (1, False), (1, True)]:
+        fd, dd = pd.pdos(vel, m=mass, dt=2.0, npad=npad, tonext=tonext)
+        # blocks of 1 atom
+        for maxmem in [1.0, 1e-9]:
+            fp, dp, dt = pd.projected_pdos(vel, groups, m=mass, dt=2.0,
+                                           npad=npad, tonext=tonext,
+                                           full_out=True, maxmem=maxmem)
+            assert dp.shape == (3, len(fd))
+            assert np.allclose(fp, fd)
+            assert np.allclose(dt, dd)
+            assert np.allclose(dp.sum(axis=0), dd)
+            # same shape as pdos of the group alone
+            for grp, dgrp in zip(groups, dp):
+                ref = pd.pdos(vel[:,grp,:], m=mass[grp], dt=2.0, npad=npad,
+                              tonext=tonext)[1]
+                assert np.allclose(dgrp / dgrp.sum(), ref / ref.sum())
+    # index arrays
+    dp2 = pd.projected_pdos(vel, [np.where(g)[0] for g in groups], m=mass,
+                            dt=2.0)[1]
+    dp = pd.projected_pdos(vel, groups, m=mass, dt=2.0)[1]
+    assert np.allclose(dp, dp2)
@@ -155,3 +155,55 @@ def test_api():
     assert type(f(f.get_min())) == type(np.array([1.0])[0])
     f = num.PolyFit1D(x, y, deg=2)
     assert type(f.get_min()) == type(1.0)
+
+
+def test_multi_rhs():
+    points = np.random.rand(50, 2)
+    values = np.array([np.sin(points[:,0]) * (ii+1) + points[:,1]**2 for ii
+                       in range(4)]).T
+    for scale in [True, False]:
+        fits = num.polyfit_split(num.polyfit(points, values, deg=3,
+                                             scale=scale))
+        assert len(fits) == 4
+        for ii,fit in enumerate(fits):
+            ref = num.PolyFit(points, values[:,ii], deg=3, scale=scale)
+            pf = num.PolyFit(points, values[:,ii], fit=fit)
+            assert np.allclose(pf(points), ref(points))
+
+
+def test_polyfit_basis():
+    points = np.random.rand(50, 2)
+    values = np.array([np.sin(points[:,0]) * (ii+1) + points[:,1]**2 for ii
+                       in range(4)]).T
+    for scale in [True, False]:
+        for method in ['qr', 'chol', 'svd']:
+            basis = num.PolyFitBasis(points, deg=3, scale=scale,
+                                     method=method)
+            fits = num.polyfit_split(basis.fit(values))
+            for ii,fit in enumerate(fits):
+                ref = num.polyfit(points, values[:,ii], deg=3, scale=scale)
+                assert np.allclose(num.polyval(fit, points),
+                                   num.polyval(ref, points))
+            # 1d values
+            fit = basis.fit(values[:,0])
+            assert np.allclose(num.polyval(fit, points),
+                               num.polyval(fits[0], points))
+    # 1d points
+    x = np.linspace(-1, 2, 20)
+    basis = num.PolyFitBasis(x, deg=2)
+    f = num.PolyFit1D(x, (x-1)**2, fit=basis.fit((x-1)**2))
+    assert np.allclose(f.get_min(), 1.0)
+
+
+def test_polyfit_basis_underdetermined():
+    # fewer points than coeffs: min. norm solution as in polyfit()
+    for points in [np.linspace(1, 2, 5)[:,None], np.random.rand(15, 2)]:
+        values = np.sin(points).sum(axis=1)
+        ref = num.polyfit(points, values, deg=5)
+        for method in ['qr', 'chol', 'svd']:
+            basis = num.PolyFitBasis(points, deg=5, method=method)
+            assert basis.method == 'svd'
+            fit = basis.fit(values)
+            assert np.allclose(num.polyval(fit, points),
+                               num.polyval(ref, points))
+            assert np.allclose(fit['coeffs'], ref['coeffs'])
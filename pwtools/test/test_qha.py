@@ -97,3 +97,135 @@ def test_qha():
     ha = HarmonicThermo(pdos[:,0], pdos[:,1], skipfreq=True, dosarea=area,
                         integrator=simps)
     assert np.allclose(simps(ha.dos, ha.f), area)
+
+
+def test_harmonic_thermo_batch():
+    from pwtools.thermo import harmonic_thermo_batch, stack_phdos
+    pdos_fn = 'files/si.phdos'
+    unpack([pdos_fn + '.gz'])
+    pdos = np.loadtxt(pdos_fn)
+    pack([pdos_fn])
+    temp = np.linspace(5, 2000, 20)
+    # DOS of different length with some freq <= 0 at the start, to be
+    # removed by skipfreq, and a scaled copy
+    phdos = [pdos, pdos[3:-10,:], pdos[:-40,:] * np.array([1.0, 2.0])]
+    phdos[1][:2,0] = [-1.0, 0.0]
+    freq, dos, mask = stack_phdos(phdos)
+    assert freq.shape == dos.shape == mask.shape == (3, pdos.shape[0])
+    for dosarea in [None, 3.0]:
+        fvib, evib, svib, cv = harmonic_thermo_batch(freq, dos, temp,
+                                                     mask=mask,
+                                                     skipfreq=True,
+                                                     dosarea=dosarea)
+        for idx, pd in enumerate(phdos):
+            ha = HarmonicThermo(pd[:,0], pd[:,1], temp, skipfreq=True,
+                                dosarea=dosarea, verbose=False)
+            assert np.allclose(fvib[idx,:], ha.fvib())
+            assert np.allclose(evib[idx,:], ha.evib())
+            assert np.allclose(svib[idx,:], ha.svib())
+            assert np.allclose(cv[idx,:], ha.cv())
+    # common 1d freq axis
+    dos = np.array([pdos[:,1], 0.5*pdos[:,1]])
+    fvib, evib, svib, cv = harmonic_thermo_batch(pdos[:,0], dos, temp,
+                                                 skipfreq=True, maxmem=1e-6)
+    ha = HarmonicThermo(pdos[:,0], pdos[:,1], temp, skipfreq=True,
+                        verbose=False)
+    assert np.allclose(cv[0,:], ha.cv())
+    assert np.allclose(cv[1,:], 0.5*ha.cv())
+
+
+def test_debye_func_fast():
+    from pwtools.thermo import debye_func, debye_func_fast, expansion
+    x = np.logspace(-3, 2, 500)
+    ff = debye_func_fast(x)
+    # across the switch between small- and large-x expansions at x=1
+    assert np.allclose(ff, debye_func(x, nstep=int(1e5)), rtol=1e-9, atol=0)
+    assert np.allclose(ff, debye_func(x), rtol=1e-3, atol=0)
+    # high-T limit f(x) -> 1/x - 3/8
+    assert np.allclose(debye_func_fast(1e-6), 1e6 - 3.0/8, rtol=1e-12)
+    # any shape
+    assert debye_func_fast(np.ones((2,3))).shape == (2,3)
+    # vs. adaptive quadrature
+    from scipy.integrate import quad
+    for xx in [0.5, 1.0, 1.0+1e-6, 1.5, 2.0, 5.0]:
+        ref = 3*quad(lambda u: u**3/np.expm1(u), 0, xx, epsabs=0,
+                     epsrel=1.2e-14)[0] / xx**4
+        assert np.allclose(debye_func_fast(xx), ref, rtol=1e-14, atol=0)
+    # analytic derivatives
+    h = 1e-5
+    for xx in [0.1, 1.0-2*h, 1.0+2*h, 2.0, 5.0, 30.0]:
+        for der in [1,2]:
+            dnum = (debye_func_fast(xx+h, der=der-1) -
+                    debye_func_fast(xx-h, der=der-1)) / (2*h)
+            assert np.allclose(debye_func_fast(xx, der=der), dnum,
+                               rtol=1e-6, atol=0)
+    # large x, exp(x) overflows: no warnings or nan, f -> pi^4/(5 x^4)
+    x = np.array([400.0, 800.0])
+    with np.errstate(all='raise', under='ignore'):
+        for der in [0,1,2]:
+            dd = debye_func_fast(x, der=der)
+            ref = np.pi**4/5 * np.array([1, -4, 20])[der] * x**(-4.0-der)
+            assert np.allclose(dd, ref, rtol=1e-12, atol=0)
+    T = np.linspace(5, 2500, 100)
+    # default is still debye_func
+    assert (expansion(T, 5e-6, 1200, 3) ==
+            expansion(T, 5e-6, 1200, 3, func=debye_func)).all()
+    x = expansion(T, 5e-6, 1200, 3, func=debye_func_fast)
+    assert np.allclose(x, expansion(T, 5e-6, 1200, 3,
+                                    func=lambda x: debye_func(x, nstep=int(1e5))))
+    dx = expansion(T, 5e-6, 1200, 3, func=debye_func_fast, der=1)
+    dnum = (expansion(T+1e-3, 5e-6, 1200, 3, func=debye_func_fast) -
+            expansion(T-1e-3, 5e-6, 1200, 3, func=debye_func_fast)) / 2e-3
+    assert np.allclose(dx, dnum, rtol=1e-5, atol=1e-12)
+
+
+def test_harmonic_thermo_qpoints():
+    from pwtools.thermo import harmonic_thermo_qpoints
+    from pwtools.constants import hplanck, c0
+    rnd = np.random.RandomState(42)
+    nq, nmodes = 50, 6
+    freqs = rnd.rand(nq, nmodes) * 500 + 10
+    # acoustic modes at Gamma
+    freqs[0,:3] = 0.0
+    weights = rnd.rand(nq)
+    temp = np.linspace(5, 3000, 30)
+    fvib, evib, svib, cv = harmonic_thermo_qpoints(freqs, temp,
+                                                   weights=weights)
+    # reference: explicit loop over modes
+    h = hplanck * c0 * 100
+    ww = weights / weights.sum()
+    ref = np.zeros((4, len(temp)))
+    for iq in range(nq):
+        for f in freqs[iq,:]:
+            if f <= 0:
+                continue
+            x = h * f / (kb * temp)
+            n = 1.0 / (np.exp(x) - 1.0)
+            lsh = np.log(2.0 * np.sinh(x / 2.0))
+            ref[0] += ww[iq] * lsh * kb * temp / eV
+            ref[1] += ww[iq] * h * f * (n + 0.5) / eV
+            ref[2] += ww[iq] * (x * (n + 0.5) - lsh)
+            ref[3] += ww[iq] * x**2 * n * (n + 1)
+    for arr, rr in zip([fvib, evib, svib, cv], ref):
+        assert np.allclose(arr, rr)
+    assert np.allclose(fvib, evib - temp * svib * kb / eV)
+    # zero point energy, classical limit of Cv
+    assert np.allclose(evib[0], 0.5 * h / eV * (ww[:,None] *
+                                                freqs).sum(), rtol=1e-3)
+    assert np.allclose(cv[-1], nmodes - 3*ww[0], rtol=1e-2)
+    # chunked over q-points
+    out = harmonic_thermo_qpoints(freqs, temp, weights=weights, maxmem=1e-6)
+    for arr, rr in zip(out, [fvib, evib, svib, cv]):
+        assert np.allclose(arr, rr)
+    # vs. HarmonicThermo with a DOS histogram
+    hist, edges = np.histogram(freqs[1:,:], bins=2000, range=(0, 520),
+                               weights=np.repeat(ww[1:], nmodes).reshape(
+                                   nq-1, nmodes))
+    df = edges[1] - edges[0]
+    fdos = 0.5 * (edges[1:] + edges[:-1])
+    temp = np.linspace(300, 3000, 10)
+    ha = HarmonicThermo(fdos, hist / df, temp, skipfreq=True, verbose=False)
+    fvib, evib, svib, cv = harmonic_thermo_qpoints(freqs[1:,:], temp,
+                                                   weights=weights[1:])
+    assert np.allclose(cv, ha.cv(), rtol=1e-2)
+    assert np.allclose(evib, ha.evib(), rtol=1e-2)
@@ -171,3 +171,86 @@ def test_rpdf():
         
         if doplot:
             plt.show()
+
+
+def test_rpdf_variable_cell():
+    # Variable cell: the time average must be the average of the per-step
+    # RPDFs, each normalized with its own volume.
+    nstep = 10
+    natoms = 20
+    cell = np.identity(3)[None,...] * np.linspace(9, 11, nstep)[:,None,None]
+    traj = crys.Trajectory(coords_frac=rand(nstep,natoms,3),
+                           cell=cell,
+                           symbols=['O']*5+['H']*15)
+    rmax_auto = crys.rmax_smith3d(traj.cell).min()
+    assert np.allclose(rmax_auto, 4.5)
+    ret = crys.rpdf(traj, dr=0.1)
+    assert ret[-1,0] < rmax_auto
+    for amask in [None, ['O', 'H']]:
+        ret = crys.rpdf(traj, dr=0.1, rmax=4.0, amask=amask)
+        ref = np.array([crys.rpdf(traj[ii], dr=0.1, rmax=4.0, amask=amask)
+                        for ii in range(nstep)]).mean(axis=0)
+        assert np.allclose(ret, ref)
+        # small maxmem -> many blocks of time steps, same result
+        ret2 = crys.rpdf(traj, dr=0.1, rmax=4.0, amask=amask, maxmem=1e-6)
+        aae(ret, ret2)
+
+
+def test_rpdf_partial():
+    nstep = 10
+    cell = np.identity(3)[None,...] * np.linspace(9, 11, nstep)[:,None,None]
+    symbols = ['O']*5 + ['H']*10 + ['Ca']*3
+    traj = crys.Trajectory(coords_frac=rand(nstep,len(symbols),3),
+                           cell=cell,
+                           symbols=symbols)
+    out, pairs = crys.rpdf_partial(traj, dr=0.1)
+    assert pairs == [('Ca','Ca'), ('Ca','H'), ('Ca','O'), ('H','H'), ('H','O'),
+                     ('O','O')]
+    assert out.shape[0] == len(pairs)
+    assert out.shape[2] == 3
+    for (sym0, sym1), dd in zip(pairs, out):
+        ref = crys.rpdf(traj, dr=0.1, amask=[sym0, sym1])
+        assert np.allclose(dd, ref)
+    # time slice, Structure input
+    out, pairs = crys.rpdf_partial(traj, dr=0.1, rmax=4.0, tmask=np.s_[-1])
+    ref, pairs = crys.rpdf_partial(traj[-1], dr=0.1, rmax=4.0)
+    assert np.allclose(out, ref)
+
+
+def test_rpdf_accumulator():
+    nstep = 12
+    cell = np.identity(3)[None,...] * np.linspace(9, 11, nstep)[:,None,None]
+    traj = crys.Trajectory(coords_frac=rand(nstep,20,3),
+                           cell=cell,
+                           symbols=['O']*5+['H']*15)
+    for amask in [None, ['O', 'H']]:
+        ref = crys.rpdf(traj, dr=0.1, rmax=4.0, amask=amask)
+        # chunks
+        acc = crys.RPDFAccumulator(dr=0.1, rmax=4.0, amask=amask)
+        for sl in [np.s_[:5], np.s_[5:6], np.s_[6:]]:
+            acc.update(traj[sl])
+        assert acc.nstep == nstep
+        assert np.allclose(acc.result(), ref)
+        # merge partial results, dump + load state
+        accs = []
+        for ii,sl in enumerate([np.s_[:5], np.s_[5:]]):
+            aa = crys.RPDFAccumulator(dr=0.1, rmax=4.0, amask=amask)
+            aa.update(traj[sl])
+            fn = pj(testdir, 'rpdf_acc_%i.pk' %ii)
+            aa.dump(fn)
+            accs.append(io.read_pickle(fn))
+        acc = accs[0].merge(accs[1])
+        assert np.allclose(acc.result(), ref)
+    # merge only with the same settings
+    acc = crys.RPDFAccumulator(dr=0.1, rmax=4.0, amask=['O', 'H'])
+    acc.merge(crys.RPDFAccumulator(dr=0.1, rmax=4.0, amask=['O', 'H']))
+    for kwds in [dict(amask=['O', 'O']), dict(amask=None), dict(pbc=False),
+                 dict(norm_vmd=True), dict(dmask='>1.0')]:
+        kw = dict(dr=0.1, rmax=4.0, amask=['O', 'H'])
+        kw.update(kwds)
+        other = crys.RPDFAccumulator(**kw)
+        try:
+            acc.merge(other)
+            raise Exception("merge with different %s not detected" %kwds)
+        except AssertionError:
+            pass
@@ -87,3 +87,52 @@ def test_odd():
     assert signal.odd(2) == 3
     assert signal.odd(6, add=-1) == 5
 
+
+
+def test_smooth_chunked():
+    for N, M in [(100, 11), (100, 10), (20, 30), (50, 49)]:
+        for edge in ['m', 'c']:
+            data = np.random.rand(N)
+            kern = hanning(M)
+            ref = smooth(data, kern, edge=edge)
+            for chunksize in [1, 7, N, 2*N]:
+                ret = smooth(data, kern, edge=edge, chunksize=chunksize)
+                assert np.allclose(ret, ref)
+    # nd, axis != 0, out
+    data = np.random.rand(5, 200, 3)
+    kern = gaussian(31, 5)[None,:,None]
+    ref = smooth(data, kern, axis=1)
+    out = np.empty_like(data)
+    ret = smooth(data, kern, axis=1, chunksize=37, out=out)
+    assert ret is out
+    assert np.allclose(out, ref)
+
+
+def test_fir_filter_chunked():
+    filt = signal.FIRFilter(cutoff=10.0, nyq=50.0, ntaps=51)
+    data = np.random.rand(1000, 3)
+    ref = filt(data, axis=0)
+    assert np.allclose(filt(data, axis=0, chunksize=64), ref)
+    out = np.empty_like(data)
+    filt(data, axis=0, chunksize=1000, out=out)
+    assert np.allclose(out, ref)
+    filt.reset()
+    y = np.concatenate([filt.process(data[ii:ii+100], axis=0) for ii in
+                        range(0, 1000, 100)], axis=0)
+    assert np.allclose(y, ref)
+
+
+def test_smooth_method():
+    for data, kern in [(np.random.rand(200), hanning(21)),
+                       (np.random.rand(200), hanning(400)),
+                       (np.random.rand(100,2,3), hanning(11)[:,None,None])]:
+        for edge in ['m', 'c']:
+            ref = smooth(data, kern, edge=edge, method='fft')
+            assert np.allclose(smooth(data, kern, edge=edge,
+                                      method='direct'), ref)
+            assert np.allclose(smooth(data, kern, edge=edge), ref)
+            assert np.allclose(smooth(data, kern, edge=edge, chunksize=33,
+                                      method='direct'), ref)
+    # cost model: short 1d kernels direct, long ones FFT
+    assert signal._conv_method((10000,), (11,)) == 'direct'
+    assert signal._conv_method((100000,), (5001,)) == 'fft'
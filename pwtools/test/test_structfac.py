@@ -0,0 +1,91 @@
+import numpy as np
+from pwtools import crys, structfac
+rand = np.random.rand
+
+
+def test_sq_direct_crystal():
+    # bcc, conventional cubic cell with 2 atoms: S(G) = |1 + exp(i*pi*(h+k+l))|**2 / 2
+    # = 2 for h+k+l even, 0 for odd, all G in a shell |h|**2 = 1..6 have the
+    # same parity
+    alat = 2.0
+    st = crys.Structure(coords_frac=np.array([[0,0,0],[0.5,0.5,0.5]]),
+                        cell=np.identity(3)*alat,
+                        symbols=['Fe']*2)
+    q, sq = structfac.sq_direct(st, qmax=2*np.pi/alat*np.sqrt(6.5), dq=0.01)
+    assert np.allclose(q, 2*np.pi/alat*np.sqrt(np.arange(1,7)))
+    assert np.allclose(sq, [0,2,0,2,0,2])
+    # supercell: additional G vectors with S=0 are in the same shells, peaks
+    # are now S=natoms per Bragg G vector
+    sc = crys.scell(st, (2,2,2))
+    q2, sq2 = structfac.sq_direct(sc, qmax=2*np.pi/alat*np.sqrt(6.5), dq=0.01)
+    assert np.allclose(q2.min(), np.pi/alat)
+    for qq, ss in zip(q, sq):
+        assert np.allclose(sq2[np.argmin(np.abs(q2 - qq))] > 0, ss > 0)
+
+
+def test_sq_direct_partial():
+    nstep = 5
+    symbols = ['O']*5 + ['H']*10 + ['Ca']*3
+    natoms = len(symbols)
+    cell = np.identity(3)[None,...] * np.linspace(6, 7, nstep)[:,None,None]
+    traj = crys.Trajectory(coords_frac=rand(nstep,natoms,3),
+                           cell=cell,
+                           symbols=symbols)
+    q, sq = structfac.sq_direct(traj, qmax=5.0, dq=0.1)
+    # small maxmem -> blocks of G vectors and time steps, same result
+    q2, sq2 = structfac.sq_direct(traj, qmax=5.0, dq=0.1, maxmem=1e-6)
+    assert np.allclose(q, q2)
+    assert np.allclose(sq, sq2)
+    qp, sqp, pairs = structfac.sq_direct(traj, qmax=5.0, dq=0.1, partial=True)
+    assert np.allclose(q, qp)
+    assert sqp.shape == (len(pairs), len(q))
+    # total = concentration-weighted sum of Faber-Ziman partials
+    nat = dict((sym, symbols.count(sym)) for sym in set(symbols))
+    ref = np.zeros_like(sq)
+    for (sym0, sym1), ss in zip(pairs, sqp):
+        fac = 1.0 if sym0 == sym1 else 2.0
+        ref += fac * nat[sym0]*nat[sym1] / natoms**2.0 * ss
+    assert np.allclose(sq, ref)
+
+
+def test_sq_direct_vs_rpdf():
+    # ideal gas: all Faber-Ziman partials (also H-O) fluctuate around 1 with
+    # both methods
+    nstep = 20
+    symbols = ['O']*20 + ['H']*40
+    natoms = len(symbols)
+    cell = np.identity(3) * 8.0
+    traj = crys.Trajectory(coords_frac=rand(nstep,natoms,3),
+                           cell=cell[None,...].repeat(nstep, axis=0),
+                           symbols=symbols)
+    qd, sqd, pairs = structfac.sq_direct(traj, qmax=6.0, dq=0.1,
+                                         partial=True)
+    out, pairs_r = crys.rpdf_partial(traj, dr=0.1)
+    assert pairs == pairs_r
+    rho = natoms / traj.volume.mean()
+    qr, sqr = structfac.sq_from_rpdf(out[0,:,0], out[...,1], rho,
+                                     q=np.linspace(2, 6, 50))
+    for ss_d, ss_r in zip(sqd[:,qd > 2], sqr):
+        assert abs(ss_d.mean() - 1) < 0.1
+        assert abs(ss_r.mean() - 1) < 0.1
+        assert abs(ss_d.mean() - ss_r.mean()) < 0.1
+
+
+def test_sq_from_rpdf():
+    rad = np.arange(0.05, 5, 0.1)
+    # ideal gas
+    q, sq = structfac.sq_from_rpdf(rad, np.ones_like(rad), rho=0.1)
+    assert np.allclose(sq, 1.0)
+    # partials: leading dims, compare w/ one-by-one
+    gr = rand(3, len(rad))
+    qq = np.linspace(0, 10, 50)
+    q, sq = structfac.sq_from_rpdf(rad, gr, rho=0.1, q=qq, window=None)
+    assert sq.shape == (3, len(qq))
+    assert np.allclose(q, qq)
+    for ii in range(3):
+        q, sq1 = structfac.sq_from_rpdf(rad, gr[ii,:], rho=0.1, q=qq,
+                                        window=None)
+        assert np.allclose(sq1, sq[ii,:])
+        # q=0: 1 + 4*pi*rho*int r**2 (g-1) dr
+        ref = 1 + 4*np.pi*0.1*(rad**2*(gr[ii,:]-1)).sum()*0.1
+        assert np.allclose(sq1[0], ref)
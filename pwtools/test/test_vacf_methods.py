@@ -31,6 +31,10 @@ def test_vacf_methods():
     f2 = pydos.fvacf(a, method=2)
     f1m = pydos.fvacf(a, method=1, m=m)
     f2m = pydos.fvacf(a, method=2, m=m)
+    f3 = pydos.fvacf(a, method=3)
+    f3m = pydos.fvacf(a, method=3, m=m)
+    # atoms in blocks of 1
+    f3mb = pydos.fvacf(a, method=3, m=m, maxmem=1e-9)
 
     assrt(f1,  f2)
     assrt(f1m, f2m)
@@ -49,3 +53,22 @@ def test_vacf_methods():
     assrt(p2m,  f2m)
     assrt(p3m,  f2m)
 
+    assrt(f1,  f3)
+    assrt(f1m, f3m)
+    assrt(f1m, f3mb)
+
+
+def test_vacf_blocks():
+    import numpy as np
+    from pwtools import pydos
+    a = np.random.rand(50,10,3) + 1.0
+    m = np.random.rand(10) * 10.0 + 1.0
+    ref = pydos.pyvacf(a, method=3, m=m)
+    for method in [1,2,3]:
+        # atoms in blocks of 1, no full F-order copy, float32 input
+        for maxmem in [1.0, 1e-9]:
+            assert np.allclose(pydos.fvacf(a, method=method, m=m,
+                                           maxmem=maxmem), ref)
+            c32 = pydos.fvacf(a.astype(np.float32), method=method, m=m,
+                              maxmem=maxmem)
+            assert np.allclose(c32, ref, rtol=1e-5)
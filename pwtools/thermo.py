@@ -1,6 +1,13 @@
 """(Quasi)harmonic approximation. Thermal expansion tools."""
 
+import hashlib
+import multiprocessing
+import warnings
 import numpy as np
+try:
+    import h5py
+except ImportError:
+    pass
 from scipy.integrate import simps, trapz
 from pwtools.constants import kb, hplanck, R, pi, c0, Ry_to_J, eV,\
     eV_by_Ang3_to_GPa
@@ -243,6 +250,219 @@ class HarmonicThermo(object):
         return self.vibrational_entropy(*args, **kwargs)
 
 
+def stack_phdos(phdos):
+    """Stack a sequence of phonon DOS arrays with possibly different lengths
+    for :func:`harmonic_thermo_batch`.
+
+    Parameters
+    ----------
+    phdos : sequence (npoints,)
+        2d arrays ``(nfreq_i, 2)`` with ``[freq, dos]``, e.g.
+        ``Gibbs.phdos``.
+
+    Returns
+    -------
+    freq, dos, mask
+    freq, dos : 2d arrays (npoints, max(nfreq_i))
+        Zero-padded.
+    mask : 2d bool array (npoints, max(nfreq_i))
+        True for the valid (not padded) entries.
+    """
+    nfreq = max(pd.shape[0] for pd in phdos)
+    freq = np.zeros((len(phdos), nfreq), dtype=float)
+    dos = np.zeros((len(phdos), nfreq), dtype=float)
+    mask = np.zeros((len(phdos), nfreq), dtype=bool)
+    for ii, pd in enumerate(phdos):
+        nn = pd.shape[0]
+        freq[ii,:nn] = pd[:,0]
+        dos[ii,:nn] = pd[:,1]
+        mask[ii,:nn] = True
+    return freq, dos, mask
+
+
+def _harmonic_terms(f, temp):
+    # Per mode terms of Fvib/(kb*T), Evib/h, Svib/kb and Cv/kb for frequency
+    # f [cm^-1] and temperature temp (broadcast against each other)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        xx = hplanck * c0 * 100 * f / (kb * temp)
+        nb = 1.0 / np.expm1(xx)
+        # log(2*sinh(x/2)) = x/2 + log(1 - exp(-x))
+        lsh = 0.5*xx + np.log1p(-np.exp(-xx))
+        return [lsh,
+                f * (nb + 0.5),
+                xx * (nb + 0.5) - lsh,
+                xx**2.0 * nb * (nb + 1.0)]
+
+
+def _trapz_masked(y, f):
+    # trapz along the last axis, f broadcasts against y
+    return 0.5 * ((y[...,1:] + y[...,:-1]) * np.diff(f, axis=-1)).sum(axis=-1)
+
+
+def harmonic_thermo_batch(freq, dos, temp, mask=None, skipfreq=False,
+                          eps=1.5*num.EPS, dosarea=None, fixnan=False,
+                          nanfill=0.0, maxmem=1.0):
+    """Vectorized :class:`HarmonicThermo` for many phonon DOS at once.
+
+    Calculates Fvib, Evib, Svib and Cv for all DOS and temperatures in one
+    call. The Bose factor ``n = 1/(exp(h*f/(kb*T)) - 1)`` is evaluated once
+    per (DOS, T, f) and used for all quantities::
+
+        x = h*f/(kb*T)
+        Evib = h*int(f) dos*f*(n + 1/2)
+        Fvib = kb*T*int(f) dos*log(2*sinh(x/2))
+        Svib = int(f) dos*(x*(n + 1/2) - log(2*sinh(x/2)))
+        Cv = int(f) dos*x**2*n*(n + 1)
+
+    Integration is done with the trapezoidal rule, same as
+    ``HarmonicThermo(..., integrator=trapz)``.
+
+    Parameters
+    ----------
+    freq : 1d array (nfreq,) or 2d array (npoints, nfreq)
+        Frequency [cm^-1], common to all DOS or one for each.
+    dos : 2d array (npoints, nfreq)
+    temp : 1d array (nT,)
+        Temperature [K]
+    mask : 2d bool array (npoints, nfreq), optional
+        True for valid DOS points. Use for DOS of different length padded to
+        a common shape, see :func:`stack_phdos`.
+    skipfreq, eps, dosarea, fixnan, nanfill :
+        See :class:`HarmonicThermo`.
+    maxmem : float
+        Max. memory in GB for the temp arrays ``(npoints, nT, nfreq)``, DOS
+        are processed in blocks which fit into that.
+
+    Returns
+    -------
+    fvib, evib, svib, cv : 2d arrays (npoints, nT)
+        Units as in :class:`HarmonicThermo`: eV, eV, kb, kb
+
+    Examples
+    --------
+    >>> freq, dos, mask = stack_phdos(gibbs.phdos)
+    >>> fvib, evib, svib, cv = harmonic_thermo_batch(freq, dos, T, mask=mask,
+    ...                                              skipfreq=True)
+    """
+    h = hplanck * c0 * 100
+    dos = np.atleast_2d(np.asarray(dos, dtype=float))
+    npoints, nfreq = dos.shape
+    freq = np.asarray(freq, dtype=float)
+    freq = np.broadcast_to(freq if freq.ndim == 2 else freq[None,:],
+                           dos.shape)
+    temp = np.asarray(temp, dtype=float)
+    valid = np.ones(dos.shape, dtype=bool) if mask is None else \
+            np.asarray(mask, dtype=bool)
+    if skipfreq:
+        valid = valid & (freq > eps)
+    # Move valid points of each row to the front (stable, order preserved)
+    # and pad with the last valid frequency and zero DOS, such that padded
+    # points have zero width in the trapz integration. Same as removing
+    # them, as HarmonicThermo does.
+    if not valid.all():
+        order = np.argsort(np.invert(valid), axis=1, kind='mergesort')
+        rows = np.arange(npoints)[:,None]
+        freq = freq[rows, order]
+        dos = dos[rows, order]
+        valid = valid[rows, order]
+        nvalid = valid.sum(axis=1)
+        assert (nvalid > 1).all(), "need > 1 valid DOS points"
+        flast = freq[np.arange(npoints), nvalid-1]
+        freq = np.where(valid, freq, flast[:,None])
+        dos = np.where(valid, dos, 0.0)
+    if dosarea is not None:
+        dos = dos * (float(dosarea) / _trapz_masked(dos, freq))[:,None]
+    out = [np.empty((npoints, len(temp)), dtype=float) for ii in range(4)]
+    nblock = int(min(npoints, max(1, maxmem*1e9 /
+                                  (len(temp)*nfreq*8.0*6))))
+    for start in range(0, npoints, nblock):
+        sl = slice(start, min(start + nblock, npoints))
+        ff = freq[sl,None,:]
+        dd = dos[sl,None,:]
+        valid_bc = valid[sl,None,:]
+        with np.errstate(invalid='ignore'):
+            yy = [dd * arr for arr in _harmonic_terms(ff, temp[None,:,None])]
+        for arr in yy:
+            # padded points, zero DOS
+            arr[np.invert(np.broadcast_to(valid_bc, arr.shape))] = 0.0
+            nan = np.isnan(arr)
+            if nan.any() and fixnan:
+                arr[nan] = nanfill
+        out[0][sl,:] = _trapz_masked(yy[0], ff) * temp[None,:] * (kb / eV)
+        out[1][sl,:] = _trapz_masked(yy[1], ff) * (h / eV)
+        out[2][sl,:] = _trapz_masked(yy[2], ff)
+        out[3][sl,:] = _trapz_masked(yy[3], ff)
+        del yy
+    return tuple(out)
+
+
+def harmonic_thermo_qpoints(freqs, temp, weights=None, skipfreq=True,
+                            eps=1.5*num.EPS, maxmem=1.0):
+    """Harmonic Fvib, Evib, Svib and Cv directly from phonon frequencies on a
+    q-point grid, as weighted sums over q-points and modes. Same as
+    :class:`HarmonicThermo` with a DOS made of delta peaks, but without
+    histogramming the frequencies into a DOS first::
+
+        Fvib = sum_q w_q sum_m kb*T*log(2*sinh(x_qm/2))
+        x_qm = h*f_qm/(kb*T), etc.
+
+    Parameters
+    ----------
+    freqs : 2d array (nqpoints, nmodes)
+        Frequencies [cm^-1], e.g. from :func:`~pwtools.pwscf.read_matdyn_freq`
+        or :func:`~pwtools.pwscf.read_matdyn_modes`, ``nmodes = 3*natoms``.
+    temp : 1d array (nT,)
+        Temperature [K]
+    weights : 1d array (nqpoints,), optional
+        q-point weights, normalized to sum 1 here. Default is equal weights
+        (full, unreduced grid).
+    skipfreq : bool
+        Ignore modes with ``freqs <= eps``, i.e. the acoustic modes at Gamma
+        and imaginary (negative) frequencies. Without that, Fvib and Svib
+        are -inf or NaN if there is a Gamma point on the grid.
+    eps : float
+        Threshold for `skipfreq`.
+    maxmem : float
+        Max. memory in GB for the temp arrays ``(nqpoints, nmodes, nT)``,
+        q-points are processed in chunks which fit into that.
+
+    Returns
+    -------
+    fvib, evib, svib, cv : 1d arrays (nT,)
+        Per unit cell (all modes of one q-point), units as in
+        :class:`HarmonicThermo`: eV, eV, kb, kb
+
+    Examples
+    --------
+    >>> qpoints, freqs = pwscf.read_matdyn_freq('matdyn.freq')
+    >>> fvib, evib, svib, cv = harmonic_thermo_qpoints(freqs, T)
+    """
+    h = hplanck * c0 * 100
+    freqs = np.asarray(freqs, dtype=float)
+    assert freqs.ndim == 2, "freqs must be 2d array (nqpoints, nmodes)"
+    temp = np.asarray(temp, dtype=float)
+    nq, nmodes = freqs.shape
+    if weights is None:
+        weights = np.ones((nq,), dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    assert weights.shape == (nq,), "weights must be (nqpoints,)"
+    weights = weights / weights.sum()
+    out = np.zeros((4, len(temp)), dtype=float)
+    nchunk = int(min(nq, max(1, maxmem*1e9 / (len(temp)*nmodes*8.0*6))))
+    for start in range(0, nq, nchunk):
+        sl = slice(start, min(start + nchunk, nq))
+        ff = freqs[sl,:,None]
+        ww = weights[sl,None,None]
+        if skipfreq:
+            ww = np.where(ff > eps, ww, 0.0)
+        with np.errstate(invalid='ignore'):
+            for ii, arr in enumerate(_harmonic_terms(ff, temp[None,None,:])):
+                if skipfreq:
+                    arr[ww[...,0] == 0.0,:] = 0.0
+                out[ii,:] += (ww * arr).sum(axis=(0,1))
+    return out[0] * temp * (kb / eV), out[1] * (h / eV), out[2], out[3]
+
+
 class Gibbs(object):
     """
     Calculate thermodynamic properties on a T-P grid in the quasiharmonic
@@ -374,7 +594,8 @@ class Gibbs(object):
     >>> fig,ax=mpl.fig_ax3d(); ax.scatter(d.xx,d.yy,d.zz); show()
     """
     def __init__(self, T=None, P=None, etot=None, phdos=None, axes_flat=None,
-                 volfunc_ax=None, case=None, **kwds):
+                 volfunc_ax=None, case=None, phfreq=None, qweights=None,
+                 **kwds):
         """
         Parameters
         ----------
@@ -408,11 +629,24 @@ class Gibbs(object):
             '1d', '2d', '3d' or None. If None then it will be determined from
             axes_flat.shape[1]. Can be used to evaluate "fake" 1d data: set
             case='1d' but let `axes_flat` be (N,2) or (N,3)
+        phfreq : sequence (axes_flat.shape[0],), optional
+            Use instead of `phdos`: phonon frequencies on a q-point grid for
+            each axes grid point, ``phfreq[i] = <2d array (nqpoints,
+            nmodes)>``, see :func:`harmonic_thermo_qpoints`. Vibrational
+            properties are then exact weighted sums over q-points and modes
+            instead of integrals over a DOS.
+        qweights : sequence (axes_flat.shape[0],), optional
+            q-point weights for `phfreq`, ``qweights[i] = <1d array
+            (nqpoints,)>``. Default is equal weights.
         **kwds: keywords 
             passed to HarmonicThermo and added here as `self.<key>=<value>`
+            (only `skipfreq` and `eps` are used with `phfreq`)
         """
-        assert axes_flat.shape[0] == len(phdos), ("axes_flat and phdos "
-            "not equally long")
+        assert (phdos is None) != (phfreq is None), ("use one of phdos or "
+            "phfreq")
+        assert axes_flat.shape[0] == len(phdos if phfreq is None else
+                                         phfreq), \
+            ("axes_flat and phdos/phfreq not equally long")
         self.kwds = dict(verbose=False, fixnan=False, skipfreq=True,
                          dosarea=None)
         self.kwds.update(kwds)                         
@@ -422,6 +656,8 @@ class Gibbs(object):
         self.P = P
         self.etot = etot
         self.phdos = phdos
+        self.phfreq = phfreq
+        self.qweights = qweights
         self.volfunc_ax = volfunc_ax
         self.axes_flat = axes_flat if axes_flat.ndim == 2 else axes_flat[:,None]
         self.nT = len(self.T)
@@ -432,6 +668,7 @@ class Gibbs(object):
                  in range(self.npoints)])
         self.case = case
         self.fitax = None
+        self.fit_basis = None
         if self.nax == 1:
             if self.case is None:
                 self.case = '1d'
@@ -490,7 +727,42 @@ class Gibbs(object):
     def _default_fit_C(x, y):
         return num.Spline(x, y, k=5, s=None)
 
-    def _fit_opt_store(self, ret, gg, prfx='/T/P', ghsym='G', tpidx=None):
+    def _fit_G_many(self, ggs):
+        """Fit G(ax0,...) (or H) for each row of `ggs` (nfit, npoints) with
+        the '1d-G' or '2d-G' fit function. Returns a list of fit objects.
+        
+        For the default fit functions (polynomials), the Vandermonde matrix
+        only depends on the axes grid. It is factorized once
+        (:class:`~pwtools.num.PolyFitBasis`, cached in ``self.fit_basis``)
+        and all rows are fitted in one solve with multiple right-hand sides.
+        Other fit functions are called once per row. In the 2d case, each row
+        is scaled to [0,1] first, as in :meth:`_fit_opt_store`.
+        """
+        if self.case == '1d':
+            points = self.V
+            func = self.fitfunc['1d-G']
+            default = func is Gibbs._default_fit_1d_G
+            fitcls = num.PolyFit1D
+        elif self.case == '2d':
+            ggmin = ggs.min(axis=1)[:,None]
+            ggmax = ggs.max(axis=1)[:,None]
+            ggs = (ggs - ggmin) / (ggmax - ggmin)
+            points = self.axes_flat
+            func = self.fitfunc['2d-G']
+            default = func is Gibbs._default_fit_2d_G
+            fitcls = num.PolyFit
+        else:
+            raise Exception("unknown case: %s" %self.case)
+        if default:
+            if self.fit_basis is None:
+                self.fit_basis = num.PolyFitBasis(points, deg=5, scale=True)
+            fits = num.polyfit_split(self.fit_basis.fit(ggs.T))
+            return [fitcls(points, gg, fit=fit) for gg,fit in zip(ggs, fits)]
+        else:
+            return [func(points, gg) for gg in ggs]
+
+    def _fit_opt_store(self, ret, gg, prfx='/T/P', ghsym='G', tpidx=None,
+                       fit=None, x0=None):
         """For each (T,P) or (P,), fit G(ax0,...) or H(ax0,...) minimize and store
         properties in `ret`. Used in /T/P loop in calc_G and /P loop in calc_H.
         
@@ -505,11 +777,22 @@ class Gibbs(object):
         tpidx : list
             [tidx,pidx] in calc_G
             [pidx] in calc_H
+        fit : fit object, optional
+            Fit of `gg` from :meth:`_fit_G_many`, skip fitting here.
+        x0 : float or 1d array, optional
+            Start guess for the minimization (V in the 1d case, (ax0,ax1) in
+            the 2d case), e.g. the result from a neighboring (T,P) point.
+
+        Returns
+        -------
+        xopt : float or 1d array
+            The optimum, can be used as `x0` for the next point.
         """
         tpsl = tuple(tpidx)
         if self.case == '1d':
-            fit = self.fitfunc['1d-G'](self.V, gg)
-            vopt = fit.get_min()
+            if fit is None:
+                fit = self.fitfunc['1d-G'](self.V, gg)
+            vopt = fit.get_min(x0=x0)
             ret['/#opt%s/V' %prfx][tpsl] = vopt
             ret['/#opt%s/%s' %(prfx,ghsym)][tpsl] = fit(vopt)
             # Loop needed for fake-1d case when we set case='1d'
@@ -518,6 +801,7 @@ class Gibbs(object):
             for iax in range(self.nax):
                 ret['/#opt%s/ax%i' %(prfx,iax)][tpsl] = self.fitax[iax](vopt)
             ret['/#opt%s/B' %prfx][tpsl] = vopt * fit(vopt, der=2) * eV_by_Ang3_to_GPa
+            return vopt
         elif self.case == '2d':
             # XXX The fit function alone should take care of scaling, see
             # num.PolyFit(..., scale=True). Doing this here is OK but redundant.
@@ -525,13 +809,15 @@ class Gibbs(object):
             ggmin = gg.min()
             ggmax = gg.max()
             ggscale = (gg - ggmin) / (ggmax - ggmin)
-            fit = self.fitfunc['2d-G'](self.axes_flat, ggscale)
-            xopt = fit.get_min()
+            if fit is None:
+                fit = self.fitfunc['2d-G'](self.axes_flat, ggscale)
+            xopt = fit.get_min(x0=x0)
             ret['/#opt%s/ax0' %prfx][tpsl] = xopt[0]
             ret['/#opt%s/ax1' %prfx][tpsl] = xopt[1]
             ret['/#opt%s/%s' %(prfx, ghsym)][tpsl] = fit(xopt) * (ggmax - ggmin) + ggmin
             if self.volfunc_ax is not None:
                 ret['/#opt%s/V' %prfx][tpsl] = self.volfunc_ax(xopt)
+            return xopt
         else:
             raise Exception("unknown case: %s" %self.case)
     
@@ -561,7 +847,10 @@ class Gibbs(object):
     def calc_F(self, calc_all=True):
         """Free energy properties along T axis for each axes grid point
         (ax0,ax1,ax2) in `self.axes_flat`. Also used by :meth:`calc_G`. Uses
-        :class:`~pwtools.thermo.HarmonicThermo`.
+        :func:`~pwtools.thermo.harmonic_thermo_batch` for all grid points at
+        once, or :class:`~pwtools.thermo.HarmonicThermo` for each point if a
+        non-default ``integrator`` is passed in ``**kwds``. With `phfreq`,
+        uses :func:`~pwtools.thermo.harmonic_thermo_qpoints` for each point.
         
         Parameters
         ----------
@@ -592,6 +881,40 @@ class Gibbs(object):
         ret = dict((self.axes_prefix + '/T/%s' %name, 
                     np.empty((self.npoints, self.nT), dtype=float)) \
                     for name in names)
+        if self.phfreq is not None:
+            qkwds = dict((k,v) for k,v in self.kwds.items() if k in
+                         ['skipfreq', 'eps'])
+            for idx in range(self.npoints):
+                if self.verbose:
+                    print("calc_F: axes_flat idx = %i" %idx)
+                qw = None if self.qweights is None else self.qweights[idx]
+                fvib, evib, svib, cv = harmonic_thermo_qpoints(
+                    self.phfreq[idx], self.T, weights=qw, **qkwds)
+                ret[self.axes_prefix + '/T/F'][idx,:] = self.etot[idx] + fvib
+                ret[self.axes_prefix + '/T/Fvib'][idx,:] = fvib
+                if calc_all:
+                    ret[self.axes_prefix + '/T/Svib'][idx,:] = svib
+                    ret[self.axes_prefix + '/T/Evib'][idx,:] = fvib + self.T * svib
+                    ret[self.axes_prefix + '/T/Cv'][idx,:] = cv
+            ret.update(self.ret)
+            return ret
+        if self.kwds.get('integrator', trapz) is trapz:
+            # all DOS at once, same result as HarmonicThermo(...,
+            # integrator=trapz) below
+            bkwds = dict((k,v) for k,v in self.kwds.items() if k in
+                         ['skipfreq', 'eps', 'dosarea', 'fixnan', 'nanfill'])
+            freq, dos, mask = stack_phdos(self.phdos)
+            fvib, evib, svib, cv = harmonic_thermo_batch(freq, dos, self.T,
+                                                         mask=mask, **bkwds)
+            ret[self.axes_prefix + '/T/F'][...] = \
+                np.asarray(self.etot)[:,None] + fvib
+            ret[self.axes_prefix + '/T/Fvib'][...] = fvib
+            if calc_all:
+                ret[self.axes_prefix + '/T/Svib'][...] = svib
+                ret[self.axes_prefix + '/T/Evib'][...] = fvib + self.T * svib
+                ret[self.axes_prefix + '/T/Cv'][...] = cv
+            ret.update(self.ret)
+            return ret
         for idx in range(self.npoints):
             if self.verbose:
                 print("calc_F: axes_flat idx = %i" %idx)
@@ -632,17 +955,126 @@ class Gibbs(object):
             names = ['ax0', 'ax1', 'ax2', 'V', 'H', 'B']
             ret.update(dict(('/#opt/P/%s' %name, np.empty((self.nP,))) \
                        for name in names))
+            fits = self._fit_G_many(ret['/P' + self.axes_prefix + '/H'])
             for pidx in range(self.nP):
                 if self.verbose:
                     print("calc_H: pidx = %i" %(pidx))
                 gg = ret['/P' + self.axes_prefix + '/H'][pidx,:]
                 self._fit_opt_store(ret, gg, prfx='/P',
-                                    tpidx=[pidx], ghsym='H')
+                                    tpidx=[pidx], ghsym='H', fit=fits[pidx])
         self._set_not_calc_none(ret, prfx='/P')
         ret.update(self.ret)        
         return ret
     
-    def calc_G(self, ret=None, calc_all=True):
+    def _G_block(self, F, tstart, tstop):
+        """G(T,P,ax0,...) = F + P*V for T indices ``tstart:tstop``, 3d array
+        (nt, nP, npoints). `F` is ``ret[axes_prefix + '/T/F']`` (npoints,
+        nT)."""
+        return F[:,tstart:tstop].T[:,None,:] + \
+            self.V[None,None,:] * self.P[None,:,None] / eV_by_Ang3_to_GPa
+
+    def _calc_G_block(self, F, tstart, tstop, calc_all=True,
+                      warm_start=False):
+        """Calculate G and fit + minimize for a block of temperatures.
+
+        Parameters
+        ----------
+        F : 2d array (npoints, nT)
+            ``ret[axes_prefix + '/T/F']``
+        tstart, tstop : int
+            T index range
+        calc_all, warm_start : bool
+            see :meth:`calc_G`
+
+        Returns
+        -------
+        ret : dict
+            ``'/T/P/<axes_prefix>/G'`` (nt, nP, npoints) and
+            ``'/#opt/T/P/<name>'`` arrays (nt, nP) if `calc_all`
+        """
+        gg = self._G_block(F, tstart, tstop)
+        ret = {'/T/P' + self.axes_prefix + '/G': gg}
+        if not calc_all:
+            return ret
+        nt = gg.shape[0]
+        ret.update(dict(('/#opt/T/P/%s' %name, np.empty((nt,self.nP))) \
+                        for name in self._opt_names))
+        # all points on the T-P block at once
+        fits = self._fit_G_many(gg.reshape(nt*self.nP, gg.shape[-1]))
+        x0_t = None
+        for tidx in range(nt):
+            x0 = x0_t
+            for pidx in range(self.nP):
+                if self.verbose:
+                    print("calc_G: tidx = %i, pidx = %i" %(tidx+tstart,pidx))
+                xopt = self._fit_opt_store(ret, gg[tidx,pidx,:],
+                                           prfx='/T/P', tpidx=[tidx,pidx],
+                                           ghsym='G',
+                                           fit=fits[tidx*self.nP + pidx],
+                                           x0=x0)
+                if warm_start:
+                    x0 = xopt
+                    if pidx == 0:
+                        x0_t = xopt
+        return ret
+
+    _opt_names = ['ax0', 'ax1', 'ax2', 'V', 'G', 'B']
+
+    def _h5_fingerprint(self, F, calc_all):
+        """SHA1 digest (uint8 array) of all inputs of the G(T,P) results
+        which :meth:`calc_G` streams to an h5 file: T, P, axes, F(T) (which
+        contains `etot`), `calc_all` and the fit functions for G and the
+        axes (compiled code and constants, also of lambdas)."""
+        sha = hashlib.sha1()
+        for arr in [self.T, self.P, self.axes_flat, self.V, F]:
+            arr = np.ascontiguousarray(arr, dtype=float)
+            sha.update(repr(arr.shape).encode())
+            sha.update(arr.tobytes())
+        sha.update(repr((self.case, bool(calc_all))).encode())
+        for what in ['1d-G', '2d-G', '1d-ax']:
+            func = self.fitfunc[what]
+            code = getattr(func, '__code__', None)
+            if code is None:
+                sha.update(repr(func).encode())
+            else:
+                sha.update(code.co_code)
+                sha.update(repr(code.co_consts).encode())
+        return np.frombuffer(sha.digest(), dtype=np.uint8)
+
+    def _h5_init(self, fh, F, calc_all, chunk_nt):
+        """Create (or check for resume) datasets in h5 file `fh` for
+        :meth:`calc_G`. Returns the bool array of finished T indices."""
+        gkey = '/T/P' + self.axes_prefix + '/G'
+        shapes = {gkey: (self.nT, self.nP, self.npoints)}
+        if calc_all:
+            shapes.update(dict(('/#opt/T/P/%s' %name, (self.nT, self.nP)) \
+                               for name in self._opt_names))
+        fingerprint = self._h5_fingerprint(F, calc_all)
+        if '/#calc_G/tdone' in fh:
+            assert np.array_equal(fh['/#calc_G/fingerprint'][()],
+                                  fingerprint), \
+                ("inputs (T, P, axes, F, calc_all or fit functions) differ "
+                 "from those of the results in %s, cannot resume, use a new "
+                 "file" %fh.filename)
+        else:
+            fh['/T/T'] = self.T
+            fh['/P/P'] = self.P
+            fh.create_dataset('/#calc_G/tdone', data=np.zeros((self.nT,),
+                                                              dtype=bool))
+            fh['/#calc_G/fingerprint'] = fingerprint
+        for key,shape in shapes.items():
+            # not calculated results (None) are deleted at the end of
+            # calc_G, re-create them when resuming
+            if key in fh:
+                assert fh[key].shape == shape, \
+                    ("%s has wrong shape in file, cannot resume" %key)
+            else:
+                fh.create_dataset(key, shape=shape, dtype=float,
+                                  chunks=(chunk_nt,) + shape[1:])
+        return fh['/#calc_G/tdone'][()]
+
+    def calc_G(self, ret=None, calc_all=True, nprocs=None, warm_start=False,
+               h5file=None, maxmem=1.0):
         """Gibbs free energy and related properties on T-P grid. 
         Uses self.fitfunc.
         
@@ -659,35 +1091,123 @@ class Gibbs(object):
         calc_all : bool
             Calcluate thermal properties from G(ax0,ax1,ax2,T,P): Cp,
             alpha_x, B. If False, then calculate and store only G.
+        nprocs : int, optional
+            Number of processes for the fit + minimization on the T-P grid.
+            The T axis is split into blocks, each done by one worker process.
+            Uses ``multiprocessing`` with the "fork" start method (Unix only),
+            such that fit functions (which are often lambdas) don't need to
+            be pickled. The worker state is passed to the pool's initializer,
+            so concurrent calls don't interfere. If "fork" is not available
+            (e.g. Windows), the calculation is serial (with a warning).
+            Default (None or 1) is serial.
+        warm_start : bool
+            Use the optimum (V or (ax0,ax1)) of the previous point on the P
+            axis (or of the previous T at the first P) as start guess for
+            the minimization instead of the default start (see
+            :meth:`~pwtools.num.Fit1D.get_min` and
+            :meth:`~pwtools.num.PolyFit.get_min`). The optimum changes
+            smoothly on the T-P grid, so this saves iterations in the 2d
+            case. Note that in the 1d case, this uses Newton's method instead
+            of the default bracketing Brent's method. Results are the same
+            within the optimizer tolerance, so this is off by default.
+        h5file : str, optional
+            Stream results to this HDF5 file while they are calculated. The T
+            axis is processed in blocks of ``maxmem`` size, each block is
+            written to chunked datasets ``'/T/P/<axes_prefix>/G'`` and
+            ``'/#opt/T/P/*'`` right away, so the full G(T,P,ax0,...) array is
+            never in memory. Finished T indices are recorded in
+            ``'/#calc_G/tdone'``. If the file already exists (e.g. from an
+            interrupted run), calculation resumes at the unfinished T blocks.
+            This requires the same inputs (`T`, `P`, axes, F (including
+            `etot`), `calc_all`, fit functions for G and the axes), which are
+            checked by a fingerprint stored in ``'/#calc_G/fingerprint'``.
+            Otherwise, an error is raised, use a new file then. At the end, all other results are
+            written as well, such that the file has the same content as
+            ``io.write_h5(h5file, ret)``. Read it with ``io.read_h5(h5file,
+            lazy=True)`` to load only slices.
+        maxmem : float
+            Max. size of G in GB for one T block with `h5file`.
 
         Returns
         -------
         ret : dict
             All keys starting with the ``/#opt`` prefix are values obtained
-            from minimizing G(ax0,ax1,ax2,T,P) w.r.t. (ax0,ax1,ax2).         
+            from minimizing G(ax0,ax1,ax2,T,P) w.r.t. (ax0,ax1,ax2). With
+            `h5file`, ``ret['/T/P/<axes_prefix>/G']`` is a
+            :class:`~pwtools.io.H5LazyDataset` instead of an array, which
+            reads slices from `h5file` on demand without keeping the file
+            open.
+
+        Notes
+        -----
+        The fit points (axes grid) are the same for all (T,P), only the
+        values change. With the default fit functions, the design matrix is
+        factorized once and all G(T,P) are fitted in one solve per T block,
+        see :meth:`_fit_G_many`.
         """
         self._set_fitax()
         if ret is None:
             ret = self.calc_F(calc_all=calc_all)
-        ret['/T/P' + self.axes_prefix + '/G'] = np.empty((self.nT,self.nP,self.npoints), dtype=float)
-        for tidx in range(self.nT):
-            for pidx in range(self.nP):
-                gg = ret[self.axes_prefix + '/T/F'][:,tidx] + self.V * self.P[pidx]  / eV_by_Ang3_to_GPa
-                ret['/T/P' + self.axes_prefix + '/G'][tidx,pidx,:] = gg
-
         if calc_all:
             ret.update(self.calc_H(calc_all=calc_all))
-            names = ['ax0', 'ax1', 'ax2', 'V', 'G', 'B']
-            ret.update(dict(('/#opt/T/P/%s' %name, np.empty((self.nT,self.nP))) \
-                       for name in names))
+        F = ret[self.axes_prefix + '/T/F']
+        gkey = '/T/P' + self.axes_prefix + '/G'
+        nprocs = 1 if nprocs is None else nprocs
+        if nprocs > 1 and \
+                'fork' not in multiprocessing.get_all_start_methods():
+            warnings.warn("calc_G: multiprocessing start method 'fork' not "
+                          "available, using nprocs=1")
+            nprocs = 1
+        if h5file is None:
+            nblocks = nprocs
+        else:
+            nt = max(1, int(maxmem * 1e9 / (self.nP * self.npoints * 8.0)))
+            nblocks = max(nprocs, int(np.ceil(self.nT / float(nt))))
+        tblocks = [(x[0], x[-1]+1) for x in
+                   np.array_split(np.arange(self.nT), nblocks) if len(x) > 0]
+        fh = None
+        pool = None
+        try:
+            if h5file is not None:
+                fh = h5py.File(h5file, mode='a')
+                chunk_nt = min(tb[1]-tb[0] for tb in tblocks)
+                tdone = self._h5_init(fh, F, calc_all, chunk_nt)
+                tblocks = [tb for tb in tblocks if not
+                           tdone[tb[0]:tb[1]].all()]
+            if nprocs == 1:
+                blocks = (self._calc_G_block(F, tb[0], tb[1],
+                                             calc_all=calc_all,
+                                             warm_start=warm_start) \
+                          for tb in tblocks)
+            else:
+                # fork: the worker args are inherited, not pickled
+                ctx = multiprocessing.get_context('fork')
+                pool = ctx.Pool(nprocs, initializer=_calc_G_block_init,
+                                initargs=(self, F, calc_all, warm_start))
+                blocks = pool.imap(_calc_G_block_worker, tblocks)
+            if fh is None:
+                blocks = list(blocks)
+                for key in blocks[0].keys():
+                    ret[key] = np.concatenate([bb[key] for bb in blocks],
+                                              axis=0)
+            else:
+                for tb, bb in zip(tblocks, blocks):
+                    for key,val in bb.items():
+                        fh[key][tb[0]:tb[1],...] = val
+                    fh['/#calc_G/tdone'][tb[0]:tb[1]] = True
+                    fh.flush()
+                if calc_all:
+                    for name in self._opt_names:
+                        key = '/#opt/T/P/%s' %name
+                        ret[key] = fh[key][()]
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if fh is not None:
+                fh.close()
 
-            for tidx in range(self.nT):
-                for pidx in range(self.nP):
-                    if self.verbose:
-                        print("calc_G: tidx = %i, pidx = %i" %(tidx,pidx))
-                    gg = ret['/T/P' + self.axes_prefix + '/G'][tidx,pidx,:]
-                    self._fit_opt_store(ret, gg, prfx='/T/P',
-                                        tpidx=[tidx,pidx], ghsym='G')
+        if calc_all:
             self._set_not_calc_none(ret, prfx='/T/P')
             
             alpha_names = ['ax0', 'ax1', 'ax2', 'V']
@@ -709,9 +1229,37 @@ class Gibbs(object):
                 fit = self.fitfunc['C'](self.T, ret['/#opt/T/P/G'][:,pidx]*eV/kb)
                 ret['/#opt/T/P/Cp'][:,pidx] = -self.T * fit(self.T, der=2)
         ret.update(self.ret)        
+        if h5file is not None:
+            # G and /#opt/T/P/* are already in the file, overwrite all other
+            # (derived) results
+            streamed = [gkey] + ['/#opt/T/P/%s' %name for name in
+                                 self._opt_names]
+            with h5py.File(h5file, mode='a') as fh:
+                for key,val in ret.items():
+                    if key in streamed and val is not None:
+                        continue
+                    if key in fh:
+                        del fh[key]
+                    if val is not None:
+                        fh[key] = val
+            from pwtools import io
+            ret[gkey] = io.H5LazyDataset(h5file, gkey)
         return ret                
 
 
+# Gibbs.calc_G(nprocs=...) state, set only in worker processes by
+# _calc_G_block_init()
+_GIBBS_WORKER_ARGS = None
+
+def _calc_G_block_init(gibbs, F, calc_all, warm_start):
+    global _GIBBS_WORKER_ARGS
+    _GIBBS_WORKER_ARGS = (gibbs, F, calc_all, warm_start)
+
+def _calc_G_block_worker(trange):
+    gibbs, F, calc_all, warm_start = _GIBBS_WORKER_ARGS
+    return gibbs._calc_G_block(F, trange[0], trange[1], calc_all=calc_all,
+                               warm_start=warm_start)
+
 def debye_func(x, nstep=100, zero=1e-8):
     r"""Debye function
 
@@ -734,6 +1282,88 @@ def debye_func(x, nstep=100, zero=1e-8):
     return 3.0 * trapz(tt**3.0 / (np.exp(tt*x) - 1.0), tt, axis=1)
 
 
+# Bernoulli numbers B_n / n! for the small-x series in debye_func_fast(),
+# B_1 = -1/2, B_n = 0 for odd n > 1
+_DEBYE_BN_FAC = np.array([1.0, -0.5, 1.0/12.0, 0.0, -1.0/720.0, 0.0,
+                          1.0/30240.0, 0.0, -1.0/1209600.0, 0.0,
+                          1.0/47900160.0, 0.0, -691.0/1307674368000.0, 0.0,
+                          1.0/74724249600.0, 0.0,
+                          -3617.0/10670622842880000.0, 0.0,
+                          43867.0/5109094217170944000.0, 0.0,
+                          -174611.0/802857662698291200000.0])
+_DEBYE_NEVEN = np.arange(2, len(_DEBYE_BN_FAC), 2, dtype=float)
+_DEBYE_CEVEN = _DEBYE_BN_FAC[2::2] / (_DEBYE_NEVEN + 3.0)
+
+def debye_func_fast(x, der=0):
+    r"""Debye function as in :func:`debye_func`, but evaluated by series
+    expansions instead of numerical integration, with derivatives.
+
+    :math:`f(x) = 3 \int_0^1 t^3 / [\exp(t x) - 1] dt = 3 I(x) / x^4`,
+    :math:`I(x) = \int_0^x u^3 / [\exp(u) - 1] du`
+    
+    For ``x <= 1``, :math:`I(x)` is the term-wise integrated Bernoulli series
+    of :math:`u^3/(\exp(u)-1)` (converges for :math:`x < 2\pi`, 21 terms).
+    For ``x > 1``, :math:`I(x) = \pi^4/15 - \sum_k \exp(-k x) (x^3/k +
+    3x^2/k^2 + 6x/k^3 + 6/k^4)` (``40/min(x)`` terms). The relative error
+    of f(x) is < 1e-14 for ``x`` in [1e-3, 300] (compared to adaptive
+    quadrature), largest just above ``x=1``. Derivatives are analytic.
+
+    Compared to :func:`debye_func` with the default ``nstep=100``, the
+    relative difference is < 6e-5 for ``x`` in [1e-3, 10] and < 7e-4 for
+    ``x`` in [10, 100], which is the integration error of :func:`debye_func`
+    (trapz on 100 points). With ``nstep=1e5``, the difference is < 1e-10 for
+    ``x`` in [1e-3, 100]. It is 2-4 times faster than :func:`debye_func`
+    with ``nstep=100`` for arrays of 100-2000 points and, unlike that,
+    accepts arrays of any shape.
+
+    Parameters
+    ----------
+    x : float or array of any shape, x > 0
+    der : int
+        0, 1, 2: f(x), df/dx, d^2f/dx^2
+
+    Returns
+    -------
+    array of shape ``np.shape(x)``, at least 1d
+    """
+    x = np.atleast_1d(np.asarray(x, dtype=float))
+    ii = np.empty_like(x)
+    small = x <= 1.0
+    xs = x[small]
+    if xs.size > 0:
+        # I(x) = sum_n B_n/n! x^(n+3)/(n+3)
+        #      = x^3 (1/3 - x/8 + sum_{n even > 0} B_n/n!/(n+3) x^n)
+        ii[small] = xs**3.0 * (1.0/3.0 - xs/8.0 +
+                               np.dot(xs[:,None]**_DEBYE_NEVEN[None,:],
+                                      _DEBYE_CEVEN))
+    xl = x[~small]
+    if xl.size > 0:
+        # exp(-k*x) < 1e-17 for k > 40/x, so we need only a few terms for
+        # large x
+        kk = np.arange(1.0, np.ceil(40.0 / xl.min()) + 1.0)
+        xk = xl[:,None] * kk[None,:]
+        # exp(-kx) (x^3/k + 3x^2/k^2 + 6x/k^3 + 6/k^4)
+        #   = exp(-kx) (((kx + 3) kx + 6) kx + 6) / k^4
+        ii[~small] = pi**4.0 / 15.0 - \
+            (np.exp(-xk) * (((xk + 3.0) * xk + 6.0) * xk + 6.0) /
+             kk**4.0).sum(axis=-1)
+    ff = 3.0 * ii / x**4.0
+    if der == 0:
+        return ff
+    # I'(x) = x^3 / (exp(x) - 1) = x^3 nb, d nb/dx = -nb (1 + nb), nb -> 0
+    # w/o overflow of exp(x)**2 for large x
+    with np.errstate(over='ignore'):
+        nb = 1.0 / np.expm1(x)
+    df = 3.0 * nb / x - 4.0 * ff / x
+    if der == 1:
+        return df
+    elif der == 2:
+        return -3.0 * nb / x**2.0 - 3.0 * nb * (1.0 + nb) / x \
+            - 4.0 * df / x + 4.0 * ff / x**2.0
+    else:
+        raise ValueError("der must be 0, 1 or 2, got %s" %str(der))
+
+
 def einstein_func(x):
     r"""Einstein function 
     
@@ -747,7 +1377,7 @@ def einstein_func(x):
     return 1.0 / (np.exp(x) - 1.0)
 
 
-def expansion(temp, alpha, theta, x0=1.0, func=debye_func):
+def expansion(temp, alpha, theta, x0=1.0, func=debye_func, der=0):
     """Calculate thermal expansion according to the model in `func`.
      
     Parameters
@@ -761,7 +1391,11 @@ def expansion(temp, alpha, theta, x0=1.0, func=debye_func):
     x0 : float
         axis length at T=0
     func : callable
-        Usually :func:`debye_func` or :func:`einstein_func`
+        Usually :func:`debye_func`, :func:`debye_func_fast` or
+        :func:`einstein_func`
+    der : int
+        0 : x(T), 1 : dx/dT. For ``der=1``, `func` must accept a `der`
+        keyword, e.g. ``func=debye_func_fast``.
     
     Examples
     --------
@@ -774,9 +1408,17 @@ def expansion(temp, alpha, theta, x0=1.0, func=debye_func):
     >>>     plot(T, num.deriv_spl(x, T, n=1)/x)
     >>> x = expansion(T, 5e-6, 1200, 3, einstein_func) 
     >>> plot(T, num.deriv_spl(x, T, n=1)/x)
+    >>> # analytic
+    >>> x = expansion(T, 5e-6, 1200, 3, debye_func_fast)
+    >>> plot(T, expansion(T, 5e-6, 1200, 3, debye_func_fast, der=1)/x)
     
     References
     ----------
     [1] Figge et al., Appl. Phys. Lett. 94, 101915 (2009)
     """
-    return x0 * (1.0 + alpha * theta * func(theta / temp))
+    if der == 0:
+        return x0 * (1.0 + alpha * theta * func(theta / temp))
+    elif der == 1:
+        return -x0 * alpha * theta**2.0 / temp**2.0 * func(theta / temp, der=1)
+    else:
+        raise ValueError("der must be 0 or 1, got %s" %str(der))
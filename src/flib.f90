@@ -157,7 +157,8 @@ subroutine vacf(v, m, c, method, use_m, nthreads, natoms, nstep)
     ! in 3d array `v`.
     !
     ! method=1: loops
-    ! method=2: vectorized, but makes a copy of `v`
+    ! method=2: vectorized, but makes a copy of `v` (heap allocated) if
+    !           use_m=1
 #ifdef __OPENMP    
     use omp_lib
     !f2py threadsafe
@@ -170,8 +171,9 @@ subroutine vacf(v, m, c, method, use_m, nthreads, natoms, nstep)
     double precision, intent(out) :: c(0:nstep-1)
     character(len=*), parameter :: this='[_flib.so:vacf] '
     integer ::  t, i, j, k
-    ! for mass vector in method 2
-    double precision :: vv(0:nstep-1, 0:natoms-1, 0:2)
+    ! for mass vector in method 2, allocatable instead of an automatic array
+    ! b/c that lives on the stack and overflows it for long trajectories
+    double precision, allocatable :: vv(:,:,:)
     !f2py intent(in, out) c
 #ifdef __OPENMP
     ! Check if env vars are recognized.
@@ -244,6 +246,7 @@ subroutine vacf(v, m, c, method, use_m, nthreads, natoms, nstep)
         ! vv(i,j,:) . vv(i,j+t,:), we get m(i) back.
         
         if (use_m == 1) then
+            allocate(vv(0:nstep-1, 0:natoms-1, 0:2))
             !$omp parallel
             !$omp do
             do j = 0,nstep-1
@@ -254,6 +257,7 @@ subroutine vacf(v, m, c, method, use_m, nthreads, natoms, nstep)
             !$omp end do
             !$omp end parallel
             call vect_loops(vv, natoms, nstep, c)
+            deallocate(vv)
         else if (use_m == 0) then        
             call vect_loops(v, natoms, nstep, c)
         else
@@ -385,6 +389,62 @@ subroutine angles(distvecs, dists, mask_val, deg, anglesijk, natoms)
 end subroutine angles
 
 
+subroutine angles_hist(distvecs, dists, typat, cutoff, hist, natoms, nbins, ntypat)
+    ! Histogram of bond angles jj-ii-kk of all neighbor triplets within
+    ! `cutoff` around each central atom ii, w/o storing all angles (see
+    ! angles()). Counts are added to `hist`, so it can be used to accumulate
+    ! over many structures.
+    !
+    ! Parameters
+    ! ----------
+    ! distvecs : 3d array w/ cartesian distance vectors
+    ! dists : 2d array with distances: dists(i,j) = norm(distvecs(i,j,:))
+    ! typat : (natoms,)
+    !   atom type integers 1..ntypat
+    ! cutoff : float
+    !   neighbors jj are atoms with 0 < dists(ii,jj) < cutoff
+    ! hist : (nbins, ntypat, ntypat, ntypat)
+    !   hist(:,ti,tj,tk) for types ti=typat(ii) (central atom) and tj <= tk
+    !   of the neighbors, bins of equal width in [0,180] degrees
+    ! natoms, nbins, ntypat : int, dummy
+    !
+    ! Returns
+    ! -------
+    ! hist : updated input array
+    implicit none
+    integer :: natoms, nbins, ntypat, ii, jj, kk, ia, ib, nnb, ibin, tj, tk
+    integer :: typat(natoms), nblst(natoms)
+    double precision :: distvecs(natoms, natoms, 3)
+    double precision :: dists(natoms, natoms)
+    double precision :: cutoff, cang
+    double precision :: hist(nbins, ntypat, ntypat, ntypat)
+    double precision, parameter :: pi=acos(-1.0d0)
+    !f2py intent(in,out,overwrite) hist
+    do ii=1,natoms
+        nnb = 0
+        do jj=1,natoms
+            if (jj /= ii .and. dists(ii,jj) > 0.0d0 .and. dists(ii,jj) < cutoff) then
+                nnb = nnb + 1
+                nblst(nnb) = jj
+            end if
+        end do
+        do ia=1,nnb-1
+            jj = nblst(ia)
+            do ib=ia+1,nnb
+                kk = nblst(ib)
+                cang = dot_product(distvecs(ii,jj,:), distvecs(ii,kk,:)) &
+                    / dists(ii,jj) / dists(ii,kk)
+                cang = max(-1.0d0, min(1.0d0, cang))
+                ibin = min(int(acos(cang) / pi * nbins) + 1, nbins)
+                tj = min(typat(jj), typat(kk))
+                tk = max(typat(jj), typat(kk))
+                hist(ibin,typat(ii),tj,tk) = hist(ibin,typat(ii),tj,tk) + 1.0d0
+            end do
+        end do
+    end do
+end subroutine angles_hist
+
+
 subroutine distsq_frac(coords_frac, cell, pbc, distsq, distvecs, distvecs_frac, natoms)
     ! Special purpose routine to calculate distance vectors, squared distances
     ! and apply minimum image convention (pbc) for fractional atom coords.
@@ -520,6 +580,70 @@ subroutine distances_traj(coords_frac, cell, pbc, natoms, nstep, dists)
 end subroutine distances_traj
 
 
+subroutine neighbors_traj(coords_frac, cell, pbc, cutoff, maxnb, natoms, &
+                          nstep, cn, nblst)
+    ! Coordination numbers and neighbor lists along a trajectory. Neighbors
+    ! of atom ii are all atoms jj with 0 < dist(ii,jj) < cutoff. Like
+    ! distances_traj(), but only the neighbor info is stored, not the
+    ! distances.
+    !
+    ! Parameters
+    ! ----------
+    ! coords_frac : (nstep,natoms,3)
+    ! cell : (nstep,3,3)
+    ! pbc : int
+    !     {0,1}
+    ! cutoff : float
+    ! maxnb : int
+    !     max. number of neighbors stored in `nblst`, can be 0 if only `cn`
+    !     is needed
+    ! natoms,nstep : dummy input
+    !
+    ! Returns
+    ! -------
+    ! cn : (nstep,natoms)
+    !     coordination numbers (number of neighbors), also if > maxnb
+    ! nblst : (nstep,natoms,maxnb)
+    !     0-based neighbor indices, filled with -1
+    implicit none
+    integer :: natoms, pbc, istep, nstep, maxnb, ii, jj, nnb
+    double precision, intent(in) :: coords_frac(nstep,natoms,3), cell(nstep,3,3)
+    double precision, intent(in) :: cutoff
+    integer, intent(out) :: cn(nstep,natoms), nblst(nstep,natoms,maxnb)
+    double precision :: distsq(natoms,natoms), distvecs_frac(natoms, natoms, 3), &
+                        distvecs(natoms, natoms, 3), cutoffsq
+
+#ifdef __OPENMP    
+    !f2py threadsafe
+#endif    
+    
+    cutoffsq = cutoff**2.0d0
+    !$omp parallel private(distvecs_frac, distvecs, distsq, ii, jj, nnb) 
+    !$omp do
+    do istep=1,nstep
+        call distsq_frac(coords_frac(istep,:,:), &
+                         cell(istep,:,:), &
+                         pbc, distsq, distvecs, distvecs_frac, natoms)
+        nblst(istep,:,:) = -1
+        do ii=1,natoms
+            nnb = 0
+            do jj=1,natoms
+                if (jj /= ii .and. distsq(jj,ii) > 0.0d0 .and. &
+                    distsq(jj,ii) < cutoffsq) then
+                    nnb = nnb + 1
+                    if (nnb <= maxnb) then
+                        nblst(istep,ii,nnb) = jj - 1
+                    end if
+                end if
+            end do
+            cn(istep,ii) = nnb
+        end do
+    end do
+    !$omp end do
+    !$omp end parallel
+end subroutine neighbors_traj
+
+
 subroutine solve(aa, bb, nn, xx)
     ! Solve linear system a*x=b. 
     ! 